@@ -0,0 +1,13 @@
+import os
+
+# Sign-ins wait on Untappd, so serve them from greenlets rather than
+# tying up one process each.
+worker_class = 'gevent'
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 100))
+
+
+def post_fork(server, worker):
+    # Let database queries yield to other greenlets too
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -14,7 +14,7 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 from datetime import datetime
 import os
 
-from decouple import config
+from decouple import Csv, config
 
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -27,9 +27,16 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SECRET_KEY = 'il0+rg-q7_b6z00r5j33#(x*r!87j*4r+761rh0^!@_p8794+^'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# Set DEBUG=True for local development. Off, static files get their
+# hashed names and far-future caching.
+DEBUG = config('DEBUG', default=False, cast=bool)
 
-ALLOWED_HOSTS = []
+# Host names the site is served under, comma separated. Any will do
+# while debugging; otherwise only local ones until the deployment sets
+# its own.
+ALLOWED_HOSTS = config('ALLOWED_HOSTS',
+                       default='*' if DEBUG else 'localhost,127.0.0.1',
+                       cast=Csv())
 
 
 # Application definition
@@ -94,6 +101,43 @@ DATABASES = {
 }
 
 
+# Cache
+# The home page fragments and their version stamps are cached here. The
+# leaderboard's stamp is bumped by award_badges and the participants' on
+# sign-up, so the cache must be shared by every process: the database by
+# default (run createcachetable), or e.g. memcached via CACHE_BACKEND.
+# A per-process cache like LocMemCache leaves the home page's ETag and
+# Last-Modified stale.
+# The database needs no extra service, but every page view still costs
+# queries: one for the stamps (all a 304 needs) and one per fragment.
+# Under heavy traffic memcached takes that load off the database.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'mozlando.untappd.dbcache.DatabaseCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'mozlando_cache'),
+    }
+}
+
+PARTICIPANTS_CACHE_TIMEOUT = int(os.getenv('PARTICIPANTS_CACHE_TIMEOUT', 300))
+PARTICIPANTS_PAGE_SIZE = 50
+# Avatar thumbnail URLs change with the avatar, so browsers can keep them
+AVATAR_CACHE_TIMEOUT = int(os.getenv('AVATAR_CACHE_TIMEOUT',
+                                     60 * 60 * 24 * 365))
+LEADERBOARD_CACHE_TIMEOUT = int(os.getenv('LEADERBOARD_CACHE_TIMEOUT', 60))
+# Bearer token a Prometheus scraper must send for /metrics; with none set
+# the endpoint is off. It shows every process's metrics: each web worker
+# publishes its own to the cache every METRICS_PUBLISH_INTERVAL seconds,
+# and award_badges after each run or --watch pass. A web worker's are
+# dropped METRICS_PUBLISH_TTL seconds after it stops.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', None)
+METRICS_PUBLISH_INTERVAL = int(os.getenv('METRICS_PUBLISH_INTERVAL', 15))
+METRICS_PUBLISH_TTL = int(os.getenv('METRICS_PUBLISH_TTL', 5 * 60))
+LEADERBOARD_PAGE_SIZE = 50
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -115,14 +159,17 @@ DATABASES['default'] =  dj_database_url.config()
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
-# Allow all host headers
-ALLOWED_HOSTS = ['*']
-
 # Static asset configuration
 import os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_ROOT = 'staticfiles'
-STATIC_URL = '/static/'
+# Set STATIC_HOST to a CDN that pulls from this app to serve assets from
+# there instead.
+STATIC_URL = os.getenv('STATIC_HOST', '') + '/static/'
+# collectstatic writes content-hashed copies of each file with gzip and
+# brotli variants; WhiteNoise (see wsgi.py) serves the hashed ones with
+# far-future cache headers and the encoding the browser accepts.
+STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 STATICFILES_DIRS = (
     os.path.join(BASE_DIR, 'static'),
@@ -138,12 +185,67 @@ SITE_ID = 1
 ACCOUNT_DEFAULT_HTTP_PROTOCOL = config('ACCOUNT_DEFAULT_HTTP_PROTOCOL', 'http')
 
 DEFAULT_CACHE_AGE = int(os.getenv('DEFAULT_CACHE_AGE', 60 * 60 * 24 * 7))
-CACHE_PATH_TMPL = 'cache/%s/%s'
+# The newest page of a user's check-ins is only cached this long
+LATEST_CACHE_AGE = int(os.getenv('LATEST_CACHE_AGE', 5 * 60))
+# Stale cached pages are revalidated before use. Pages at most this many
+# seconds past their cache age are instead served as they are while a
+# background request revalidates them (0 to always wait).
+UNTAPPD_STALE_WHILE_REVALIDATE = int(
+    os.getenv('UNTAPPD_STALE_WHILE_REVALIDATE', 0))
+
+# Untappd response cache. Set UNTAPPD_CACHE_BACKEND to
+# mozlando.untappd.cache.DjangoCache to use the Django cache instead.
+UNTAPPD_CACHE = {
+    'BACKEND': os.getenv('UNTAPPD_CACHE_BACKEND',
+                         'mozlando.untappd.cache.SQLiteCache'),
+    'OPTIONS': {
+        'path': os.getenv('UNTAPPD_CACHE_PATH', 'cache/untappd.sqlite3'),
+        'max_entries': int(os.getenv('UNTAPPD_CACHE_MAX_ENTRIES', 10000)),
+        'max_bytes': int(os.getenv('UNTAPPD_CACHE_MAX_BYTES',
+                                   256 * 1024 * 1024)),
+    },
+}
 
 # See: https://untappd.com/api/docs
 UNTAPPD_BASE_URL = 'https://api.untappd.com/v4'
 UNTAPPD_CLIENT_ID = os.getenv('UNTAPPD_CLIENT_ID', None)
 UNTAPPD_CLIENT_SECRET = os.getenv('UNTAPPD_CLIENT_SECRET', None)
+# Seconds to wait on Untappd before giving up, and pooled keep-alive
+# connections per host.
+UNTAPPD_TIMEOUT = float(os.getenv('UNTAPPD_TIMEOUT', 5))
+UNTAPPD_POOL_SIZE = int(os.getenv('UNTAPPD_POOL_SIZE', 10))
+# Untappd accounts whose friend feeds award_badges reads, to fetch many
+# participants' check-ins per request (comma-separated usernames). They
+# must have signed in, for their access tokens, and participants must be
+# their friends. Friend lists are cached for UNTAPPD_FRIENDS_CACHE_AGE.
+UNTAPPD_FEED_USERNAMES = [
+    username for username in
+    os.getenv('UNTAPPD_FEED_USERNAMES', '').split(',') if username]
+UNTAPPD_FRIENDS_CACHE_AGE = int(os.getenv('UNTAPPD_FRIENDS_CACHE_AGE',
+                                          60 * 60))
+# Concurrent user fetches in award_badges, and the shared request rate
+# (requests/second) they are paced to.
+UNTAPPD_FETCH_CONCURRENCY = int(os.getenv('UNTAPPD_FETCH_CONCURRENCY', 8))
+UNTAPPD_RATE_LIMIT = float(os.getenv('UNTAPPD_RATE_LIMIT', 1))
+# Untappd allows a number of requests per UNTAPPD_QUOTA_WINDOW seconds and
+# reports what is left in X-Ratelimit-Remaining. award_badges leaves
+# UNTAPPD_QUOTA_RESERVE of them for sign-ins, and skips users without a
+# check-in for UNTAPPD_INACTIVE_AFTER seconds until they have gone
+# UNTAPPD_INACTIVE_INTERVAL seconds unchecked.
+UNTAPPD_QUOTA_WINDOW = int(os.getenv('UNTAPPD_QUOTA_WINDOW', 60 * 60))
+UNTAPPD_QUOTA_RESERVE = int(os.getenv('UNTAPPD_QUOTA_RESERVE', 10))
+UNTAPPD_INACTIVE_AFTER = int(os.getenv('UNTAPPD_INACTIVE_AFTER',
+                                       7 * 24 * 60 * 60))
+UNTAPPD_INACTIVE_INTERVAL = int(os.getenv('UNTAPPD_INACTIVE_INTERVAL',
+                                          6 * 60 * 60))
+
+# award_badges --watch polls each user every WATCH_MIN_INTERVAL (one beer
+# away from the badge) to WATCH_MAX_INTERVAL (no matching beers) seconds,
+# and looks for newly linked accounts every WATCH_ACCOUNTS_INTERVAL. Their
+# first fetch happens there rather than while they sign in.
+WATCH_MIN_INTERVAL = int(os.getenv('WATCH_MIN_INTERVAL', 5 * 60))
+WATCH_MAX_INTERVAL = int(os.getenv('WATCH_MAX_INTERVAL', 60 * 60))
+WATCH_ACCOUNTS_INTERVAL = int(os.getenv('WATCH_ACCOUNTS_INTERVAL', 15))
 
 CREDLY_BASE_URL = 'https://api.credly.com/v1.1'
 CREDLY_API_KEY = os.getenv('CREDLY_API_KEY', None)
@@ -151,8 +253,21 @@ CREDLY_API_SECRET = os.getenv('CREDLY_API_SECRET', None)
 CREDLY_USERNAME = os.getenv('CREDLY_USERNAME', None)
 CREDLY_PASSWORD = os.getenv('CREDLY_PASSWORD', None)
 CREDLY_BADGE_ID = 61615
-
-# Mozlando values
+CREDLY_PAGE_SIZE = 100
+CREDLY_TIMEOUT = 30
+CREDLY_MAX_RETRIES = 5
+CREDLY_BACKOFF = 1
+# Recipients per /member_badges request, and requests kept in flight
+CREDLY_AWARD_BATCH_SIZE = int(os.getenv('CREDLY_AWARD_BATCH_SIZE', 10))
+CREDLY_CONCURRENCY = int(os.getenv('CREDLY_CONCURRENCY', 4))
+# How long the local index of existing badge recipients is trusted before
+# award_badges re-reads it from Credly.
+CREDLY_RECIPIENT_INDEX_AGE = int(os.getenv('CREDLY_RECIPIENT_INDEX_AGE',
+                                           60 * 60))
+
+# Mozlando values. Badge rules are Event rows (see mozlando.untappd.models),
+# which award_badges evaluates together; these are the defaults used when
+# no event is given.
 NUM_BEERS = 12
 START_DATETIME = datetime(2015, 12, 7)
 END_DATETIME = datetime(2015, 12, 11, 23, 59, 59, 999999)
@@ -161,23 +276,11 @@ MIN_LATITUDE = 28.367444
 MAX_LATITUDE = 28.375647
 MIN_LONGITUDE = -81.553245
 MAX_LONGITUDE = -81.545134
-
-# Test values (Cherry Street in Tulsa Nov 23-27)
-# NUM_BEERS = 2
-# START_DATETIME = datetime(2015, 11, 23)
-# END_DATETIME = datetime(2015, 11, 27, 23, 59, 59, 999999)
-# MIN_LATITUDE = 36.136844
-# MAX_LATITUDE = 36.143845
-# MIN_LONGITUDE = -95.97546
-# MAX_LONGITUDE = -95.940098
-# CREDLY_BADGE_ID = 61628
-
-# Test values (Portland Nov 3-6)
-# NUM_BEERS = 2
-# START_DATETIME = datetime(2015, 11, 3)
-# END_DATETIME = datetime(2015, 11, 6, 23, 59, 59, 999999)
-# MIN_LATITUDE = 45.521143
-# MAX_LATITUDE = 45.526412
-# MIN_LONGITUDE = -122.684202
-# MAX_LONGITUDE = -122.671810
-# CREDLY_BADGE_ID = 61628
+# Named areas (e.g. one per pavilion) check-ins must fall in, as a GeoJSON
+# FeatureCollection. When set it replaces the MIN/MAX_LATITUDE/LONGITUDE
+# box. Each feature is a Polygon or MultiPolygon with a "name" property;
+# no surveyed outlines ship with the repo.
+GEOFENCE_PATH = os.getenv('GEOFENCE_PATH', None)
+GEOFENCE_CELL_SIZE = 0.0005
+# Distinct areas the matching beers must come from (0 to ignore areas)
+NUM_AREAS = int(os.getenv('NUM_AREAS', 0))
@@ -0,0 +1 @@
+default_app_config = 'mozlando.untappd.apps.UntappdConfig'
@@ -1,3 +1,48 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import (Award, Beer, Checkin, CheckinSync, Event, Score,
+                     Venue)
+
+
+@admin.register(Award)
+class AwardAdmin(admin.ModelAdmin):
+    list_display = ('email', 'badge_id', 'status', 'user', 'created')
+    list_filter = ('badge_id', 'status')
+    raw_id_fields = ('user',)
+    search_fields = ('email',)
+
+
+@admin.register(CheckinSync)
+class CheckinSyncAdmin(admin.ModelAdmin):
+    list_display = ('account', 'last_checkin_id', 'modified')
+    raw_id_fields = ('account',)
+
+
+@admin.register(Checkin)
+class CheckinAdmin(admin.ModelAdmin):
+    list_display = ('checkin_id', 'user', 'beer', 'venue', 'created_at')
+    raw_id_fields = ('user', 'beer', 'venue')
+
+
+@admin.register(Event)
+class EventAdmin(admin.ModelAdmin):
+    list_display = ('name', 'slug', 'active', 'start', 'end', 'num_beers',
+                    'credly_badge_id')
+    list_filter = ('active',)
+    prepopulated_fields = {'slug': ('name',)}
+
+
+@admin.register(Score)
+class ScoreAdmin(admin.ModelAdmin):
+    list_display = ('user', 'event', 'num_beers', 'updated')
+    list_filter = ('event',)
+    raw_id_fields = ('user',)
+
+
+@admin.register(Venue)
+class VenueAdmin(admin.ModelAdmin):
+    list_display = ('name', 'area', 'lat', 'lng')
+    list_filter = ('area',)
+
+
+admin.site.register(Beer)
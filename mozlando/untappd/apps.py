@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class UntappdConfig(AppConfig):
+    name = 'mozlando.untappd'
+    verbose_name = 'Untappd'
+
+    def ready(self):
+        from . import signals  # noqa
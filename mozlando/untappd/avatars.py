@@ -0,0 +1,90 @@
+"""
+Local thumbnails of participants' Untappd avatars.
+
+Rather than have every visitor load each full-size avatar from Untappd's
+CDN, the participant list links to /avatars/<account id>/<digest>.jpg.
+The first request fetches the avatar once and stores a 36x36 copy in
+AvatarThumbnail. The digest comes from the source URL, so the thumbnail
+can be cached for good and a new avatar gets a new URL.
+"""
+import hashlib
+from io import BytesIO
+
+import requests
+from PIL import Image, ImageOps
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError
+
+from . import metrics
+from .models import AvatarThumbnail
+from .session import get_session
+
+SIZE = (36, 36)
+
+
+def source_url(account):
+    """The avatar URL Untappd gave at sign-in, or ''."""
+    response = account.extra_data.get('response') or {}
+    return (response.get('user') or {}).get('user_avatar') or ''
+
+
+def source_digest(url):
+    return hashlib.md5(url.encode('utf-8')).hexdigest()[:12]
+
+
+def thumbnail_url(account):
+    """Where the account's thumbnail is served, or '' without an avatar."""
+    url = source_url(account)
+    if not url:
+        return ''
+    return reverse('avatar', args=[account.id, source_digest(url)])
+
+
+def stored_thumbnail(account_id, digest):
+    """The stored image for ``digest``, or None."""
+    image = (AvatarThumbnail.objects.filter(account=account_id,
+                                            digest=digest)
+                                    .values_list('image', flat=True)
+                                    .first())
+    return None if image is None else bytes(image)
+
+
+def create_thumbnail(account):
+    """
+    Fetch the account's avatar, shrink it and store it. Returns the JPEG
+    bytes, or None if the avatar couldn't be fetched or read.
+    """
+    url = source_url(account)
+    if not url:
+        return None
+    try:
+        with metrics.timer('avatar_fetch_seconds'):
+            r = get_session().get(url, timeout=settings.UNTAPPD_TIMEOUT)
+        r.raise_for_status()
+        image = shrink(r.content)
+    except (requests.exceptions.RequestException, IOError):
+        metrics.inc('avatar_thumbnails_total', result='error')
+        return None
+
+    try:
+        AvatarThumbnail.objects.update_or_create(
+            account=account, defaults=dict(source=url,
+                                           digest=source_digest(url),
+                                           image=image))
+    except IntegrityError:
+        # Created by a concurrent request
+        pass
+    metrics.inc('avatar_thumbnails_total', result='created')
+    return image
+
+
+def shrink(data):
+    """A SIZE JPEG of the middle of an image. Raises IOError for data
+    Pillow can't read."""
+    image = Image.open(BytesIO(data))
+    thumbnail = ImageOps.fit(image.convert('RGB'), SIZE, Image.ANTIALIAS)
+    out = BytesIO()
+    thumbnail.save(out, 'JPEG', quality=85, optimize=True)
+    return out.getvalue()
@@ -0,0 +1,275 @@
+"""
+Response cache for Untappd API calls.
+
+The backend is chosen by ``settings.UNTAPPD_CACHE``, which mirrors the
+shape of Django's ``CACHES`` setting::
+
+    UNTAPPD_CACHE = {
+        'BACKEND': 'mozlando.untappd.cache.SQLiteCache',
+        'OPTIONS': {'path': 'cache/untappd.sqlite3'},
+    }
+
+Values are byte strings; callers do their own encoding. Each entry can
+also keep a dict of validators (e.g. the response's ETag) so a stale
+entry can be revalidated rather than fetched again in full.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+# ``stored`` is when the value was set, in seconds since the epoch
+CacheEntry = namedtuple('CacheEntry', 'value stored validators')
+
+
+class BaseCache(object):
+    """
+    Counts hits and misses; subclasses implement _get_entry, which
+    returns a CacheEntry for entries younger than self.timeout, and _set.
+    """
+
+    def __init__(self, timeout=None, **options):
+        # Entries older than this are never served and may be purged
+        self.timeout = timeout or settings.DEFAULT_CACHE_AGE
+        self.hits = 0
+        self.misses = 0
+        self.stats_lock = threading.Lock()
+
+    def get(self, key, max_age=None):
+        """Return the value stored under ``key`` if younger than max_age."""
+        entry = self.get_entry(key, max_age)
+        if entry is None or self.is_stale(entry, max_age):
+            return None
+        return entry.value
+
+    def get_entry(self, key, max_age=None):
+        """
+        Return the CacheEntry under ``key``, even if older than max_age,
+        so it can be revalidated or served stale. Only entries younger
+        than max_age count as hits.
+        """
+        with metrics.timer('untappd_cache_seconds', op='get'):
+            entry = self._get_entry(key)
+        if entry is None:
+            result = 'miss'
+        elif self.is_stale(entry, max_age):
+            result = 'stale'
+        else:
+            result = 'hit'
+        with self.stats_lock:
+            if result == 'hit':
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.inc('untappd_cache_lookups_total', result=result)
+        return entry
+
+    def is_stale(self, entry, max_age=None):
+        max_age = min(max_age or self.timeout, self.timeout)
+        return entry.stored <= time.time() - max_age
+
+    def set(self, key, value, validators=None):
+        with metrics.timer('untappd_cache_seconds', op='set'):
+            self._set(key, value, validators or {})
+
+    def add_stats(self, stats):
+        """Count another process's hits and misses, e.g. a worker's."""
+        with self.stats_lock:
+            self.hits += stats['hits']
+            self.misses += stats['misses']
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses,
+                    hit_ratio=float(self.hits) / lookups if lookups else 0.0)
+
+    def _get_entry(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value, validators):
+        raise NotImplementedError
+
+
+class SQLiteCache(BaseCache):
+    """
+    Single-file cache with LRU eviction by entry count and total size.
+
+    Each write is its own transaction, so a crash never leaves a partial
+    entry, and WAL mode lets concurrent runs share the file. Hits don't
+    write: their access times are kept in memory and written together
+    every ``touch_every`` hits and before evicting.
+    """
+
+    def __init__(self, path='cache/untappd.sqlite3', max_entries=10000,
+                 max_bytes=256 * 1024 * 1024, evict_every=50,
+                 touch_every=100, **options):
+        super(SQLiteCache, self).__init__(**options)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.touch_every = touch_every
+        self.sets = 0
+        self.local = threading.local()
+        # Key -> access time not yet written, and hits since last written
+        self.touched = {}
+        self.touches = 0
+        self.touched_lock = threading.Lock()
+
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Created by a concurrent run
+                pass
+        with self.connection as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         ' key TEXT PRIMARY KEY,'
+                         ' value BLOB NOT NULL,'
+                         ' size INTEGER NOT NULL,'
+                         ' stored REAL NOT NULL,'
+                         ' accessed REAL NOT NULL,'
+                         ' validators TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS entries_accessed'
+                         ' ON entries (accessed)')
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(entries)')]
+            if 'validators' not in columns:
+                # Cache files from before validators were kept
+                conn.execute('ALTER TABLE entries ADD COLUMN validators TEXT')
+
+    @property
+    def connection(self):
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def _get_entry(self, key):
+        now = time.time()
+        conn = self.connection
+        row = conn.execute('SELECT value, stored, validators FROM entries'
+                           ' WHERE key = ? AND stored > ?',
+                           (key, now - self.timeout)).fetchone()
+        if row is None:
+            return None
+        with self.touched_lock:
+            self.touched[key] = now
+            self.touches += 1
+            flush = self.touches >= self.touch_every
+        if flush:
+            with conn:
+                self.write_accessed(conn)
+        value, stored, validators = row
+        return CacheEntry(bytes(value), stored,
+                          json.loads(validators) if validators else {})
+
+    def _set(self, key, value, validators):
+        now = time.time()
+        with self.connection as conn:
+            conn.execute('INSERT OR REPLACE INTO entries'
+                         ' (key, value, size, stored, accessed, validators)'
+                         ' VALUES (?, ?, ?, ?, ?, ?)',
+                         (key, sqlite3.Binary(value), len(value), now, now,
+                          json.dumps(validators)))
+        self.sets += 1
+        if self.sets % self.evict_every == 0:
+            self.evict()
+
+    def write_accessed(self, conn):
+        """Write the access times of hits since the last time."""
+        with self.touched_lock:
+            touched, self.touched = self.touched, {}
+            self.touches = 0
+        if touched:
+            conn.executemany('UPDATE entries SET accessed = ? WHERE key = ?',
+                             [(accessed, key)
+                              for key, accessed in touched.items()])
+
+    def evict(self):
+        """Purge expired entries, then least recently used ones over the
+        entry and size limits."""
+        with self.connection as conn:
+            self.write_accessed(conn)
+            conn.execute('DELETE FROM entries WHERE stored <= ?',
+                         (time.time() - self.timeout,))
+            count, size = conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries'
+            ).fetchone()
+            if count <= self.max_entries and size <= self.max_bytes:
+                return
+            cursor = conn.execute('SELECT key, size FROM entries'
+                                  ' ORDER BY accessed')
+            stale = []
+            for key, entry_size in cursor:
+                if count <= self.max_entries and size <= self.max_bytes:
+                    break
+                stale.append((key,))
+                count -= 1
+                size -= entry_size
+            conn.executemany('DELETE FROM entries WHERE key = ?', stale)
+
+
+class DjangoCache(BaseCache):
+    """Store entries in one of Django's configured CACHES."""
+
+    def __init__(self, alias='default', **options):
+        super(DjangoCache, self).__init__(**options)
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def _get_entry(self, key):
+        entry = self.cache.get('untappd:%s' % key)
+        if entry is None:
+            return None
+        # Entries stored before validators were kept have none
+        stored, value, validators = (tuple(entry) + ({},))[:3]
+        if stored <= time.time() - self.timeout:
+            return None
+        return CacheEntry(value, stored, validators)
+
+    def _set(self, key, value, validators):
+        self.cache.set('untappd:%s' % key, (time.time(), value, validators),
+                       self.timeout)
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process-wide cache configured by UNTAPPD_CACHE."""
+    global _cache, _cache_pid
+    with _cache_lock:
+        # A forked worker opens its own rather than sharing the parent's
+        # sqlite connections
+        if _cache is None or _cache_pid != os.getpid():
+            config = settings.UNTAPPD_CACHE
+            backend = import_string(config['BACKEND'])
+            _cache = backend(**config.get('OPTIONS', {}))
+            _cache_pid = os.getpid()
+    return _cache
+
+
+@receiver(setting_changed)
+def reset_cache(setting, **kwargs):
+    """Drop the cache when UNTAPPD_CACHE changes, e.g. under
+    override_settings, so the next get_cache() uses the new one."""
+    global _cache
+    if setting == 'UNTAPPD_CACHE':
+        with _cache_lock:
+            _cache = None
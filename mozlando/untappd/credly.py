@@ -0,0 +1,160 @@
+"""
+Client for the Credly API, used to award the badge.
+
+See: https://credly.com/developers
+"""
+import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from . import metrics
+
+
+class CredlyError(Exception):
+    pass
+
+
+class CredlyClient(object):
+    """
+    Credly API client over one keep-alive session.
+
+    Requests time out after CREDLY_TIMEOUT seconds and are retried with
+    exponential backoff on connection errors, 429 and 5xx responses. A
+    401 gets a new access token and tries again; threads sharing the
+    client get it once between them.
+    """
+
+    def __init__(self, base_url=None, api_key=None, api_secret=None,
+                 timeout=None, max_retries=None, backoff=None,
+                 pool_size=None):
+        self.base_url = base_url or settings.CREDLY_BASE_URL
+        self.timeout = timeout or settings.CREDLY_TIMEOUT
+        self.max_retries = (settings.CREDLY_MAX_RETRIES
+                            if max_retries is None else max_retries)
+        self.backoff = settings.CREDLY_BACKOFF if backoff is None else backoff
+        self.pool_size = pool_size or settings.CREDLY_CONCURRENCY
+        self.token = None
+        self.auth_lock = threading.RLock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'X-Api-Key': api_key or settings.CREDLY_API_KEY,
+            'X-Api-Secret': api_secret or settings.CREDLY_API_SECRET,
+        })
+
+    def request(self, method, path, data=None, auth=None):
+        params = dict(data or {})
+        token = None if path == '/authenticate' else self.token
+        if token:
+            params['access_token'] = token
+        url = '%s%s' % (self.base_url, path)
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                with metrics.timer('credly_request_seconds', path=path):
+                    r = self.session.request(method.upper(), url,
+                                             params=params, auth=auth,
+                                             timeout=self.timeout)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                metrics.inc('credly_requests_total', path=path,
+                            status='error')
+                if last_attempt:
+                    raise
+            else:
+                metrics.inc('credly_requests_total', path=path,
+                            status=r.status_code)
+                if r.status_code == 401 and token:
+                    # The token expired; get a new one and try again
+                    token = self.refresh_token(token)
+                    params['access_token'] = token
+                    continue
+                if (r.status_code != 429 and r.status_code < 500 or
+                    last_attempt):
+                    return r
+            time.sleep(self.backoff * 2 ** attempt)
+        raise CredlyError('Credly rejected every access token for %s' % path)
+
+    def authenticate(self, username=None, password=None):
+        """Exchange the Credly username and password for an access token."""
+        with self.auth_lock:
+            r = self.request('post', '/authenticate', auth=(
+                username or settings.CREDLY_USERNAME,
+                password or settings.CREDLY_PASSWORD))
+            if r.status_code != 200:
+                raise CredlyError('Error authenticating with Credly: %s'
+                                  % r.content)
+            self.token = json.loads(r.content)['data']['token']
+            return self.token
+
+    def refresh_token(self, expired):
+        """A token to use in place of ``expired``, authenticating again
+        unless another thread already has."""
+        with self.auth_lock:
+            if self.token == expired:
+                self.authenticate()
+            return self.token
+
+    def given_badges(self, page=1, per_page=None):
+        """One page of /me/badges/given, decoded."""
+        r = self.request('get', '/me/badges/given', {
+            'page': page,
+            'per_page': per_page or settings.CREDLY_PAGE_SIZE,
+        })
+        if r.status_code != 200:
+            raise CredlyError('Error listing given badges: %s' % r.content)
+        return json.loads(r.content)
+
+    def award(self, emails, badge_id=None):
+        """
+        Award the badge to a batch of emails in one request. Returns the
+        decoded response, with 'successes' and 'errors' keyed by email,
+        or None if the request failed outright.
+        """
+        r = self.request('post', '/member_badges', {
+            'email': ','.join(emails),
+            'first_name': None,
+            'last_name': None,
+            'badge_id': badge_id or settings.CREDLY_BADGE_ID,
+        })
+        if r.status_code != 200:
+            print 'Something went wrong awarding badge: '
+            print r.content
+            return None
+        return json.loads(r.content)
+
+    def award_all(self, emails, badge_id=None, batch_size=None,
+                  concurrency=None):
+        """
+        Award the badge to every email, CREDLY_AWARD_BATCH_SIZE per request
+        with at most ``concurrency`` requests in flight. Yields
+        (batch, response) pairs as they complete.
+        """
+        batch_size = batch_size or settings.CREDLY_AWARD_BATCH_SIZE
+        emails = list(emails)
+        batches = [emails[i:i + batch_size]
+                   for i in range(0, len(emails), batch_size)]
+        if not batches:
+            return
+
+        def award(batch):
+            return batch, self.award(batch, badge_id)
+
+        pool = ThreadPool(min(concurrency or self.pool_size, len(batches)))
+        try:
+            for result in pool.imap_unordered(award, batches):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
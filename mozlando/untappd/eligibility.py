@@ -0,0 +1,192 @@
+"""
+Batch evaluation of the badge rule over columns of check-ins.
+
+Check-ins are held as parallel NumPy arrays (user id, epoch seconds,
+lat, lng, bid), so the event window and geofence or bounding box
+become boolean masks and the unique beer count is a grouped
+``np.unique``. Counts are computed once and can then be compared against
+any threshold.
+"""
+import calendar
+
+import numpy as np
+
+from django.conf import settings
+
+from .geofence import get_geofence
+
+
+def epoch(dt):
+    """Seconds since the epoch; naive datetimes are taken as UTC."""
+    return calendar.timegm(dt.utctimetuple())
+
+
+class CheckinColumns(object):
+
+    def __init__(self, user, created, lat, lng, bid):
+        self.user = np.asarray(user, dtype=np.int64)
+        self.created = np.asarray(created, dtype=np.int64)
+        # Check-ins without a venue location are NaN and match no box
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.bid = np.asarray(bid, dtype=np.int64)
+        self._areas = {}
+
+    def __len__(self):
+        return len(self.user)
+
+    def areas(self, geofence):
+        """Index of each check-in's geofence area, or -1 (memoized).
+        Without a geofence nothing is in an area."""
+        if geofence not in self._areas:
+            if geofence is None:
+                self._areas[geofence] = np.full(len(self), -1,
+                                                dtype=np.int64)
+            else:
+                self._areas[geofence] = geofence.locate_many(self.lat,
+                                                             self.lng)
+        return self._areas[geofence]
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build columns from (user, created, lat, lng, bid) tuples."""
+        rows = list(rows)
+        if not rows:
+            return cls([], [], [], [], [])
+        user, created, lat, lng, bid = zip(*rows)
+        lat = [np.nan if value is None else value for value in lat]
+        lng = [np.nan if value is None else value for value in lng]
+        return cls(user, created, lat, lng, bid)
+
+    @classmethod
+    def from_queryset(cls, checkins):
+        """Build columns from a Checkin queryset."""
+        rows = checkins.values_list('user_id', 'created_at', 'venue__lat',
+                                    'venue__lng', 'beer_id')
+        return cls.from_rows((user, epoch(created), lat, lng, bid)
+                             for user, created, lat, lng, bid
+                             in rows.iterator())
+
+
+def event_mask(columns, start=None, end=None, bounds=None, in_areas=None,
+               geofence=None):
+    """
+    Boolean mask of check-ins inside the event window and area, defaulting
+    to the event settings like CheckinQuerySet.in_event.
+    """
+    geofence = geofence or get_geofence()
+    if bounds is None and in_areas is None:
+        in_areas = geofence is not None
+        if not in_areas:
+            bounds = (settings.MIN_LATITUDE, settings.MAX_LATITUDE,
+                      settings.MIN_LONGITUDE, settings.MAX_LONGITUDE)
+
+    start = epoch(start or settings.START_DATETIME)
+    end = epoch(end or settings.END_DATETIME)
+    mask = (columns.created > start) & (columns.created < end)
+    if bounds is not None:
+        min_lat, max_lat, min_lng, max_lng = bounds
+        with np.errstate(invalid='ignore'):
+            mask &= ((columns.lat >= min_lat) & (columns.lat <= max_lat) &
+                     (columns.lng >= min_lng) & (columns.lng <= max_lng))
+    if in_areas:
+        mask &= columns.areas(geofence) >= 0
+    return mask
+
+
+def unique_counts(user, values, mask=None):
+    """
+    Distinct ``values`` per user among the masked rows, as parallel
+    (users, counts) arrays. Values must be non-negative integers.
+    """
+    if mask is not None:
+        user, values = user[mask], values[mask]
+    if not len(user):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    # Pack each (user, value) pair into one integer so a single unique
+    # drops repeats, then count what is left per user.
+    offset = int(values.max()) + 1
+    pairs = np.unique(user * offset + values)
+    return np.unique(pairs // offset, return_counts=True)
+
+
+def unique_beer_counts(columns, mask=None):
+    """Distinct beers per user among the masked check-ins."""
+    return unique_counts(columns.user, columns.bid, mask)
+
+
+def event_beer_counts(columns, num_areas=None, **event):
+    """
+    Distinct beers per user at the event, as parallel (users, counts)
+    arrays, for users with check-ins in at least ``num_areas`` geofence
+    areas (NUM_AREAS by default; 0 to ignore areas). Users with at least
+    the event's number of beers are those CheckinQuerySet.eligible finds.
+    """
+    if num_areas is None:
+        num_areas = settings.NUM_AREAS
+    mask = event_mask(columns, **event)
+    users, counts = unique_beer_counts(columns, mask)
+
+    if num_areas:
+        areas = columns.areas(event.get('geofence') or get_geofence())
+        # Check-ins outside every area (-1) don't count towards one
+        area_users, area_counts = unique_counts(columns.user, areas,
+                                                mask & (areas >= 0))
+        enough_areas = np.in1d(users, area_users[area_counts >= num_areas])
+        users, counts = users[enough_areas], counts[enough_areas]
+    return users, counts
+
+
+class BadgeProgress(object):
+    """
+    One user's progress towards each event's badge, fed check-ins one at
+    a time, for deciding mid-fetch that no more are needed. ``stored``
+    maps event id to the (bid, area) pairs of check-ins already stored
+    that count for it.
+    """
+
+    def __init__(self, events, stored=None, geofence=None):
+        self.events = list(events)
+        self.geofence = geofence or get_geofence()
+        stored = stored or {}
+        self.beers = dict((event.id, set()) for event in self.events)
+        self.areas = dict((event.id, set()) for event in self.events)
+        for event in self.events:
+            for bid, area in stored.get(event.id, ()):
+                self.beers[event.id].add(bid)
+                if area:
+                    self.areas[event.id].add(area)
+        self.starts = dict((event.id, epoch(event.start))
+                           for event in self.events)
+        self.ends = dict((event.id, epoch(event.end))
+                         for event in self.events)
+
+    def earned(self, event):
+        return (len(self.beers[event.id]) >= event.num_beers and
+                len(self.areas[event.id]) >= event.num_areas)
+
+    def done(self):
+        return all(self.earned(event) for event in self.events)
+
+    def add(self, created, lat, lng, bid):
+        """Count a check-in made at epoch ``created``."""
+        area = None
+        located = False
+        for event in self.events:
+            if not self.starts[event.id] < created < self.ends[event.id]:
+                continue
+            min_lat, max_lat, min_lng, max_lng = event.bounds
+            if (lat is None or lng is None or
+                not min_lat <= lat <= max_lat or
+                not min_lng <= lng <= max_lng):
+                continue
+            if event.use_geofence or event.num_areas:
+                if not located:
+                    area = (self.geofence.locate(lat, lng)
+                            if self.geofence else None)
+                    located = True
+                if event.use_geofence and area is None:
+                    continue
+                if area is not None:
+                    self.areas[event.id].add(area)
+            self.beers[event.id].add(bid)
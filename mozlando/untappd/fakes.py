@@ -0,0 +1,382 @@
+"""
+Local stand-ins for the Untappd and Credly APIs, plus synthetic data.
+
+The servers answer the endpoints award_badges and the OAuth views use,
+with configurable latency, error rate and Untappd-style rate limiting,
+so runs can be measured at scale without touching the real services.
+See the benchmark_awards command.
+"""
+import hashlib
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlparse
+
+from .eligibility import epoch
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one segment, so keep-alive clients aren't held
+    # up by delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def respond(self, method):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length)))
+
+        status, data, headers = self.server.dispatch(method, url.path,
+                                                     params)
+        body = json.dumps(data).encode('utf-8')
+        if self.server.etags and status == 200:
+            headers['ETag'] = '"%s"' % hashlib.md5(body).hexdigest()
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded JSON server on a free local port. Every request waits
+    ``latency`` seconds and fails with a 500 at ``error_rate``; when
+    ``rate_limit`` is set, only that many requests without an access
+    token are allowed per ``rate_limit_window`` seconds, after which it
+    answers 429. With
+    ``etags``, responses carry an ETag and If-None-Match gets a 304.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0, error_rate=0, rate_limit=0,
+                 rate_limit_window=3600, seed=0, etags=False):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.etags = etags
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.thread = None
+        # Open keep-alive connections, closed on stop
+        self.connections = set()
+        self.reset_counters()
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            # Response body bytes
+            self.bytes_sent = 0
+            self.window_start = time.time()
+            self.remaining = self.rate_limit
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-response when they stop reading early
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def dispatch(self, method, path, params):
+        if self.latency:
+            time.sleep(self.latency)
+
+        headers = {}
+        with self.lock:
+            self.requests += 1
+            # Untappd limits each user's access token separately
+            if self.rate_limit and 'access_token' not in params:
+                now = time.time()
+                if now - self.window_start >= self.rate_limit_window:
+                    self.window_start = now
+                    self.remaining = self.rate_limit
+                limited = self.remaining <= 0
+                self.remaining = max(self.remaining - 1, 0)
+                headers['X-Ratelimit-Limit'] = self.rate_limit
+                headers['X-Ratelimit-Remaining'] = self.remaining
+            else:
+                limited = False
+            failed = self.random.random() < self.error_rate
+            if limited or failed:
+                self.errors += 1
+
+        if limited:
+            return 429, self.error(429, 'Rate limit exceeded'), headers
+        if failed:
+            return 500, self.error(500, 'Injected error'), headers
+        status, data = self.handle_api(method, path, params)
+        return status, data, headers
+
+    def error(self, code, detail):
+        return {'meta': {'code': code, 'error_detail': detail},
+                'response': {}}
+
+    def handle_api(self, method, path, params):
+        raise NotImplementedError
+
+
+class FakeUntappdServer(FakeServer):
+    """
+    Serves ``checkins`` (username -> raw check-in items, newest first)
+    from /v4/user/checkins/<username>, paged with max_id/min_id, plus the
+    OAuth token and user info endpoints. ``friends`` (username -> friend
+    usernames) are listed at /v4/user/friends/<username>, and their
+    check-ins make up /v4/checkin/recent for the user's access token,
+    which is token-<username>.
+    """
+
+    def __init__(self, checkins, friends=None, **kwargs):
+        FakeServer.__init__(self, **kwargs)
+        self.checkins = checkins
+        self.friends = friends or {}
+
+    def handle_api(self, method, path, params):
+        if path.startswith('/v4/user/checkins/'):
+            return self.user_checkins(path.rsplit('/', 1)[-1], params)
+        if path.startswith('/v4/user/friends/'):
+            return self.user_friends(path.rsplit('/', 1)[-1], params)
+        if path.startswith('/v4/checkin/recent'):
+            return self.recent_checkins(params)
+        if path.startswith('/oauth/authorize'):
+            return 200, {'response': {
+                'access_token': 'token-%s' % params.get('code', '')}}
+        if path.startswith('/v4/user/info'):
+            token = params.get('access_token', '')
+            return 200, {'meta': {'code': 200}, 'response': {'user': {
+                'uid': abs(hash(token)) % 10 ** 8,
+                'user_name': token,
+                'first_name': 'Fake',
+                'last_name': 'User',
+                'user_avatar': '',
+                'settings': {'email_address': '%s@example.com' % token},
+            }}}
+        return 404, self.error(404, 'Unknown endpoint')
+
+    def user_checkins(self, username, params):
+        if username not in self.checkins:
+            return 404, self.error(404, 'Invalid user')
+        return self.page(self.checkins[username], params)
+
+    def user_friends(self, username, params):
+        friends = self.friends.get(username, [])
+        offset = int(params.get('offset', 0))
+        page = friends[offset:offset + min(int(params.get('limit', 25)), 25)]
+        return 200, {'meta': {'code': 200}, 'response': {
+            'count': len(page),
+            'items': [{'user': {'user_name': friend}} for friend in page],
+        }}
+
+    def recent_checkins(self, params):
+        token = params.get('access_token', '')
+        if not token.startswith('token-'):
+            return 401, self.error(401, 'Invalid access token')
+        items = []
+        for friend in self.friends.get(token[len('token-'):], []):
+            items.extend(self.checkins.get(friend, []))
+        items.sort(key=lambda item: item['checkin_id'], reverse=True)
+        return self.page(items, params)
+
+    def page(self, items, params):
+        if params.get('max_id'):
+            items = [item for item in items
+                     if item['checkin_id'] < int(params['max_id'])]
+        if params.get('min_id'):
+            items = [item for item in items
+                     if item['checkin_id'] > int(params['min_id'])]
+        items = items[:min(int(params.get('limit', 25)), 50)]
+        max_id = items[-1]['checkin_id'] if items else ''
+        return 200, {'meta': {'code': 200}, 'response': {
+            'pagination': {'max_id': max_id},
+            'checkins': {'count': len(items), 'items': items},
+        }}
+
+
+class FakeCredlyServer(FakeServer):
+    """Records awards per badge and answers /authenticate,
+    /me/badges/given and /member_badges under /v1.1. Pages of given
+    badges hold at most ``max_per_page``, whatever is asked for. Only
+    the newest access token is accepted; expire_token() makes clients
+    authenticate again."""
+
+    def __init__(self, max_per_page=None, **kwargs):
+        FakeServer.__init__(self, **kwargs)
+        self.awards = {}
+        self.max_per_page = max_per_page
+        # Awards asked for again, which award_badges should avoid
+        self.duplicates = 0
+        self.authentications = 0
+        self.token = None
+
+    def expire_token(self):
+        with self.lock:
+            self.token = None
+
+    def handle_api(self, method, path, params):
+        if path == '/v1.1/authenticate':
+            with self.lock:
+                self.authentications += 1
+                self.token = 'fake-credly-token-%d' % self.authentications
+            return 200, {'data': {'token': self.token}}
+        if params.get('access_token') != self.token:
+            return 401, self.error(401, 'Invalid access token')
+        if path == '/v1.1/me/badges/given':
+            return 200, self.given(int(params.get('page', 1)),
+                                   int(params.get('per_page', 10)))
+        if path == '/v1.1/member_badges' and method == 'POST':
+            return 200, self.award(params.get('email', '').split(','),
+                                   int(params['badge_id']))
+        return 404, self.error(404, 'Unknown endpoint')
+
+    def given(self, page, per_page):
+        if self.max_per_page:
+            per_page = min(per_page, self.max_per_page)
+        with self.lock:
+            given = sorted((badge_id, email)
+                           for badge_id, emails in self.awards.items()
+                           for email in emails)
+        start = (page - 1) * per_page
+        return {
+            'data': [{'badge': {'id': badge_id},
+                      'member_orphan': {'email': email}}
+                     for badge_id, email in given[start:start + per_page]],
+            'paging': {'page': page, 'per_page': per_page,
+                       'total_results': len(given)},
+        }
+
+    def award(self, emails, badge_id):
+        successes, errors = {}, {}
+        with self.lock:
+            awarded = self.awards.setdefault(badge_id, set())
+            for email in emails:
+                if email in awarded:
+                    errors[email] = 'ALREADYAWARDED'
+                    self.duplicates += 1
+                else:
+                    awarded.add(email)
+                    successes[email] = 'SUCCESS'
+        response = {'successes': successes}
+        if errors:
+            response['errors'] = errors
+        return response
+
+
+def untappd_datetime(timestamp):
+    return time.strftime('%a, %d %b %Y %H:%M:%S +0000',
+                         time.gmtime(timestamp))
+
+
+def generate_checkins(num_users, num_checkins, event, in_event=0.3,
+                      num_beers=60, num_venues=30, seed=0):
+    """
+    Synthetic Untappd histories for ``num_users`` users of ``num_checkins``
+    check-ins each, newest first. About ``in_event`` of them fall inside
+    the event's window and box; the rest are from the year before,
+    elsewhere. Returns username -> items.
+    """
+    rng = random.Random(seed)
+    start, end = epoch(event.start), epoch(event.end)
+    min_lat, max_lat, min_lng, max_lng = event.bounds
+
+    def venue(venue_id, at_event):
+        if at_event:
+            lat = rng.uniform(min_lat, max_lat)
+            lng = rng.uniform(min_lng, max_lng)
+        else:
+            lat = rng.uniform(min_lat - 5, min_lat - 1)
+            lng = rng.uniform(min_lng - 5, min_lng - 1)
+        return {'venue_id': venue_id, 'venue_name': 'Venue %s' % venue_id,
+                'location': {'lat': lat, 'lng': lng}}
+
+    venues = [venue(i, at_event=i % 2 == 0) for i in range(1, num_venues + 1)]
+    event_venues = [v for v in venues if v['venue_id'] % 2 == 0]
+    other_venues = [v for v in venues if v['venue_id'] % 2 == 1]
+
+    rows = []
+    for n in range(num_users):
+        username = 'benchuser%d' % n
+        for i in range(num_checkins):
+            at_event = rng.random() < in_event
+            if at_event:
+                timestamp = rng.uniform(start, end)
+            else:
+                timestamp = rng.uniform(start - 365 * 86400, start)
+            rows.append((timestamp, username, at_event))
+
+    # Untappd check-in ids grow over time across all users
+    rows.sort()
+    checkins = dict(('benchuser%d' % n, []) for n in range(num_users))
+    for checkin_id, (timestamp, username, at_event) in enumerate(rows, 1):
+        bid = rng.randint(1, num_beers)
+        checkins[username].append({
+            'checkin_id': checkin_id,
+            'user': {'user_name': username},
+            'created_at': untappd_datetime(timestamp),
+            'beer': {'bid': bid, 'beer_name': 'Beer %s' % bid},
+            'brewery': {'brewery_name': 'Brewery %s' % (bid % 7)},
+            'venue': rng.choice(event_venues if at_event else other_venues),
+        })
+    for items in checkins.values():
+        items.reverse()
+    return checkins
@@ -0,0 +1,112 @@
+"""
+Versioned caching for rendered page fragments.
+
+Each fragment is cached under a version stamp kept in the Django cache.
+Invalidating bumps the stamp, which orphans every copy rendered under
+the old one, so page views don't touch the database until the data
+behind a fragment actually changes. The time of that change is kept
+apart from the stamp, for Last-Modified.
+"""
+import time
+from datetime import datetime
+
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from . import metrics
+
+
+class CachedFragment(object):
+
+    def __init__(self, name, template_name, get_context, timeout):
+        self.name = name
+        self.template_name = template_name
+        self.get_context = get_context
+        self.timeout = timeout
+
+    @property
+    def version_key(self):
+        return '%s:version' % self.name
+
+    @property
+    def modified_key(self):
+        return '%s:modified' % self.name
+
+    def version(self):
+        """
+        Version stamp of the current data. It counts up from the time in
+        milliseconds when it was first needed, so a stamp dropped from the
+        cache starts again past any it had reached.
+        """
+        return self._get(self.version_key, int(time.time() * 1000))
+
+    def last_modified(self):
+        """When the data last changed, or was first asked about."""
+        return self._as_datetime(self._get(self.modified_key, time.time()))
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            # Not stamped yet
+            self.version()
+        cache.set(self.modified_key, time.time(), None)
+
+    def _as_datetime(self, modified):
+        # Clocks differ between processes; never claim the future
+        return datetime.utcfromtimestamp(min(modified, time.time())).replace(
+            tzinfo=timezone.utc)
+
+    def _get(self, key, default):
+        value = cache.get(key)
+        if value is None:
+            cache.add(key, default, None)
+            value = cache.get(key, default)
+        return value
+
+    def cache_key(self, *args, **kwargs):
+        version = kwargs.get('version') or self.version()
+        return ':'.join(str(part) for part in
+                        (self.name, 'html', version) + args)
+
+    def render(self, *args, **kwargs):
+        """Render the fragment; ``args`` are passed to get_context and
+        distinguish cached variants (e.g. a page number). Pass ``version``
+        if it was already read, as by stamps()."""
+        key = self.cache_key(*args, **kwargs)
+        html = cache.get(key)
+        metrics.inc('fragment_lookups_total', fragment=self.name,
+                    result='miss' if html is None else 'hit')
+        if html is None:
+            # Building the context is where the page's queries happen
+            with metrics.timer('fragment_query_seconds',
+                               fragment=self.name):
+                context = self.get_context(*args)
+            with metrics.timer('fragment_render_seconds',
+                               fragment=self.name):
+                html = render_to_string(self.template_name, context)
+            cache.set(key, html, self.timeout)
+        return html
+
+
+def stamps(*fragments):
+    """
+    Version stamps and modified times of ``fragments`` in one cache
+    round trip, as {name: (version, last modified)}.
+    """
+    keys = []
+    for fragment in fragments:
+        keys += [fragment.version_key, fragment.modified_key]
+    found = cache.get_many(keys)
+    result = {}
+    for fragment in fragments:
+        try:
+            result[fragment.name] = (
+                found[fragment.version_key],
+                fragment._as_datetime(found[fragment.modified_key]))
+        except KeyError:
+            # Not stamped yet
+            result[fragment.name] = (fragment.version(),
+                                     fragment.last_modified())
+    return result
@@ -0,0 +1,150 @@
+"""
+Named-area geofences, e.g. one polygon per World Showcase pavilion.
+
+Areas are loaded from a GeoJSON FeatureCollection of Polygon or
+MultiPolygon features, each with a ``name`` property. Lookups first
+bucket points into a uniform grid, and only test the areas whose
+bounding boxes overlap that cell, so each point is checked against a
+handful of polygons instead of all of them.
+"""
+import json
+import math
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+
+def ring_contains(ring, lngs, lats):
+    """Even-odd ray casting of points against one closed ring."""
+    inside = np.zeros(len(lngs), dtype=bool)
+    x2, y2 = ring[-1]
+    for x1, y1 in ring:
+        crosses = (y1 > lats) != (y2 > lats)
+        # Edges parallel to the ray divide by zero, but never cross it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_at = (x2 - x1) * (lats - y1) / (y2 - y1) + x1
+            inside ^= crosses & (lngs < x_at)
+        x2, y2 = x1, y1
+    return inside
+
+
+class Area(object):
+
+    def __init__(self, name, polygons):
+        # polygons: [[outer ring, hole, ...], ...] of (lng, lat) pairs
+        self.name = name
+        self.polygons = [[np.asarray(ring, dtype=np.float64)
+                          for ring in polygon] for polygon in polygons]
+        points = np.concatenate([polygon[0] for polygon in self.polygons])
+        self.min_lng, self.min_lat = points.min(axis=0)
+        self.max_lng, self.max_lat = points.max(axis=0)
+
+    def contains(self, lngs, lats):
+        """Boolean mask of the points inside this area."""
+        inside = np.zeros(len(lngs), dtype=bool)
+        for polygon in self.polygons:
+            in_polygon = ring_contains(polygon[0], lngs, lats)
+            for hole in polygon[1:]:
+                in_polygon &= ~ring_contains(hole, lngs, lats)
+            inside |= in_polygon
+        return inside
+
+
+class Geofence(object):
+
+    def __init__(self, areas, cell_size=None):
+        self.areas = list(areas)
+        self.names = [area.name for area in self.areas]
+        self.cell_size = cell_size or settings.GEOFENCE_CELL_SIZE
+        # Grid cell -> indexes of areas whose bounding box overlaps it
+        self.grid = defaultdict(list)
+        for index, area in enumerate(self.areas):
+            for i in range(self.cell(area.min_lng),
+                           self.cell(area.max_lng) + 1):
+                for j in range(self.cell(area.min_lat),
+                               self.cell(area.max_lat) + 1):
+                    self.grid[i, j].append(index)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        with open(path) as f:
+            collection = json.load(f)
+        areas = []
+        for feature in collection['features']:
+            geometry = feature['geometry']
+            polygons = geometry['coordinates']
+            if geometry['type'] == 'Polygon':
+                polygons = [polygons]
+            areas.append(Area(feature['properties']['name'], polygons))
+        return cls(areas, **kwargs)
+
+    def cell(self, value):
+        return int(math.floor(value / self.cell_size))
+
+    def locate_many(self, lats, lngs):
+        """
+        Index into ``names`` of the area containing each point, or -1.
+        Points without a location (NaN) match nothing.
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        found = np.full(len(lats), -1, dtype=np.int64)
+        located = ~(np.isnan(lats) | np.isnan(lngs))
+        if not located.any():
+            return found
+
+        points = np.nonzero(located)[0]
+        cells_i = np.floor(lngs[points] / self.cell_size).astype(np.int64)
+        cells_j = np.floor(lats[points] / self.cell_size).astype(np.int64)
+        cells = defaultdict(list)
+        for point, i, j in zip(points, cells_i, cells_j):
+            if (i, j) in self.grid:
+                cells[i, j].append(point)
+
+        for cell, cell_points in cells.items():
+            cell_points = np.asarray(cell_points)
+            for index in self.grid[cell]:
+                unmatched = cell_points[found[cell_points] < 0]
+                if not len(unmatched):
+                    break
+                inside = self.areas[index].contains(lngs[unmatched],
+                                                    lats[unmatched])
+                found[unmatched[inside]] = index
+        return found
+
+    def locate(self, lat, lng):
+        """Name of the area containing the point, or None."""
+        if lat is None or lng is None:
+            return None
+        index = self.locate_many([lat], [lng])[0]
+        return self.names[index] if index >= 0 else None
+
+
+_geofence = None
+_geofence_lock = threading.Lock()
+
+
+def get_geofence():
+    """The geofence loaded from settings.GEOFENCE_PATH, or None."""
+    global _geofence
+    if not settings.GEOFENCE_PATH:
+        return None
+    with _geofence_lock:
+        if _geofence is None:
+            _geofence = Geofence.load(settings.GEOFENCE_PATH)
+    return _geofence
+
+
+@receiver(setting_changed)
+def reset_geofence(setting, **kwargs):
+    """Drop the geofence when its settings change, e.g. under
+    override_settings, so the next get_geofence() loads the new one."""
+    global _geofence
+    if setting in ('GEOFENCE_PATH', 'GEOFENCE_CELL_SIZE'):
+        with _geofence_lock:
+            _geofence = None
@@ -0,0 +1,102 @@
+"""
+Incremental decoding of one JSON array out of a streamed document.
+
+Untappd nests a page's check-ins at response.checkins.items. Rather than
+decoding the whole page, ``iter_array`` scans the byte stream for that
+array and decodes its elements one at a time, buffering only the text not
+yet decoded. A consumer that stops early stops the reading too.
+"""
+import codecs
+import json
+
+DECODER = json.JSONDecoder()
+WHITESPACE = ' \t\n\r'
+
+
+class Stream(object):
+    """Text buffer over an iterable of UTF-8 byte chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = u''
+        self.pos = 0
+
+    def read(self):
+        """Append the next chunk, dropping what has been consumed.
+        Returns False at the end of the stream."""
+        for chunk in self.chunks:
+            text = self.decoder.decode(chunk)
+            if text:
+                self.buf = self.buf[self.pos:] + text
+                self.pos = 0
+                return True
+        return False
+
+    def find(self, marker):
+        """Move past the next occurrence of ``marker``."""
+        while True:
+            found = self.buf.find(marker, self.pos)
+            if found >= 0:
+                self.pos = found + len(marker)
+                return
+            # Keep enough to match a marker split across chunks
+            self.pos = max(self.pos, len(self.buf) - len(marker) + 1)
+            if not self.read():
+                raise ValueError('%s not found' % marker)
+
+    def peek(self):
+        """The next non-whitespace character, or '' at the end."""
+        while True:
+            while (self.pos < len(self.buf) and
+                   self.buf[self.pos] in WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected %r at %s' % (char, self.pos))
+        self.pos += 1
+
+    def decode(self):
+        """Decode the JSON value starting here."""
+        self.peek()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # Incomplete; a complete value never fails to decode
+                if not self.read():
+                    raise
+                continue
+            # A number could go on in the next chunk
+            if end == len(self.buf) and self.read():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_array(chunks, keys):
+    """
+    Yield the elements of the array under the object ``keys`` (e.g.
+    ('checkins', 'items')), found by the first occurrence of each key in
+    turn, from a stream of UTF-8 byte chunks.
+    """
+    stream = Stream(chunks)
+    for key in keys:
+        stream.find(json.dumps(key))
+    stream.expect(':')
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+    while True:
+        yield stream.decode()
+        char = stream.peek()
+        stream.pos += 1
+        if char == ']':
+            return
+        if char != ',':
+            raise ValueError('Expected , or ] in array')
@@ -0,0 +1,60 @@
+"""
+Progress leaderboard, served from precomputed Score rows.
+
+award_badges refreshes scores as it ingests check-ins and then
+invalidates the cached pages, so no request ever counts check-ins or
+calls Untappd.
+"""
+from django.conf import settings
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.http import Http404
+
+from .fragments import CachedFragment
+from .models import Event, Score
+
+
+def get_event(slug=None):
+    """The active event with ``slug``, or the latest active event."""
+    events = Event.objects.active()
+    if slug:
+        events = events.filter(slug=slug)
+    event = events.first()
+    if event is None:
+        raise Http404('No such event')
+    return event
+
+
+def get_page(event, number):
+    paginator = Paginator(Score.objects.leaderboard(event),
+                          settings.LEADERBOARD_PAGE_SIZE)
+    try:
+        return paginator.page(number)
+    except PageNotAnInteger:
+        return paginator.page(1)
+    except EmptyPage:
+        return paginator.page(paginator.num_pages)
+
+
+def page_data(slug=None, number=1):
+    event = get_event(slug)
+    page = get_page(event, number)
+    return {
+        'event': event.slug,
+        'name': event.name,
+        'num_beers': event.num_beers,
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'count': page.paginator.count,
+        'results': [{
+            'rank': page.start_index() + i,
+            'username': score.user.username,
+            'num_beers': score.num_beers,
+            'updated': score.updated.isoformat(),
+        } for i, score in enumerate(page.object_list)],
+    }
+
+
+fragment = CachedFragment(
+    'leaderboard', '_leaderboard.html',
+    lambda slug=None: {'leaderboard': page_data(slug)},
+    settings.LEADERBOARD_CACHE_TIMEOUT)
@@ -1,83 +1,464 @@
 #!/usr/bin/env python
-from email.utils import parsedate
+import argparse
+from datetime import timedelta
 import hashlib
+import heapq
 import json
-import os
+import multiprocessing
 import requests
+import threading
 import time
 import urllib
-from os.path import dirname
+from multiprocessing.pool import ThreadPool
 
+from django import db
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
 
-from allauth.socialaccount.models import SocialAccount
+from allauth.socialaccount.models import SocialAccount, SocialToken
+
+from mozlando.untappd import leaderboard, metrics
+from mozlando.untappd.cache import get_cache
+from mozlando.untappd.credly import CredlyClient, CredlyError
+from mozlando.untappd.eligibility import BadgeProgress, epoch
+from mozlando.untappd.jsonstream import iter_array
+from mozlando.untappd.models import (Award, Checkin, CheckinSync,
+                                     CredlyRecipient, Event, Score, chunked,
+                                     normalize_email)
+from mozlando.untappd.profiling import Profiler
+from mozlando.untappd.ratelimit import Quota, QuotaExhausted, TokenBucket
+from mozlando.untappd.records import (CheckinRecord, pack_records,
+                                      unpack_records)
+from mozlando.untappd.session import describe_error, get_session
+
+
+class UntappdError(Exception):
+    """An Untappd API error response, e.g. an invalid user or an
+    exhausted quota."""
+
+    def __init__(self, code, detail):
+        super(UntappdError, self).__init__(
+            'Untappd error %s: %s' % (code, detail))
+        self.code = code
+        self.detail = detail
 
 
 class Command(BaseCommand):
 
-  def handle(self, *args, **options):
-    emails_to_award = []
+  def add_arguments(self, parser):
+    parser.add_argument('--concurrency', type=int,
+                        default=settings.UNTAPPD_FETCH_CONCURRENCY,
+                        help='Number of Untappd fetches to run at once.')
+    parser.add_argument('--rate', type=float,
+                        default=settings.UNTAPPD_RATE_LIMIT,
+                        help='Maximum Untappd requests per second '
+                             '(0 for no limit).')
+    parser.add_argument('--refresh-recipients', action='store_true',
+                        help='Re-read existing Credly badge recipients even '
+                             'if the local index is fresh.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep running, polling users closest to the '
+                             'badge most often and awarding as soon as '
+                             'they qualify.')
+    parser.add_argument('--stale-while-revalidate', type=int,
+                        default=settings.UNTAPPD_STALE_WHILE_REVALIDATE,
+                        help='Serve cached pages up to this many seconds '
+                             'stale while refreshing them in the '
+                             'background.')
+    parser.add_argument('--shard', type=parse_shard,
+                        help='Only handle shard i of N (given as i/N) of '
+                             'the accounts, partitioned by Untappd uid, so '
+                             'N nodes can share a run.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to fetch check-ins in; '
+                             'the parent awards badges once they finish.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Report wall and CPU time, memory and '
+                             'network and cache wait for each phase of '
+                             'the run.')
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help='Profile, and also write cProfile stats of '
+                             'the run to FILE for pstats, snakeviz or '
+                             'gprof2dot.')
 
+  def handle(self, *args, **options):
     if not settings.UNTAPPD_CLIENT_ID or not settings.UNTAPPD_CLIENT_SECRET:
         print ('You must set UNTAPPD_CLIENT_ID and UNTAPPD_CLIENT_SECRET'
                ' environment variables to use Untappd API.')
         return
+    if options['watch'] and options['workers'] > 1:
+        raise CommandError('--workers is for one-off runs; run a --watch '
+                           'per --shard instead.')
+    options['profile'] = options['profile'] or bool(options['profile_dump'])
+    if options['profile'] and options['watch']:
+        raise CommandError('--profile is for one-off runs.')
+
+    if not self.setup(options):
+        print 'There are no active events to award badges for.'
+        return
+
+    if options['watch']:
+        return self.watch()
+
+    metrics.reset()
+    if options['profile']:
+        self.profiler.start()
+    with metrics.timer('award_run_seconds'):
+        if options['workers'] > 1:
+            with self.profiler.phase('workers'):
+                user_ids = self.run_workers(options['workers'], options)
+        else:
+            user_ids = self.sync_shard(self.shard)
+        print 'Untappd cache: %(hits)s hits, %(misses)s misses' % (
+            get_cache().stats())
+
+        # Merge: evaluate everyone at once in the database, once per
+        # event, and award each badge once. A sharded run only evaluates
+        # its own users, so shards never award the same user.
+        with self.profiler.phase('eligibility'):
+            eligible = eligible_emails(self.events,
+                                       user_ids if self.shard else None,
+                                       self.awarded)
+        for event, emails in eligible.items():
+            if emails:
+                self.award(event, emails)
+        if self.refresher:
+            with self.profiler.phase('revalidation'):
+                self.refresher.join()
+
+    print 'Run summary:'
+    for line in metrics.summary():
+        print '  %s' % line
+    if settings.METRICS_TOKEN:
+        # Shown on /metrics until the next run replaces them
+        metrics.publish(self.metrics_process, timeout=None)
+    if options['profile']:
+        self.print_profile(options['profile_dump'])
+
+  def print_profile(self, dump=None):
+    self.profiler.stop()
+    print 'Profile:'
+    for line in self.profiler.report():
+        print '  %s' % line
+    if dump:
+        self.profiler.dump(dump)
+        print 'Wrote cProfile stats to %s' % dump
+
+  def setup(self, options):
+    """Load the run's state. Returns False if no event is active."""
+    if not self.load_events():
+        return False
+
+    self.shard = options.get('shard')
+    # What /metrics labels this command's metrics with
+    self.metrics_process = 'award_badges'
+    if self.shard:
+        self.metrics_process += ':%s/%s' % self.shard
+    self.concurrency = max(options['concurrency'], 1)
+    self.bucket = TokenBucket(options['rate'], self.concurrency)
+    # A one-off run spends what it is given, most promising users first;
+    # the watcher spreads the quota over the hour instead
+    self.quota = Quota(settings.UNTAPPD_QUOTA_WINDOW,
+                       settings.UNTAPPD_QUOTA_RESERVE,
+                       pace=options['watch'])
+    self.deferred = set()
+    self.refresher = None
+    if options.get('stale_while_revalidate'):
+        self.refresher = Refresher(options['stale_while_revalidate'],
+                                   self.concurrency)
+    self.refresh_recipients = options['refresh_recipients']
+    # Always timed; reported with --profile
+    self.profiler = Profiler(cprofile=bool(options.get('profile_dump')))
+    self.credly = None
+    self.syncs = {}
+    # Highest account id load_accounts has seen
+    self.newest_account_id = 0
+    # (user_id, badge_id) pairs in the award ledger
+    self.awarded = Award.objects.user_badges()
+    return True
+
+  def load_events(self):
+    """Load the active events. Returns False if there are none."""
+    self.events = list(Event.objects.active())
+    if not self.events:
+        return False
+    self.scored = set(Score.objects.filter(event__in=self.events)
+                                   .values_list('user_id', 'event_id'))
+    # Check-ins before the earliest event can't count for any of them
+    self.since = min(event.start for event in self.events)
+    return True
 
-    for account in SocialAccount.objects.filter(provider='untappd'):
-        username = account.user.username
-        beers = []
-        beer_ids = []
+  def run_workers(self, workers, options):
+    """
+    Fetch check-ins for this shard in ``workers`` processes, each taking
+    its own slice of it and an equal part of the request rate. Returns the
+    ids of the users they handled, with their cache stats and metrics
+    merged into this process's.
+    """
+    index, count = self.shard or (0, 1)
+    worker_options = dict(concurrency=options['concurrency'],
+                          rate=options['rate'] / workers,
+                          stale_while_revalidate=options.get(
+                              'stale_while_revalidate'),
+                          refresh_recipients=False, watch=False,
+                          profile=options.get('profile'),
+                          profile_dump=options.get('profile_dump'))
+    tasks = [((index + count * worker, count * workers), worker_options)
+             for worker in range(workers)]
+    # Workers open their own database connections
+    db.connections.close_all()
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(run_shard, tasks)
+    finally:
+        pool.close()
+        pool.join()
 
+    user_ids = []
+    for result in results:
+        user_ids.extend(result['user_ids'])
+        get_cache().add_stats(result['cache'])
+        metrics.merge(result['metrics'])
+    return user_ids
+
+  def sync_shard(self, shard=None):
+    """
+    Fetch and store new check-ins for the users in ``shard`` (all users
+    if None), most promising first. Returns their ids.
+    """
+    with self.profiler.phase('accounts'):
+        accounts = self.load_accounts(shard=shard)
+    user_ids = [account.user_id for account in accounts.values()]
+    with self.profiler.phase('rank'):
+        done = [username for username, account in accounts.items()
+                if self.has_every_badge(account.user_id)]
+        for username in done:
+            del accounts[username]
+        ranked, skipped = rank_accounts(accounts, self.syncs, self.events)
+    if done:
+        print 'Skipping %s users who have every badge' % len(done)
+    if skipped:
+        print 'Skipping %s users with no recent activity' % len(skipped)
+    with self.profiler.phase('sync'):
+        self.sync(accounts, ranked)
+    if self.deferred:
+        print ('Untappd quota exhausted; %s users left for the next '
+               'run' % len(self.deferred))
+    return user_ids
+
+  def load_accounts(self, after=0, shard=None):
+    """
+    Untappd accounts by username, optionally only those with ids above
+    ``after`` or in ``shard`` (an (index, count) pair), with their sync
+    state loaded.
+    """
+    accounts = {}
+    for account in (SocialAccount.objects.filter(provider='untappd',
+                                                 id__gt=after)
+                                         .select_related('user')
+                                         .iterator()):
+        self.newest_account_id = max(self.newest_account_id, account.id)
+        if shard is None or shard_of(account.uid, shard[1]) == shard[0]:
+            accounts[account.user.username] = account
+
+    for chunk in chunked(accounts.values()):
+        account_ids = [account.id for account in chunk]
+        syncs = dict((sync.account_id, sync) for sync in
+                     CheckinSync.objects.filter(account__in=account_ids))
+        missing = [account_id for account_id in account_ids
+                   if account_id not in syncs]
+        if missing:
+            CheckinSync.objects.bulk_create(
+                CheckinSync(account_id=account_id) for account_id in missing)
+            # bulk_create doesn't set primary keys; load them
+            syncs.update((sync.account_id, sync) for sync in
+                         CheckinSync.objects.filter(account__in=missing))
+        for account in chunk:
+            self.syncs[account.user.username] = syncs[account.id]
+    return accounts
+
+  def sync(self, accounts, order=None):
+    """
+    Fetch and store new check-ins for the given accounts, in ``order`` of
+    usernames if given, refreshing their scores. Users left unfetched
+    because the Untappd quota ran out are added to self.deferred.
+    Returns the ids of users whose scores were refreshed.
+    """
+    syncs = self.syncs
+    bucket = self.bucket
+    quota = self.quota
+    refresher = self.refresher
+    since = self.since
+    events = self.events
+    progress_seeds = stored_progress([account.user_id
+                                      for account in accounts.values()],
+                                     events)
+    tokens = user_tokens([account.id for account in accounts.values()])
+    with self.profiler.phase('fan_in'):
+        feed = self.fan_in(accounts)
+    changed = set()
+
+    def fetch_user(username, token=None):
+        # With their own token the request counts against the user's
+        # quota rather than the app's
+        progress = BadgeProgress(
+            events, progress_seeds.get(accounts[username].user_id))
+        seen = []
+        records = fetch_new_checkins(
+            username, syncs[username].last_checkin_id, bucket, since,
+            None if token else quota, progress, refresher, token, seen)
+        metrics.inc('untappd_user_fetches_total',
+                    via='token' if token else 'client')
+        return username, records, seen
+
+    def fetch(username):
+        """(username, new CheckinRecords or None if deferred, records
+        read to advance the watermark past)"""
+        if username in feed:
+            metrics.inc('untappd_user_fetches_total', via='feed')
+            return username, feed[username], []
+        token = tokens.get(accounts[username].id)
+        if token is None and quota.exhausted():
+            return username, None, []
         print 'Fetching user activity for %s' % username
-        checkins = untappd_api_get(
-            'user/checkins/%s' % username, dict(limit=50), 'activity',
-            settings.DEFAULT_CACHE_AGE
-        )
+        if token is not None:
+            try:
+                return fetch_user(username, token)
+            except UntappdError as e:
+                # A revoked token or the user's quota used up; fall back
+                # to the app's
+                print 'Could not fetch %s with their token: %s' % (
+                    username, e)
+                if quota.exhausted():
+                    return username, None, []
+        try:
+            return fetch_user(username)
+        except QuotaExhausted:
+            return username, None, []
+        except UntappdError as e:
+            print 'Could not fetch %s: %s' % (username, e)
+            return username, [], []
+
+    # Fetch concurrently, storing each user's check-ins as soon as their
+    # response arrives. imap_unordered hands users out in order, so once
+    # the quota runs out the remaining, least promising ones are deferred.
+    self.deferred.difference_update(accounts)
+    pool = ThreadPool(min(self.concurrency, len(accounts) or 1),
+                      self.profiler.profile_thread)
+    try:
+        for username, new_checkins, seen in pool.imap_unordered(
+                fetch, list(accounts) if order is None else order):
+            if new_checkins is None:
+                self.deferred.add(username)
+                continue
+            with self.profiler.phase('store'):
+                user = accounts[username].user
+                stored = Checkin.objects.ingest(user, new_checkins)
+                sync = syncs[username]
+                # Past older check-ins too, so users with none in the
+                # window aren't fetched from scratch every run
+                sync.advance(new_checkins)
+                sync.advance(seen)
+                sync.save()
+                unscored = [event for event in self.events
+                            if (user.id, event.id) not in self.scored]
+                if stored or unscored:
+                    Score.objects.refresh([user.id], self.events)
+                    self.scored.update((user.id, event.id)
+                                       for event in self.events)
+                    changed.add(user.id)
+            print 'Stored %s new checkins for %s' % (len(stored), username)
+    finally:
+        pool.close()
+        pool.join()
+    if changed:
+        leaderboard.fragment.invalidate()
+    return changed
 
-        if 'checkins' not in checkins['response']:
-            print "User %s has no checkins." % username
+  def fan_in(self, accounts):
+    """
+    Read the friend feeds of UNTAPPD_FEED_USERNAMES for the check-ins of
+    participants among their friends, many users per request. A feed
+    covers a friend once it has been read back to the friend's newest
+    known check-in, or to the start for friends never fetched. Returns
+    the new CheckinRecords of covered users by username, newest first;
+    everyone else is fetched one by one.
+    """
+    covered = {}
+    start = epoch(self.since)
+    for feed_username, token in feed_tokens().items():
+        try:
+            friends = friend_usernames(feed_username, self.bucket,
+                                       self.quota)
+        except (QuotaExhausted, UntappdError) as e:
+            print 'Could not list the friends of %s: %s' % (feed_username, e)
             continue
+        watermarks = dict((username, self.syncs[username].last_checkin_id)
+                          for username in friends
+                          if username in accounts and username not in covered)
+        if not watermarks:
+            continue
+        floor = (None if None in watermarks.values()
+                 else min(watermarks.values()))
 
-        for checkin in checkins['response']['checkins']['items']:
-            checkin_timetuple = parsedate(checkin.get('created_at'))
-            checkin_beer = checkin.get('beer')
-            if 'location' in checkin.get('venue'):
-                checkin_location = checkin.get('venue').get('location')
-                checkin_lat = checkin_location.get('lat')
-                checkin_lng = checkin_location.get('lng')
-            else:
-                print "%s checkin had no location." % checkin_beer['beer_name']
-                continue
-            if ( # checked in during Mozlando date/time
-                 settings.START_DATETIME.timetuple() < checkin_timetuple and
-                 checkin_timetuple < settings.END_DATETIME.timetuple()
-                ):
-                print 'Match Checkin: Time: {0}'.format(checkin_timetuple)
-                if ( # checked in at Epcot
-                 (
-                  settings.MIN_LATITUDE <= checkin_lat and
-                  checkin_lat <= settings.MAX_LATITUDE
-                 )
-                 and
-                 (
-                  settings.MIN_LONGITUDE <= checkin_lng and
-                  checkin_lng <= settings.MAX_LONGITUDE
-                 )
-                   ):
-                    print 'Match Checkin: Lat: %s Lng: %s' % (checkin_lat,
-                                                              checkin_lng)
-                    if ( # checked in a unique beer
-                     checkin_beer['bid'] not in beer_ids
-                    ):
-                        print 'Match Checkin: Beer: %s' % checkin_beer
-                        beers.append(checkin_beer)
-                        beer_ids.append(checkin_beer['bid'])
-            # if there are 12 check-ins, add the user's email to the list
-        if len(beers) >= settings.NUM_BEERS:
-            print "Found %s matching beers; badge time!" % settings.NUM_BEERS
-            # add the user's email to the list
-            emails_to_award.append(account.user.emailaddress_set.all()[0].email)
+        print 'Reading the friend feed of %s for %s users' % (
+            feed_username, len(watermarks))
+        found = {}
+        oldest_id = None
+        reached_start = False
+        try:
+            for record in iter_list('checkin/recent', dict(limit=50),
+                                    self.bucket, None, self.refresher,
+                                    token, scope=feed_username):
+                oldest_id = record.checkin_id
+                if record.created < start:
+                    reached_start = True
+                    break
+                if floor is not None and record.checkin_id <= floor:
+                    break
+                if record.user_name in watermarks:
+                    found.setdefault(record.user_name, []).append(record)
+        except UntappdError as e:
+            # Whatever was read still covers some friends
+            print 'Could not read the feed of %s: %s' % (feed_username, e)
+
+        for username, last_id in watermarks.items():
+            if reached_start or (last_id is not None and
+                                 oldest_id is not None and
+                                 last_id >= oldest_id):
+                covered[username] = [
+                    record for record in found.get(username, [])
+                    if last_id is None or record.checkin_id > last_id]
+    if covered:
+        print 'Friend feeds covered %s users' % len(covered)
+    return covered
+
+  def has_every_badge(self, user_id):
+    return all((user_id, event.credly_badge_id) in self.awarded
+               for event in self.events)
+
+  def award(self, event, emails):
+    """
+    Award the event's badge to whichever of the users don't have it yet,
+    given as a map of user id to email, recording them in the ledger.
+    Users sharing an email are awarded once, as the first of them.
+    """
+    badge_id = event.credly_badge_id
+    users = {}
+    emails_to_award = []
+    with self.profiler.phase('ledger'):
+        ledger = Award.objects.emails(badge_id)
+    for user_id, email in sorted(emails.items()):
+        normalized = normalize_email(email)
+        if normalized in users:
+            continue
+        users[normalized] = user_id
+        if normalized not in ledger:
+            emails_to_award.append(email)
+    if not emails_to_award:
+        return
 
     if (not settings.CREDLY_API_KEY
         or not settings.CREDLY_API_SECRET
@@ -87,46 +468,566 @@ class Command(BaseCommand):
                'CREDLY_USERNAME, and CREDLY_PASSWORD for awarding '
                'badges.')
         return
+
+    # Authenticate once; the client re-authenticates if the token expires
+    if self.credly is None:
+        with self.profiler.phase('credly_authenticate'):
+            credly = CredlyClient()
+            credly.authenticate()
+            self.credly = credly
+
+    # Remove existing badge recipients from emails_to_award
+    print 'Initial badge list: %s' % emails_to_award
+    with self.profiler.phase('credly_recipients'):
+        if (self.refresh_recipients or
+            not CredlyRecipient.objects.is_fresh(
+                settings.CREDLY_RECIPIENT_INDEX_AGE)):
+            refresh_recipient_index(self.credly)
+            self.refresh_recipients = False
+        recipients = CredlyRecipient.objects.emails(badge_id)
+    already = []
+    for email in emails_to_award:
+        if normalize_email(email) in recipients:
+            print 'Removing %s from badge list because they already have it.' % email
+            already.append(email)
+    Award.objects.record(badge_id, already, Award.ALREADY_AWARDED,
+                         users=users)
+    emails_to_award = [email for email in emails_to_award
+                       if normalize_email(email) not in recipients]
+
+    with self.profiler.phase('credly_award'):
+        recorded = already + award_badges(self.credly, emails_to_award,
+                                          badge_id, users)
+    self.awarded.update((users[normalize_email(email)], badge_id)
+                        for email in recorded
+                        if normalize_email(email) in users)
+
+  def watch(self):
+    """
+    Poll users forever on a priority schedule. Users closer to an event's
+    badge are polled more often, inactive users rarely, and users are
+    dropped once they have earned every active event's badge. Requests
+    are spread over the Untappd quota window; users who don't fit in it
+    wait for the next one.
+    """
+    accounts = {}
+    schedule = []
+    while True:
+        wait = self.watch_once(accounts, schedule)
+        if settings.METRICS_TOKEN:
+            metrics.publish(self.metrics_process)
+        time.sleep(wait)
+
+  def watch_once(self, accounts, schedule):
+    """
+    One pass of watch(): pick up new accounts and changed events, then
+    poll the users who are due. ``accounts`` (by username) and
+    ``schedule`` (a heap of (due time, username)) carry over between
+    passes. Returns how many seconds to wait for the next.
+    """
+    # Events may have been activated, ended or edited since the last pass
+    events = self.events
+    # With none active, users due are dropped until there are again
+    self.load_events()
+    if self.events != events:
+        # Users done with the old events may not be with these
+        scheduled = set(username for due, username in schedule)
+        for username, account in accounts.items():
+            if (username not in scheduled and
+                not self.has_every_badge(account.user_id)):
+                heapq.heappush(schedule, (time.time(), username))
+
+    # Pick up accounts linked since the last pass, due right away
+    new_accounts = self.load_accounts(after=self.newest_account_id,
+                                      shard=self.shard)
+    for username, account in new_accounts.items():
+        if not self.has_every_badge(account.user_id):
+            heapq.heappush(schedule, (time.time(), username))
+    accounts.update(new_accounts)
+
+    due = {}
+    order = []
+    while schedule and schedule[0][0] <= time.time():
+        username = heapq.heappop(schedule)[1]
+        due[username] = accounts[username]
+        order.append(username)
+
+    if due and self.events:
+        self.sync(due, order)
+        for username in self.deferred:
+            heapq.heappush(schedule, (self.quota.reset_at, username))
+        due = dict((username, account)
+                   for username, account in due.items()
+                   if username not in self.deferred)
+        user_ids = [account.user_id for account in due.values()]
+        for event, emails in eligible_emails(self.events, user_ids,
+                                             self.awarded).items():
+            if not emails:
+                continue
+            try:
+                self.award(event, emails)
+            except CredlyError as e:
+                # They stay scheduled, and are awarded once Credly is back
+                print 'Could not award %s: %s' % (event, e)
+            except requests.RequestException as e:
+                # Its message would show the access token
+                print 'Could not award %s: %s' % (
+                    event, describe_error(e, settings.CREDLY_BASE_URL))
+        # Users are done with an event once its badge is in the ledger,
+        # whether awarded now or before
+        scores = load_scores(user_ids, self.events)
+        for username, account in due.items():
+            if self.has_every_badge(account.user_id):
+                continue
+            interval = min(
+                poll_interval(scores.get((account.user_id, event.id), 0),
+                              event.num_beers)
+                for event in self.events)
+            if is_inactive(self.syncs[username]):
+                interval = max(interval,
+                               settings.UNTAPPD_INACTIVE_INTERVAL)
+            heapq.heappush(schedule, (time.time() + interval, username))
+
+    wait = settings.WATCH_MAX_INTERVAL
+    if schedule:
+        wait = schedule[0][0] - time.time()
+    return max(min(wait, settings.WATCH_ACCOUNTS_INTERVAL), 1)
+
+
+def run_shard(args):
+    """Sync one shard in a worker process; see Command.run_workers."""
+    shard, options = args
+    metrics.reset()
+    command = Command()
+    command.setup(options)
+    if options['profile']:
+        command.profiler.start()
+    try:
+        user_ids = command.sync_shard(shard)
+        if command.refresher:
+            command.refresher.join()
+    finally:
+        db.connections.close_all()
+    if options['profile']:
+        print 'Worker for shard %s/%s:' % shard
+        command.print_profile(options['profile_dump'] and
+                              '%s.%s' % (options['profile_dump'], shard[0]))
+    return dict(user_ids=user_ids, cache=get_cache().stats(),
+                metrics=metrics.snapshot())
+
+
+class Refresher(object):
+    """
+    Stale-while-revalidate for cached check-in pages: a page at most
+    ``stale`` seconds past its cache age is served as it is while a
+    background thread revalidates it for the next lookup.
+    """
+
+    def __init__(self, stale, concurrency=1):
+        self.stale = stale
+        self.pool = ThreadPool(concurrency)
+        # Cache keys being refreshed
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def can_serve(self, entry, max_age):
+        return entry.stored > time.time() - max_age - self.stale
+
+    def submit(self, key, func, *args):
+        """Run func(*args) in the background unless ``key`` already is."""
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        self.pool.apply_async(self.refresh, (key, func) + args)
+
+    def refresh(self, key, func, *args):
+        try:
+            func(*args)
+        except QuotaExhausted:
+            pass
+        except UntappdError as e:
+            print 'Could not refresh %s: %s' % (args[0], e)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def join(self):
+        """Wait for the refreshes under way; no more can be submitted."""
+        self.pool.close()
+        self.pool.join()
+
+
+def parse_shard(value):
+    """Parse --shard's i/N into (i, N)."""
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, e.g. 0/4')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('i must be between 0 and N - 1')
+    return index, count
+
+
+def shard_of(uid, count):
+    """Which of ``count`` shards an Untappd uid belongs to. Stable across
+    processes and machines, unlike hash()."""
+    return int(hashlib.md5(uid.encode('utf-8')).hexdigest(), 16) % count
+
+
+def user_tokens(account_ids):
+    """Map account id to the Untappd access token stored at sign-in."""
+    tokens = {}
+    for chunk in chunked(account_ids):
+        tokens.update(SocialToken.objects.filter(account__in=chunk)
+                                         .values_list('account_id', 'token'))
+    return tokens
+
+
+def feed_tokens():
+    """Map each of UNTAPPD_FEED_USERNAMES who has signed in to their
+    access token."""
+    if not settings.UNTAPPD_FEED_USERNAMES:
+        return {}
+    return dict(SocialToken.objects.filter(
+        account__provider='untappd',
+        account__user__username__in=settings.UNTAPPD_FEED_USERNAMES,
+    ).values_list('account__user__username', 'token'))
+
+
+def friend_usernames(username, bucket=None, quota=None):
+    """The usernames of an Untappd user's friends."""
+    friends = set()
+    params = dict(offset=0, limit=25)
+    while True:
+        data = untappd_api_get(
+            'user/friends/%s' % username, dict(params), cache_name='friends',
+            cache_timeout=settings.UNTAPPD_FRIENDS_CACHE_AGE,
+            bucket=bucket, quota=quota)
+        items = data['response'].get('items') or []
+        friends.update(item['user']['user_name'] for item in items
+                       if item.get('user'))
+        if len(items) < params['limit']:
+            return friends
+        params['offset'] += len(items)
+
+
+def stored_progress(user_ids, events):
+    """
+    For each user, map event id to the (bid, area) pairs of stored
+    check-ins that count for it, to seed their BadgeProgress.
+    """
+    stored = {}
+    checkins = Checkin.objects.filter(user__in=user_ids)
+    for event in events:
+        for user_id, bid, area in (event.checkins(checkins)
+                                        .values_list('user_id', 'beer_id',
+                                                     'venue__area')
+                                        .distinct()):
+            stored.setdefault(user_id, {}).setdefault(event.id, []).append(
+                (bid, area))
+    return stored
+
+
+def load_scores(user_ids, events):
+    """Map (user id, event id) to the user's matching beers so far."""
+    scores = {}
+    for user_id, event_id, num_beers in (
+            Score.objects.filter(user__in=user_ids, event__in=events)
+                         .values_list('user_id', 'event_id', 'num_beers')):
+        scores[user_id, event_id] = num_beers
+    return scores
+
+
+def is_inactive(sync):
+    """Whether a user's newest known check-in is older than
+    UNTAPPD_INACTIVE_AFTER."""
+    return (sync.last_active is not None and
+            sync.last_active < timezone.now() - timedelta(
+                seconds=settings.UNTAPPD_INACTIVE_AFTER))
+
+
+def rank_accounts(accounts, syncs, events):
+    """
+    Order usernames by how likely fetching them is to earn a badge, for
+    spending a limited Untappd quota. Users never fetched come first, then
+    users by progress towards their nearest unearned badge and then by
+    recent activity; users who earned every badge come last. Inactive
+    users fetched within UNTAPPD_INACTIVE_INTERVAL are skipped.
+    Returns (ranked usernames, skipped usernames).
+    """
+    scores = load_scores([account.user_id for account in accounts.values()],
+                         events)
+    recently = timezone.now() - timedelta(
+        seconds=settings.UNTAPPD_INACTIVE_INTERVAL)
+
+    ranks = []
+    skipped = []
+    for username, account in accounts.items():
+        sync = syncs[username]
+        if sync.last_checkin_id is None:
+            ranks.append(((0, 0, 0), username))
+            continue
+        if is_inactive(sync) and sync.modified > recently:
+            skipped.append(username)
+            continue
+        progress = [float(scores.get((account.user_id, event.id), 0)) /
+                    max(event.num_beers, 1) for event in events]
+        unearned = [fraction for fraction in progress if fraction < 1]
+        last_active = (time.mktime(sync.last_active.timetuple())
+                       if sync.last_active else 0)
+        ranks.append(((1 if unearned else 2,
+                       -max(unearned or progress), -last_active), username))
+    ranks.sort()
+    return [username for rank, username in ranks], skipped
+
+
+def poll_interval(num_beers, target):
+    """Seconds until a user with ``num_beers`` of ``target`` beers should
+    be polled again, shortest for users one beer away from the badge."""
+    remaining = max(target - num_beers, 0)
+    fraction = float(remaining) / max(target, 1)
+    return (settings.WATCH_MIN_INTERVAL +
+            (settings.WATCH_MAX_INTERVAL - settings.WATCH_MIN_INTERVAL) *
+            fraction)
+
+
+def eligible_emails(events, user_ids=None, awarded=()):
+    """
+    For each event, map user id to email for users who earned its badge,
+    optionally only among ``user_ids``, leaving out (user_id, badge_id)
+    pairs already ``awarded``.
+    """
+    checkins = Checkin.objects.all()
+    if user_ids is not None:
+        checkins = checkins.filter(user__in=user_ids)
+    eligible = {}
+    for event in events:
+        with metrics.timer('eligibility_seconds', event=event.slug):
+            eligible[event] = dict(
+                (user_id, num_beers)
+                for user_id, num_beers in event.eligible(checkins)
+                if (user_id, event.credly_badge_id) not in awarded)
+
+    user_ids = set()
+    for counts in eligible.values():
+        user_ids.update(counts)
+    users = {}
+    for chunk in chunked(user_ids):
+        users.update((user.id, user) for user in
+                     User.objects.filter(id__in=chunk)
+                                 .prefetch_related('emailaddress_set'))
+
+    emails = {}
+    for event, counts in eligible.items():
+        emails[event] = {}
+        for user_id, num_beers in counts.items():
+            user = users[user_id]
+            addresses = user.emailaddress_set.all()
+            if not addresses:
+                print 'No email address for %s; skipping.' % user.username
+                continue
+            print "Found %s matching beers for %s at %s; badge time!" % (
+                num_beers, user.username, event)
+            # add the user's email to the list
+            emails[event][user_id] = addresses[0].email
+    return emails
+
+
+def fetch_new_checkins(username, min_id=None, bucket=None, since=None,
+                       quota=None, progress=None, refresher=None, token=None,
+                       seen=None):
+    """
+    Fetch a user's check-ins newer than ``min_id`` (the last one already
+    seen), newest first, stopping at the first made before ``since``
+    (default: settings.START_DATETIME) or, given a BadgeProgress, as soon
+    as the user has earned every badge. Requests not served from the
+    cache are paced by ``bucket`` and ``quota``; given a Refresher, stale
+    pages may be served while they are revalidated. Requests are made
+    with the user's access ``token`` if given, else the app's client id.
+    Given a list ``seen``, the newest check-in read is appended to it even
+    if it is too old to return, so the user's watermark can move past it.
+
+    Check-ins are decoded one at a time and reduced to CheckinRecords as
+    they stream in, so only what is kept is ever held in memory. Returns
+    the records, newest first.
+    """
+    checkins = iter_checkins(username, min_id, bucket, since, quota,
+                             refresher, token, seen)
+    if progress is not None:
+        checkins = until_earned(checkins, progress)
+    try:
+        return list(checkins)
+    finally:
+        checkins.close()
+
+
+def until_earned(records, progress):
+    """Pass check-in records through until ``progress`` has every badge."""
+    try:
+        for record in records:
+            if progress.done():
+                metrics.inc('untappd_fetch_stopped_total', reason='earned')
+                return
+            yield record
+            if record.bid is not None:
+                progress.add(record.created, record.lat, record.lng,
+                             record.bid)
+    finally:
+        records.close()
+
+
+def iter_checkins(username, min_id=None, bucket=None, since=None,
+                  quota=None, refresher=None, token=None, seen=None):
+    """
+    Page through a user's check-ins, newest first, yielding
+    CheckinRecords until one is older than ``since``. The first record
+    read is appended to ``seen`` if given.
+    """
+    params = dict(limit=50)
+    if min_id:
+        params['min_id'] = min_id
+    start = epoch(since or settings.START_DATETIME)
+
+    def too_old(record):
+        if seen is not None and not seen:
+            seen.append(record)
+        if record.created < start:
+            metrics.inc('untappd_fetch_stopped_total', reason='since')
+            return True
+        return False
+
+    return iter_list('user/checkins/%s' % username, params, bucket, quota,
+                     refresher, token, until=too_old)
+
+
+def iter_list(path, params, bucket=None, quota=None, refresher=None,
+              token=None, scope='', until=None):
+    """
+    Page through an Untappd check-in list, newest first, using the max_id
+    cursor, yielding CheckinRecords to the end of the list or up to the
+    first one ``until(record)`` is true for. The rest of that record's
+    page is still read, so the page gets cached.
+    """
+    params = dict(params)
+    while True:
+        count = 0
+        stopped = False
+        # Only the newest page changes; pages behind a cursor are fixed
+        for record in iter_page(
+                path, dict(params),
+                settings.DEFAULT_CACHE_AGE if 'max_id' in params
+                else settings.LATEST_CACHE_AGE,
+                bucket, quota, refresher, token, scope):
+            count += 1
+            if not stopped and until is not None and until(record):
+                stopped = True
+            if not stopped:
+                yield record
+        if stopped or count < params['limit']:
+            return
+        params['max_id'] = record.checkin_id
+
+
+def iter_page(path, params, cache_timeout, bucket=None, quota=None,
+              refresher=None, token=None, scope=''):
+    """
+    CheckinRecords from one page of an Untappd check-in list, from the
+    cache or streamed from the API. Pages read to the end are cached,
+    packed with pack_records, along with validators for revalidating them
+    once older than ``cache_timeout``. Given a Refresher, a page not too
+    stale is served as it is and revalidated in the background.
+
+    Pages are requested with the access ``token`` if given, but cached
+    under the client id URL so either finds them; ``scope`` tells apart
+    lists that differ per token, like a friend feed.
+    """
+    url = untappd_api_url(path, params)
+    cache = get_cache()
+    cache_key = 'records:%s' % hashlib.md5(url + scope).hexdigest()
+
+    entry = cache.get_entry(cache_key, cache_timeout)
+    page = None
+    if entry is not None:
+        try:
+            page = unpack_records(entry.value)
+        except ValueError:
+            pass
+    if page is not None:
+        if cache.is_stale(entry, cache_timeout):
+            args = (path, params, cache_key, page, entry.validators,
+                    bucket, quota, token)
+            if (refresher is not None and
+                    refresher.can_serve(entry, cache_timeout)):
+                refresher.submit(cache_key, revalidate_page, *args)
+            else:
+                page = revalidate_page(*args)
+        for record in page:
+            yield record
+        return
+
+    if token:
+        url = untappd_api_url(path, params, token)
+    page = []
+    validators = {}
+    for item in untappd_stream(url, ('checkins', 'items'), bucket, quota,
+                               validators):
+        record = CheckinRecord.from_item(item)
+        page.append(record)
+        yield record
+    if page:
+        validators['newest'] = page[0].checkin_id
+    cache.set(cache_key, pack_records(page), validators)
+
+
+def revalidate_page(path, params, cache_key, page, validators, bucket=None,
+                    quota=None, token=None):
+    """
+    Bring a stale cached page of CheckinRecords up to date with one small
+    request, cache it and return it. Given an ETag or Last-Modified this
+    is a conditional GET. Otherwise the newest page (the one without a
+    max_id) only asks for check-ins newer than its newest one and puts
+    them in front. Anything else is fetched again in full.
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    delta = (not headers and 'max_id' not in params and
+             validators.get('newest') is not None)
+    url = untappd_api_url(path, dict(params, min_id=validators['newest'])
+                          if delta else params, token)
+
+    r = untappd_send(url, bucket, quota, headers=headers)
+    if r.status_code == 304:
+        result = 'not_modified'
+        current = page
+        validators = dict(validators)
     else:
-        credly_token_response = credly_api_request(
-            'post',
-            '/authenticate',
-            "",
-            None,
-            (settings.CREDLY_USERNAME,settings.CREDLY_PASSWORD)
-        )
-        credly_token = json.loads(credly_token_response.content)['data']['token']
-
-        # Remove existing badge recipients from emails_to_award
-        print 'Initial badge list: %s' % emails_to_award
-        existing_badges_response = credly_api_request(
-            'get',
-            '/me/badges/given',
-            {},
-            credly_token
-        )
-        existing_badges = json.loads(existing_badges_response.content)
-        for existing_badge in existing_badges['data']:
-            # First check if its an "orphan" (i.e., un-accepted) badge
-            if 'member_orphan' in existing_badge:
-                print 'Removing %s from badge list because they already have it.' % existing_badge['member_orphan']['email']
-                emails_to_award = [email for email in emails_to_award if email != existing_badge['member_orphan']['email']]
-            # Now check if its a "member" (i.e., accepted) badge
-            elif 'member' in existing_badge:
-                if 'email' in existing_badge['member']:
-                    print 'Removing %s from badge list because they already have it.' % existing_badge['member']['email']
-                    emails_to_award = [email for email in emails_to_award if email != existing_badge['member']['email']]
-
-        for email_to_award in emails_to_award:
-            award_badge(email_to_award, credly_token)
-
-
-def untappd_api_url(url, params=None):
-    """Append the Untappd client details, if available"""
+        items = untappd_json(r)['response']['checkins']['items']
+        current = [CheckinRecord.from_item(item) for item in items]
+        if delta:
+            result = 'delta'
+            current = (current + page)[:params['limit']]
+        else:
+            result = 'full'
+        validators = response_validators(r.headers)
+    if current:
+        validators['newest'] = current[0].checkin_id
+    get_cache().set(cache_key, pack_records(current), validators)
+    metrics.inc('untappd_revalidations_total', result=result)
+    return current
+
+
+def untappd_api_url(url, params=None, access_token=None):
+    """Append the user's access token if given, otherwise the Untappd
+    client details, if available"""
     url = '%s/%s' % (settings.UNTAPPD_BASE_URL, url)
-    if not params:
-        params = {}
-    if settings.UNTAPPD_CLIENT_ID and settings.UNTAPPD_CLIENT_SECRET:
+    params = dict(params or {})
+    if access_token:
+        params['access_token'] = access_token
+    elif settings.UNTAPPD_CLIENT_ID and settings.UNTAPPD_CLIENT_SECRET:
         params.update(dict(
             client_id = settings.UNTAPPD_CLIENT_ID,
             client_secret = settings.UNTAPPD_CLIENT_SECRET
@@ -136,107 +1037,187 @@ def untappd_api_url(url, params=None):
     return url
 
 
-def untappd_api_get(path, params=None, cache_name=False, cache_timeout=3600):
-    """Cached HTTP GET to the API"""
+def untappd_api_get(path, params=None, cache_name=False, cache_timeout=3600,
+                    bucket=None, quota=None):
+    """Cached HTTP GET to the API. Raises UntappdError for error
+    responses, which are never cached."""
     url = untappd_api_url(path, params)
 
     # If no cache name, then cache is disabled.
     if not cache_name:
-        return requests.get(url).json()
+        return untappd_request(url, bucket, quota)
 
-    # Build a cache path based on MD5 of URL
-    path_hash = hashlib.md5(url).hexdigest()
-    cache_path = settings.CACHE_PATH_TMPL % (cache_name, path_hash)
-
-    # Create the cache path, if necessary
-    cache_dir = dirname(cache_path)
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
+    # Build a cache key based on MD5 of URL
+    cache = get_cache()
+    cache_key = '%s:%s' % (cache_name, hashlib.md5(url).hexdigest())
 
     # Attempt to load up data from cache
     data = None
-    if os.path.exists(cache_path) and file_age(cache_path) < cache_timeout:
+    cached = cache.get(cache_key, cache_timeout)
+    if cached is not None:
         try:
-            data = json.load(open(cache_path, 'r'))
+            data = json.loads(cached)
         except ValueError:
             pass
 
-    # If data was missing or stale from cache, finally perform GET
-    if not data:
-        data = requests.get(url).json()
-        json.dump(data, open(cache_path, 'w'))
+    # If data was missing, stale or an error from cache, finally perform GET
+    if not data or 'response' not in data:
+        data = untappd_request(url, bucket, quota)
+        cache.set(cache_key, json.dumps(data))
 
     return data
 
 
-def credly_api_request(method, path, data, token=None, user_pw=None):
-    auth=None
-    params = {}
-    request_function = requests.get
+def untappd_request(url, bucket=None, quota=None):
+    """
+    GET an Untappd API URL once ``bucket`` and ``quota`` allow and return
+    the decoded body. Raises QuotaExhausted when the quota is used up and
+    UntappdError for other error responses.
+    """
+    return untappd_json(untappd_send(url, bucket, quota))
 
-    if method == "post":
-        request_function = requests.post
-    elif method == "get":
-        params = data
 
-    if user_pw:
-        auth = requests.auth.HTTPBasicAuth(*user_pw)
-    if token:
-        params.update({'access_token': token})
-    url = '%s%s?%s' % (settings.CREDLY_BASE_URL,
-                       path, urllib.urlencode(params))
-    print 'credly url: %s' % url
-
-    r = request_function(
-        url,
-        params=data,
-        headers={
-            'X-Api-Key': settings.CREDLY_API_KEY,
-            'X-Api-Secret': settings.CREDLY_API_SECRET
-        },
-        auth=auth
-        # verify=False, # To workaround SSL cert issue.
-    )
+def untappd_stream(url, keys, bucket=None, quota=None, validators=None):
+    """
+    Like untappd_request, but yield the elements of the array under
+    ``keys`` as they are read off the wire. Closing the generator early
+    drops the connection instead of reading the rest. A ``validators``
+    dict is updated with the response's, see response_validators.
+    """
+    r = untappd_send(url, bucket, quota, stream=True)
+    if r.status_code != 200:
+        untappd_json(r)
+    if validators is not None:
+        validators.update(response_validators(r.headers))
+    finished = False
+    try:
+        for item in iter_array(r.iter_content(8192), keys):
+            yield item
+        finished = True
+    except ValueError as e:
+        raise UntappdError(r.status_code, 'Unexpected response: %s' % e)
+    except requests.exceptions.RequestException as e:
+        # The connection broke mid-body
+        raise UntappdError(None, describe_error(e, url))
+    finally:
+        connection = getattr(r.raw, '_connection', None)
+        if not finished and connection is not None:
+            # The rest of the body is still on the wire
+            connection.close()
+        r.close()
+
+
+def untappd_send(url, bucket=None, quota=None, stream=False, headers=None):
+    """
+    Send a GET to the Untappd API once ``bucket`` and ``quota`` allow,
+    recording its latency, status and the remaining hourly quota.
+    """
+    if bucket:
+        bucket.consume()
+    if quota:
+        quota.acquire()
+    try:
+        with metrics.timer('untappd_request_seconds'):
+            r = get_session().get(url, stream=stream, headers=headers,
+                                  timeout=settings.UNTAPPD_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        metrics.inc('untappd_requests_total', status='error')
+        raise UntappdError(None, describe_error(e, url))
+    metrics.inc('untappd_requests_total', status=r.status_code)
+    remaining = r.headers.get('X-Ratelimit-Remaining')
+    if remaining is not None:
+        metrics.set_gauge('untappd_ratelimit_remaining', int(remaining))
+    if quota:
+        quota.update(r.headers)
+        if r.status_code == 429:
+            quota.exhaust()
+            raise QuotaExhausted(quota.reset_at)
     return r
 
 
-def award_badge(email, token):
-    """Award a badge with the specified slug to the specified emails."""
+def response_validators(headers):
+    """The ETag and Last-Modified of a response, if it has them."""
+    validators = {}
+    if headers.get('ETag'):
+        validators['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['last_modified'] = headers['Last-Modified']
+    return validators
 
-    print 'Awarding the badge to %s ...' % email
-    r = credly_api_request(
-        "post",
-        '/member_badges',
-        {
-            'email': email,
-            'first_name': None,
-            'last_name': None,
-            'badge_id': settings.CREDLY_BADGE_ID
-        },
-        token
-    )
 
-    if r.status_code != 200:
-        print 'Something went wrong awarding badge: '
-        print r.content
-        return
+def untappd_json(r):
+    """Decode an Untappd response, raising UntappdError for errors."""
+    try:
+        data = r.json()
+    except ValueError:
+        raise UntappdError(r.status_code, r.content[:200])
+    meta = data.get('meta') or {}
+    code = meta.get('code', r.status_code)
+    if code != 200 or 'response' not in data:
+        raise UntappdError(code, meta.get('error_detail') or
+                           meta.get('error_type'))
+    return data
 
-    response = json.loads(r.content)
 
-    if 'successes' in response:
-        successes = response['successes']
-        print 'Badge awarded to: %s' % [k for k in successes.keys()]
+def refresh_recipient_index(credly):
+    """Page through /me/badges/given into the local CredlyRecipient index."""
+    recipients = []
+    page = 1
+    seen = 0
+    while True:
+        given = credly.given_badges(page)
+        seen += len(given['data'])
+        for existing_badge in given['data']:
+            badge_id = (existing_badge.get('badge') or {}).get('id')
+            # First check if its an "orphan" (i.e., un-accepted) badge,
+            # then if its a "member" (i.e., accepted) badge
+            for member_key in ('member_orphan', 'member'):
+                member = existing_badge.get(member_key) or {}
+                if member.get('email'):
+                    recipients.append((member['email'], badge_id))
 
-    if 'errors' in response:
-        errors = response['errors']
-        already_awarded = [x for x in errors.keys()
-                           if errors[x] == 'ALREADYAWARDED']
-        print 'Badge had already been awarded to: %s' % (
-            [k for k in already_awarded])
-        print 'Error awarding badge to: %s' % (
-            [k for k in errors if k not in already_awarded])
+        # Count what came back rather than what was asked for, in case
+        # Credly caps per_page
+        total = (given.get('paging') or {}).get('total_results')
+        if not given['data'] or (total is not None and seen >= total):
+            break
+        page += 1
+
+    print 'Indexed %s existing badge recipients' % len(recipients)
+    CredlyRecipient.objects.replace(recipients)
+
+
+def award_badges(credly, emails, badge_id, users=None):
+    """
+    Award the badge to the specified emails, in batches, recording the
+    successes and ALREADYAWARDED errors in the award ledger. ``users``
+    maps normalized emails to user ids. Returns the emails recorded.
+    """
+    recorded = []
+    if not emails:
+        return recorded
+    print 'Awarding badge %s to %s ...' % (badge_id, emails)
+    for batch, response in credly.award_all(emails, badge_id):
+        if response is None:
+            print 'Error awarding badge to: %s' % batch
+            continue
 
+        if 'successes' in response:
+            successes = response['successes']
+            print 'Badge awarded to: %s' % [k for k in successes.keys()]
+            Award.objects.record(badge_id, successes.keys(), Award.AWARDED,
+                                 successes, users)
+            recorded.extend(successes.keys())
 
-def file_age(fn):
-    """Get the age of a file in seconds"""
-    return time.time() - os.stat(fn).st_mtime
+        if 'errors' in response:
+            errors = response['errors']
+            already_awarded = [x for x in errors.keys()
+                               if errors[x] == 'ALREADYAWARDED']
+            print 'Badge had already been awarded to: %s' % (
+                [k for k in already_awarded])
+            print 'Error awarding badge to: %s' % (
+                [k for k in errors if k not in already_awarded])
+            Award.objects.record(badge_id, already_awarded,
+                                 Award.ALREADY_AWARDED, errors, users)
+            recorded.extend(already_awarded)
+    return recorded
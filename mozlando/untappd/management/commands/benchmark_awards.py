@@ -0,0 +1,232 @@
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from allauth.account.models import EmailAddress
+from allauth.socialaccount.models import (SocialAccount, SocialApp,
+                                          SocialToken)
+
+from mozlando.untappd.cache import get_cache
+from mozlando.untappd.eligibility import epoch
+from mozlando.untappd.fakes import (FakeCredlyServer, FakeUntappdServer,
+                                    generate_checkins)
+from mozlando.untappd.models import Award, CredlyRecipient, Event
+from mozlando.untappd.views import UntappdOAuth2Adapter, UntappdOAuth2Client
+
+
+class Command(BaseCommand):
+    help = ('Run award_badges against local fake Untappd and Credly '
+            'servers with synthetic users, in a throwaway test database, '
+            'and report how long it took.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--checkins', type=int, default=200,
+                            help='Check-ins per user.')
+        parser.add_argument('--in-event', type=float, default=0.3,
+                            help='Fraction of check-ins at the event.')
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help='Seconds the fake servers take per request.')
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help='Fraction of requests answered with a 500.')
+        parser.add_argument('--rate-limit', type=int, default=0,
+                            help='Untappd requests allowed per hour '
+                                 '(0 for no limit).')
+        parser.add_argument('--etags', action='store_true',
+                            help='Have the fake Untappd send ETags and '
+                                 'answer conditional requests.')
+        parser.add_argument('--tokens', type=float, default=0,
+                            help='Fraction of users with a stored access '
+                                 'token.')
+        parser.add_argument('--feed', action='store_true',
+                            help='Read check-ins from the friend feed of '
+                                 'a user who is friends with everyone.')
+        parser.add_argument('--runs', type=int, default=2,
+                            help='Number of award runs; runs after the '
+                                 'first measure the warm cache.')
+        parser.add_argument('--logins', type=int, default=20,
+                            help='Number of OAuth logins to time.')
+        parser.add_argument('--concurrency', type=int)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes award_badges fetches in.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Client-side Untappd requests per second '
+                                 '(0 for no limit).')
+        parser.add_argument('--profile', action='store_true',
+                            help='Print award_badges\' per-phase profile '
+                                 '(needs -v 2).')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        old_name = connection.settings_dict['NAME']
+        cache_dir = tempfile.mkdtemp()
+        if (options['workers'] > 1 and
+                connection.vendor == 'sqlite'):
+            # Worker processes can't see an in-memory database
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                cache_dir, 'test.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        servers = []
+        try:
+            event = Event.objects.active().first()
+            started = time.time()
+            checkins = generate_checkins(
+                options['users'], options['checkins'], event,
+                options['in_event'], seed=options['seed'])
+            self.create_users(checkins, options['tokens'], options['feed'])
+            print 'Generated %s users with %s checkins each in %.2fs' % (
+                options['users'], options['checkins'], time.time() - started)
+
+            server_options = dict(latency=options['latency'],
+                                  error_rate=options['error_rate'],
+                                  seed=options['seed'])
+            # benchuser0 follows everyone else's check-ins
+            friends = {'benchuser0': sorted(checkins)[1:]}
+            untappd = FakeUntappdServer(
+                checkins, friends, rate_limit=options['rate_limit'],
+                etags=options['etags'], **server_options).start()
+            credly = FakeCredlyServer(**server_options).start()
+            servers = [untappd, credly]
+
+            with override_settings(
+                    UNTAPPD_BASE_URL=untappd.url + '/v4',
+                    UNTAPPD_CLIENT_ID='benchmark',
+                    UNTAPPD_CLIENT_SECRET='benchmark',
+                    UNTAPPD_CACHE={
+                        'BACKEND': 'mozlando.untappd.cache.SQLiteCache',
+                        'OPTIONS': {'path': os.path.join(cache_dir,
+                                                         'untappd.sqlite3')},
+                    },
+                    CREDLY_BASE_URL=credly.url + '/v1.1',
+                    CREDLY_API_KEY='benchmark',
+                    CREDLY_API_SECRET='benchmark',
+                    CREDLY_USERNAME='benchmark',
+                    CREDLY_PASSWORD='benchmark',
+                    CREDLY_BACKOFF=0.01,
+                    # The synthetic check-ins date from the event; count
+                    # their users as active, or warm runs skip them all
+                    UNTAPPD_INACTIVE_AFTER=int(
+                        time.time() - epoch(event.start)) + 24 * 60 * 60,
+                    UNTAPPD_FEED_USERNAMES=(['benchuser0'] if options['feed']
+                                            else [])):
+                for run in range(1, options['runs'] + 1):
+                    self.award_run(run, untappd, credly, options)
+                if options['logins']:
+                    self.login_run(untappd, options['logins'])
+        finally:
+            for server in servers:
+                server.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def create_users(self, checkins, tokens=0, feed=False):
+        User.objects.bulk_create(User(username=username)
+                                 for username in checkins)
+        users = User.objects.filter(username__in=list(checkins))
+        SocialAccount.objects.bulk_create(
+            SocialAccount(user=user, provider='untappd', uid=str(user.id),
+                          extra_data={'user_name': user.username})
+            for user in users)
+        EmailAddress.objects.bulk_create(
+            EmailAddress(user=user, email='%s@example.com' % user.username,
+                         verified=True, primary=True)
+            for user in users)
+
+        # Tokens as the fake Untappd hands them out at sign-in; the feed
+        # reader always has one
+        app = SocialApp.objects.create(provider='untappd', name='Untappd',
+                                       client_id='benchmark',
+                                       secret='benchmark')
+        accounts = SocialAccount.objects.select_related('user').order_by('id')
+        num_tokens = int(round(tokens * len(checkins)))
+        SocialToken.objects.bulk_create(
+            SocialToken(app=app, account=account,
+                        token='token-%s' % account.user.username)
+            for n, account in enumerate(accounts)
+            if n < num_tokens or (feed and
+                                  account.user.username == 'benchuser0'))
+
+    def award_run(self, run, untappd, credly, options):
+        if run > 1:
+            # Forget the last run's badges so this one fetches the same
+            # users again, rather than skipping those who earned them
+            Award.objects.all().delete()
+            CredlyRecipient.objects.all().delete()
+            credly.awards.clear()
+        for server in (untappd, credly):
+            server.reset_counters()
+        cache = get_cache()
+        cache.hits = cache.misses = 0
+        awarded = sum(len(emails) for emails in credly.awards.values())
+        command_options = dict(rate=options['rate'],
+                               workers=options['workers'],
+                               profile=options['profile'])
+        if options['concurrency']:
+            command_options['concurrency'] = options['concurrency']
+
+        started, cpu_started = time.time(), time.clock()
+        stdout = sys.stdout
+        if self.verbosity < 2:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            call_command('award_badges', **command_options)
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+                sys.stdout = stdout
+        elapsed = time.time() - started
+        cpu = time.clock() - cpu_started
+
+        stats = cache.stats()
+        requests = untappd.requests + credly.requests
+        print 'Run %s: %.2fs wall, %.2fs CPU' % (run, elapsed, cpu)
+        print '  Untappd: %s requests (%s errors, %.1f KB), Credly: %s ' \
+              'requests (%s errors), %.1f requests/s' % (
+                  untappd.requests, untappd.errors,
+                  untappd.bytes_sent / 1024.0, credly.requests,
+                  credly.errors, requests / elapsed)
+        print '  Cache: %s hits, %s misses, %.0f%% hit ratio' % (
+            stats['hits'], stats['misses'], stats['hit_ratio'] * 100)
+        print '  Badges awarded: %s, peak RSS: %.1f MB' % (
+            sum(len(emails) for emails in credly.awards.values()) - awarded,
+            peak_rss())
+        if run > 1 and not stats['hits'] + stats['misses']:
+            raise CommandError('Run %s made no Untappd cache lookups, so '
+                               'it measured nothing warm.' % run)
+
+    def login_run(self, untappd, logins):
+        """Time the OAuth token exchange and user info lookup that happen
+        when someone signs in."""
+        request = RequestFactory().get('/')
+        adapter = UntappdOAuth2Adapter()
+        adapter.user_info_url = untappd.url + '/v4/user/info/'
+        client = UntappdOAuth2Client(
+            request, 'benchmark', 'benchmark', adapter.access_token_method,
+            untappd.url + '/oauth/authorize/', 'http://testserver/', [])
+
+        untappd.reset_counters()
+        started = time.time()
+        for n in range(logins):
+            access_token = client.get_access_token('code%s' % n)
+            token = SocialToken(token=access_token['access_token'])
+            adapter.complete_login(request, None, token)
+        elapsed = time.time() - started
+        print 'Logins: %s in %.2fs, %.1f ms each' % (
+            logins, elapsed, elapsed * 1000 / logins)
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB (Linux reports KB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
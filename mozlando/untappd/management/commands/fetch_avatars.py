@@ -0,0 +1,40 @@
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mozlando.untappd import avatars
+from mozlando.untappd.models import AvatarThumbnail
+from mozlando.untappd.participants import get_accounts
+
+
+class Command(BaseCommand):
+    help = ('Make thumbnails of participants\' Untappd avatars that have '
+            'none yet, so the participant list doesn\'t wait on them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int,
+                            default=settings.UNTAPPD_FETCH_CONCURRENCY,
+                            help='Number of avatars to fetch at once.')
+
+    def handle(self, *args, **options):
+        digests = dict(AvatarThumbnail.objects.values_list('account_id',
+                                                           'digest'))
+        missing = [account for account in get_accounts()
+                   if avatars.source_url(account) and
+                   digests.get(account.id) != avatars.source_digest(
+                       avatars.source_url(account))]
+        if not missing:
+            print 'Every avatar has a thumbnail.'
+            return
+
+        print 'Making %s avatar thumbnails ...' % len(missing)
+        pool = ThreadPool(max(options['concurrency'], 1))
+        try:
+            made = sum(1 for image in pool.imap_unordered(
+                avatars.create_thumbnail, missing) if image is not None)
+        finally:
+            pool.close()
+            pool.join()
+        print 'Made %s; %s could not be fetched.' % (made,
+                                                     len(missing) - made)
@@ -0,0 +1,44 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mozlando.untappd.eligibility import CheckinColumns, event_beer_counts
+from mozlando.untappd.models import Checkin, Event
+
+
+class Command(BaseCommand):
+    help = ('Re-score stored check-ins against an event\'s badge rule, '
+            'optionally trying alternative thresholds.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event',
+                            help='Slug of the event to score. Defaults to '
+                                 'the latest active event.')
+        parser.add_argument('--num-beers', type=int, action='append',
+                            dest='thresholds',
+                            help='Threshold to report; may be repeated. '
+                                 'Defaults to the event\'s.')
+
+    def handle(self, *args, **options):
+        events = Event.objects.all()
+        if options['event']:
+            events = events.filter(slug=options['event'])
+        else:
+            events = events.active()
+        event = events.first()
+        if event is None:
+            raise CommandError('No such event.')
+        thresholds = options['thresholds'] or [event.num_beers]
+
+        started = time.time()
+        columns = CheckinColumns.from_queryset(Checkin.objects.all())
+        loaded = time.time()
+        users, counts = event_beer_counts(columns, event.num_areas,
+                                          **event.event_filter())
+        scored = time.time()
+
+        print 'Loaded %s checkins in %.3fs, scored %s in %.3fs' % (
+            len(columns), loaded - started, event, scored - loaded)
+        for threshold in thresholds:
+            print '%s users with at least %s matching beers' % (
+                (counts >= threshold).sum(), threshold)
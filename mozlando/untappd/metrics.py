@@ -0,0 +1,277 @@
+"""
+In-process metrics for the hot paths: counters, gauges and latency
+histograms, kept per (name, labels) and rendered in the Prometheus text
+format by the /metrics view, or as a short summary by award_badges.
+
+    with metrics.timer('untappd_request_seconds'):
+        ...
+    metrics.inc('untappd_requests_total', status=200)
+    metrics.set_gauge('untappd_ratelimit_remaining', 42)
+
+Metrics live in the process that records them. Worker processes hand
+theirs back with ``snapshot`` for the parent to ``merge``. For /metrics
+to show every process, each web worker and award_badges ``publish``
+theirs to the shared Django cache, and ``render_all`` renders them
+together, labelled with the process they came from.
+"""
+import bisect
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import connection
+
+# Upper bounds in seconds; the last bucket is +Inf
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # (name, sorted label items) -> value or Histogram
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def seconds(self, name):
+        """Total observed under ``name``, across all labels."""
+        with self.lock:
+            return sum(histogram.sum for (key_name, labels), histogram
+                       in self.histograms.items() if key_name == name)
+
+    def snapshot(self):
+        """A picklable copy of every metric, for merge."""
+        with self.lock:
+            return (dict(self.counters), dict(self.gauges),
+                    dict(self.histograms))
+
+    def merge(self, snapshot, **labels):
+        """Add another registry's snapshot to this one's metrics, with
+        ``labels`` added to each."""
+        counters, gauges, histograms = snapshot
+        if labels:
+            extra = tuple(labels.items())
+            counters, gauges, histograms = [
+                dict(((name, tuple(sorted(key_labels + extra))), value)
+                     for (name, key_labels), value in values.items())
+                for values in (counters, gauges, histograms)]
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            for key, histogram in histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(histogram.buckets)
+                self.histograms[key].merge(histogram)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the seconds spent in the block, even if it raises."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters),
+                                 ('gauge', self.gauges)):
+                for name in sorted(set(key[0] for key in values)):
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    for (key_name, labels), value in sorted(values.items()):
+                        if key_name == name:
+                            lines.append('%s%s %s' % (
+                                name, format_labels(labels), value))
+
+            for name in sorted(set(key[0] for key in self.histograms)):
+                lines.append('# TYPE %s histogram' % name)
+                for (key_name, labels), histogram in sorted(
+                        self.histograms.items()):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    bounds = [repr(float(b)) for b in histogram.buckets]
+                    for bound, count in zip(bounds + ['+Inf'],
+                                            histogram.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %s' % (
+                            name, format_labels(labels + (('le', bound),)),
+                            cumulative))
+                    lines.append('%s_sum%s %r' % (
+                        name, format_labels(labels), histogram.sum))
+                    lines.append('%s_count%s %s' % (
+                        name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Human-readable lines, one per metric, for end-of-run output."""
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('%s%s: %s' % (name, format_labels(labels),
+                                           value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append('%s%s: %s' % (name, format_labels(labels),
+                                           value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                lines.append(
+                    '%s%s: %s calls, %.3fs total, %.3fs mean, '
+                    'p50 <= %ss, p95 <= %ss' % (
+                        name, format_labels(labels), histogram.count,
+                        histogram.sum, histogram.sum / histogram.count,
+                        histogram.quantile(0.5), histogram.quantile(0.95)))
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                     .replace('"', '\\"'))
+        for name, value in labels)
+
+
+def process_name(role):
+    """A name for this process among others publishing, e.g.
+    web:host:1234."""
+    return '%s:%s:%s' % (role, socket.gethostname(), os.getpid())
+
+
+PROCESSES_KEY = 'metrics:processes'
+# The process publishing from this one, whose live metrics render_all uses
+current_process = None
+
+
+def publish(process, timeout=DEFAULT_TIMEOUT):
+    """
+    Share this process's metrics in the Django cache under the name
+    ``process``, until ``timeout`` seconds (default METRICS_PUBLISH_TTL;
+    None to keep them) go by without another publish.
+    """
+    if timeout is DEFAULT_TIMEOUT:
+        timeout = settings.METRICS_PUBLISH_TTL
+    key = 'metrics:process:%s' % process
+    cache.set(key, snapshot(), timeout)
+    # Not atomic: a process registering at the same moment may be lost,
+    # and registers again on its next publish
+    processes = cache.get(PROCESSES_KEY) or []
+    if key not in processes:
+        cache.set(PROCESSES_KEY, processes + [key], None)
+
+
+def render_all():
+    """
+    The metrics every process has published, labelled with ``process``,
+    in the Prometheus text format. This process's are current rather
+    than as last published.
+    """
+    keys = cache.get(PROCESSES_KEY) or []
+    found = cache.get_many(keys)
+    if len(found) < len(keys):
+        # Forget processes that stopped publishing
+        cache.set(PROCESSES_KEY, [key for key in keys if key in found], None)
+    if current_process:
+        found['metrics:process:%s' % current_process] = snapshot()
+    combined = Registry()
+    for key, data in found.items():
+        combined.merge(data, process=key[len('metrics:process:'):])
+    return combined.render()
+
+
+def start_publisher(process, interval=None):
+    """Publish as ``process`` every METRICS_PUBLISH_INTERVAL seconds on
+    a background thread, for the life of the process."""
+    global current_process
+    current_process = process
+    interval = interval or settings.METRICS_PUBLISH_INTERVAL
+
+    def run():
+        while True:
+            try:
+                publish(process)
+            except Exception as e:
+                # The cache may be down for a moment; the next one counts
+                print 'Could not publish metrics: %s' % e
+            finally:
+                # The thread's own, which it would otherwise hold open
+                connection.close()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='metrics-publisher')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+registry = Registry()
+inc = registry.inc
+set_gauge = registry.set_gauge
+observe = registry.observe
+timer = registry.timer
+render = registry.render
+summary = registry.summary
+reset = registry.reset
+seconds = registry.seconds
+snapshot = registry.snapshot
+merge = registry.merge
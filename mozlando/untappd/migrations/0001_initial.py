@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialaccount', '0002_token_max_lengths'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckinSync',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('last_checkin_id', models.BigIntegerField(null=True, blank=True)),
+                ('event_checkins', models.TextField(default=b'[]')),
+                ('modified', models.DateTimeField(auto_now=True)),
+                ('account', models.OneToOneField(related_name='checkin_sync', to='socialaccount.SocialAccount')),
+            ],
+        ),
+    ]
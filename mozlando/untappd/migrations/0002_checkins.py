@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+def reset_watermarks(apps, schema_editor):
+    # Check-ins kept on the sync state are dropped below, so refetch each
+    # account's full history into the new Checkin table.
+    CheckinSync = apps.get_model('untappd', 'CheckinSync')
+    CheckinSync.objects.update(last_checkin_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('untappd', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Beer',
+            fields=[
+                ('bid', models.BigIntegerField(serialize=False, primary_key=True)),
+                ('name', models.CharField(max_length=255, blank=True)),
+                ('brewery', models.CharField(max_length=255, blank=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Checkin',
+            fields=[
+                ('checkin_id', models.BigIntegerField(serialize=False, primary_key=True)),
+                ('created_at', models.DateTimeField()),
+                ('beer', models.ForeignKey(related_name='checkins', to='untappd.Beer')),
+                ('user', models.ForeignKey(related_name='untappd_checkins', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Venue',
+            fields=[
+                ('venue_id', models.BigIntegerField(serialize=False, primary_key=True)),
+                ('name', models.CharField(max_length=255, blank=True)),
+                ('lat', models.FloatField(null=True, blank=True)),
+                ('lng', models.FloatField(null=True, blank=True)),
+            ],
+        ),
+        migrations.RunPython(reset_watermarks, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='checkinsync',
+            name='event_checkins',
+        ),
+        migrations.AlterIndexTogether(
+            name='venue',
+            index_together=set([('lat', 'lng')]),
+        ),
+        migrations.AddField(
+            model_name='checkin',
+            name='venue',
+            field=models.ForeignKey(related_name='checkins', blank=True, to='untappd.Venue', null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='checkin',
+            index_together=set([('user', 'created_at')]),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('untappd', '0002_checkins'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CredlyRecipient',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('email', models.EmailField(max_length=254)),
+                ('badge_id', models.IntegerField(null=True, blank=True)),
+                ('refreshed', models.DateTimeField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='credlyrecipient',
+            unique_together=set([('email', 'badge_id')]),
+        ),
+    ]
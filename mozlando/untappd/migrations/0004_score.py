@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('untappd', '0003_credlyrecipient'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Score',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('num_beers', models.PositiveIntegerField(default=0, db_index=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(related_name='untappd_score', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('untappd', '0004_score'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='venue',
+            name='area',
+            field=models.CharField(db_index=True, max_length=100, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def utc(*args):
+    return datetime(*args).replace(tzinfo=timezone.utc)
+
+
+# The events that used to be swapped in and out of settings.py
+EVENTS = [
+    dict(slug='mozlando-2015', name='Mozlando: Beers & Ears', active=True,
+         start=utc(2015, 12, 7),
+         end=utc(2015, 12, 11, 23, 59, 59, 999999),
+         min_latitude=28.367444, max_latitude=28.375647,
+         min_longitude=-81.553245, max_longitude=-81.545134,
+         num_beers=12, credly_badge_id=61615),
+    dict(slug='tulsa-cherry-street-2015', name='Cherry Street, Tulsa (test)',
+         active=False,
+         start=utc(2015, 11, 23),
+         end=utc(2015, 11, 27, 23, 59, 59, 999999),
+         min_latitude=36.136844, max_latitude=36.143845,
+         min_longitude=-95.97546, max_longitude=-95.940098,
+         num_beers=2, credly_badge_id=61628),
+    dict(slug='portland-2015', name='Portland (test)', active=False,
+         start=utc(2015, 11, 3),
+         end=utc(2015, 11, 6, 23, 59, 59, 999999),
+         min_latitude=45.521143, max_latitude=45.526412,
+         min_longitude=-122.684202, max_longitude=-122.671810,
+         num_beers=2, credly_badge_id=61628),
+]
+
+
+def add_events(apps, schema_editor):
+    Event = apps.get_model('untappd', 'Event')
+    for event in EVENTS:
+        Event.objects.create(**event)
+
+
+def clear_scores(apps, schema_editor):
+    # Scores are derived, and award_badges recomputes them per event
+    Score = apps.get_model('untappd', 'Score')
+    Score.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('untappd', '0005_venue_area'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('slug', models.SlugField(unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('active', models.BooleanField(default=True)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('min_latitude', models.FloatField()),
+                ('max_latitude', models.FloatField()),
+                ('min_longitude', models.FloatField()),
+                ('max_longitude', models.FloatField()),
+                ('use_geofence', models.BooleanField(default=False)),
+                ('num_beers', models.PositiveIntegerField()),
+                ('num_areas', models.PositiveIntegerField(default=0)),
+                ('credly_badge_id', models.IntegerField()),
+            ],
+            options={
+                'ordering': ['-start'],
+            },
+        ),
+        migrations.RunPython(add_events, migrations.RunPython.noop),
+        migrations.RunPython(clear_scores, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='score',
+            name='user',
+            field=models.ForeignKey(related_name='untappd_scores', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='score',
+            name='event',
+            field=models.ForeignKey(related_name='scores', default=1, to='untappd.Event'),
+            preserve_default=False,
+        ),
+        migrations.AlterUniqueTogether(
+            name='score',
+            unique_together=set([('user', 'event')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('untappd', '0006_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkinsync',
+            name='last_active',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
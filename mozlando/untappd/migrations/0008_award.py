@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('untappd', '0007_checkinsync_last_active'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Award',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('email', models.EmailField(max_length=254)),
+                ('badge_id', models.IntegerField()),
+                ('status', models.CharField(max_length=20, choices=[(b'awarded', b'Awarded'), (b'already_awarded', b'Already awarded')])),
+                ('response', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(related_name='untappd_awards', on_delete=django.db.models.deletion.SET_NULL, blank=True, to=settings.AUTH_USER_MODEL, null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='award',
+            unique_together=set([('email', 'badge_id')]),
+        ),
+    ]
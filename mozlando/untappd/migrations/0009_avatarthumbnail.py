@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('socialaccount', '0002_token_max_lengths'),
+        ('untappd', '0008_award'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AvatarThumbnail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('source', models.URLField(max_length=500)),
+                ('digest', models.CharField(max_length=12)),
+                ('image', models.BinaryField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('account', models.OneToOneField(related_name='avatar_thumbnail', to='socialaccount.SocialAccount')),
+            ],
+        ),
+    ]
@@ -1,3 +1,489 @@
-from django.db import models
+import json
 
-# Create your models here.
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, When
+from django.utils import timezone
+
+from allauth.socialaccount.models import SocialAccount
+
+from .geofence import get_geofence
+
+
+def aware(value):
+    if timezone.is_naive(value):
+        return timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def chunked(items, size=500):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def insert_missing(model, objs):
+    """
+    Bulk insert the objects in ``objs`` (a dict keyed by primary key)
+    whose keys are not already stored. Untappd ids are stable, so
+    existing rows are left alone.
+    """
+    for attempt in range(3):
+        existing = set()
+        for keys in chunked(objs):
+            existing.update(model.objects.filter(pk__in=keys)
+                                         .values_list('pk', flat=True))
+        missing = [obj for pk, obj in objs.items() if pk not in existing]
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create(missing, batch_size=500)
+            return missing
+        except IntegrityError:
+            # Another award_badges worker stored some of them first
+            if attempt == 2:
+                raise
+
+
+class CheckinSync(models.Model):
+    """
+    Per-account Untappd sync state, so award runs only fetch check-ins
+    newer than the last one seen.
+    """
+    account = models.OneToOneField(SocialAccount, related_name='checkin_sync')
+    last_checkin_id = models.BigIntegerField(null=True, blank=True)
+    # When the newest check-in seen was made
+    last_active = models.DateTimeField(null=True, blank=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s @ %s' % (self.account, self.last_checkin_id)
+
+    def advance(self, records):
+        """Move the watermark past the given CheckinRecords."""
+        for record in records:
+            if (self.last_checkin_id is None or
+                record.checkin_id > self.last_checkin_id):
+                self.last_checkin_id = record.checkin_id
+                self.last_active = record.created_at
+
+
+class Beer(models.Model):
+    bid = models.BigIntegerField(primary_key=True)
+    name = models.CharField(max_length=255, blank=True)
+    brewery = models.CharField(max_length=255, blank=True)
+
+    def __unicode__(self):
+        return self.name
+
+
+class VenueManager(models.Manager):
+
+    def locate(self):
+        """
+        Record which geofence area each venue not yet located is in: the
+        area name, or '' if it is outside all of them. Does nothing when
+        no GEOFENCE_PATH is configured.
+        """
+        geofence = get_geofence()
+        if geofence is None:
+            return
+        venues = list(self.filter(area__isnull=True)
+                          .values_list('venue_id', 'lat', 'lng'))
+        if not venues:
+            return
+        venue_ids, lats, lngs = zip(*venues)
+        found = geofence.locate_many(
+            [float('nan') if lat is None else lat for lat in lats],
+            [float('nan') if lng is None else lng for lng in lngs])
+
+        by_area = {}
+        for venue_id, index in zip(venue_ids, found):
+            area = geofence.names[index] if index >= 0 else ''
+            by_area.setdefault(area, []).append(venue_id)
+        for area, area_venue_ids in by_area.items():
+            for keys in chunked(area_venue_ids):
+                self.filter(pk__in=keys).update(area=area)
+
+
+class Venue(models.Model):
+    venue_id = models.BigIntegerField(primary_key=True)
+    name = models.CharField(max_length=255, blank=True)
+    lat = models.FloatField(null=True, blank=True)
+    lng = models.FloatField(null=True, blank=True)
+    # Geofence area (e.g. pavilion) the venue is in; '' if none, and null
+    # until located.
+    area = models.CharField(max_length=100, null=True, blank=True,
+                            db_index=True)
+
+    objects = VenueManager()
+
+    class Meta:
+        index_together = [('lat', 'lng')]
+
+    def __unicode__(self):
+        return self.name
+
+
+class CheckinQuerySet(models.QuerySet):
+
+    def in_event(self, start=None, end=None, bounds=None, in_areas=None):
+        """
+        Check-ins inside the event window and area, which default to the
+        START_DATETIME and END_DATETIME settings and the GEOFENCE_PATH
+        areas, falling back to the MIN/MAX_LATITUDE/LONGITUDE box.
+        ``bounds`` is (min_lat, max_lat, min_lng, max_lng); with
+        ``in_areas`` check-ins must also be inside a geofence area.
+        """
+        start = aware(start or settings.START_DATETIME)
+        end = aware(end or settings.END_DATETIME)
+        if bounds is None and in_areas is None:
+            in_areas = get_geofence() is not None
+            if not in_areas:
+                bounds = (settings.MIN_LATITUDE, settings.MAX_LATITUDE,
+                          settings.MIN_LONGITUDE, settings.MAX_LONGITUDE)
+
+        checkins = self.filter(created_at__gt=start, created_at__lt=end)
+        if bounds is not None:
+            min_lat, max_lat, min_lng, max_lng = bounds
+            checkins = checkins.filter(venue__lat__gte=min_lat,
+                                       venue__lat__lte=max_lat,
+                                       venue__lng__gte=min_lng,
+                                       venue__lng__lte=max_lng)
+        if in_areas:
+            checkins = checkins.filter(venue__area__gt='')
+        return checkins
+
+    def beer_counts(self):
+        """Distinct beers per user, as (user_id, num_beers) rows."""
+        return (self.order_by()
+                    .values('user')
+                    .annotate(num_beers=Count('beer', distinct=True))
+                    .values_list('user', 'num_beers'))
+
+    def eligible(self, num_beers=None, num_areas=None, **event):
+        """
+        (user_id, num_beers) for users who earned the badge: at least
+        ``num_beers`` distinct beers, from at least ``num_areas`` distinct
+        geofence areas (NUM_AREAS by default; 0 to ignore areas).
+        """
+        num_beers = num_beers or settings.NUM_BEERS
+        if num_areas is None:
+            num_areas = settings.NUM_AREAS
+        counts = (self.in_event(**event).order_by()
+                      .values('user')
+                      .annotate(num_beers=Count('beer', distinct=True)))
+        if num_areas:
+            # Venues outside every area ('') don't count towards one
+            areas = Count(Case(When(venue__area__gt='', then='venue__area')),
+                          distinct=True)
+            counts = (counts.annotate(num_areas=areas)
+                            .filter(num_areas__gte=num_areas))
+        return (counts.filter(num_beers__gte=num_beers)
+                      .values_list('user', 'num_beers'))
+
+
+class CheckinManager(models.Manager.from_queryset(CheckinQuerySet)):
+
+    def ingest(self, user, records):
+        """
+        Store CheckinRecords for ``user``, bulk inserting any beers, venues
+        and check-ins not seen before.
+        """
+        beers, venues, checkins = {}, {}, {}
+        for record in records:
+            if record.bid is None:
+                continue
+            beers[record.bid] = Beer(bid=record.bid,
+                                     name=record.beer_name[:255],
+                                     brewery=record.brewery_name[:255])
+            if record.venue_id is not None:
+                venues[record.venue_id] = Venue(
+                    venue_id=record.venue_id,
+                    name=record.venue_name[:255],
+                    lat=record.lat,
+                    lng=record.lng)
+
+            checkins[record.checkin_id] = Checkin(
+                checkin_id=record.checkin_id,
+                user=user,
+                beer_id=record.bid,
+                venue_id=record.venue_id,
+                created_at=record.created_at)
+
+        insert_missing(Beer, beers)
+        insert_missing(Venue, venues)
+        Venue.objects.locate()
+        return insert_missing(Checkin, checkins)
+
+
+class Checkin(models.Model):
+    checkin_id = models.BigIntegerField(primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             related_name='untappd_checkins')
+    beer = models.ForeignKey(Beer, related_name='checkins')
+    venue = models.ForeignKey(Venue, null=True, blank=True,
+                              related_name='checkins')
+    created_at = models.DateTimeField()
+
+    objects = CheckinManager()
+
+    class Meta:
+        index_together = [('user', 'created_at')]
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.user, self.beer)
+
+
+class EventQuerySet(models.QuerySet):
+
+    def active(self):
+        return self.filter(active=True)
+
+
+class Event(models.Model):
+    """
+    A badge rule: unique beers checked in at the event's venues during
+    its dates earn its Credly badge. award_badges evaluates every active
+    event against the same fetched check-ins.
+    """
+    slug = models.SlugField(unique=True)
+    name = models.CharField(max_length=255)
+    active = models.BooleanField(default=True)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    min_latitude = models.FloatField()
+    max_latitude = models.FloatField()
+    min_longitude = models.FloatField()
+    max_longitude = models.FloatField()
+    # Also require check-ins to be inside a GEOFENCE_PATH area
+    use_geofence = models.BooleanField(default=False)
+    num_beers = models.PositiveIntegerField()
+    # Distinct geofence areas the beers must come from; 0 to ignore
+    num_areas = models.PositiveIntegerField(default=0)
+    credly_badge_id = models.IntegerField()
+
+    objects = EventQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['-start']
+
+    def __unicode__(self):
+        return self.name
+
+    @property
+    def bounds(self):
+        return (self.min_latitude, self.max_latitude,
+                self.min_longitude, self.max_longitude)
+
+    def event_filter(self):
+        """Keyword arguments for CheckinQuerySet.in_event and the
+        eligibility engine's event_mask."""
+        return dict(start=self.start, end=self.end, bounds=self.bounds,
+                    in_areas=self.use_geofence)
+
+    def checkins(self, checkins=None):
+        """The given check-ins (default: all) that count for this event."""
+        if checkins is None:
+            checkins = Checkin.objects.all()
+        return checkins.in_event(**self.event_filter())
+
+    def eligible(self, checkins=None):
+        """(user_id, num_beers) for users who earned this event's badge."""
+        if checkins is None:
+            checkins = Checkin.objects.all()
+        return checkins.eligible(num_beers=self.num_beers,
+                                 num_areas=self.num_areas,
+                                 **self.event_filter())
+
+
+class ScoreManager(models.Manager):
+
+    def refresh(self, user_ids, events=None):
+        """Recompute the given users' stored scores for the given events
+        (default: all active events)."""
+        user_ids = list(user_ids)
+        if events is None:
+            events = Event.objects.active()
+        for event in events:
+            counts = dict(event.checkins(
+                Checkin.objects.filter(user__in=user_ids)).beer_counts())
+            for user_id in user_ids:
+                self.update_or_create(
+                    user_id=user_id, event=event,
+                    defaults={'num_beers': counts.get(user_id, 0)})
+
+    def leaderboard(self, event):
+        return (self.filter(event=event)
+                    .select_related('user')
+                    .only('num_beers', 'updated', 'user__username')
+                    .order_by('-num_beers', 'user__username'))
+
+
+class Score(models.Model):
+    """
+    Precomputed count of a user's unique beers at an event, refreshed
+    as check-ins are ingested so the leaderboard never has to count.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             related_name='untappd_scores')
+    event = models.ForeignKey(Event, related_name='scores')
+    num_beers = models.PositiveIntegerField(default=0, db_index=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = ScoreManager()
+
+    class Meta:
+        unique_together = [('user', 'event')]
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.user, self.num_beers)
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+class CredlyRecipientManager(models.Manager):
+
+    def refreshed(self):
+        """When the index was last refreshed, or None if it is empty."""
+        return self.aggregate(models.Max('refreshed'))['refreshed__max']
+
+    def is_fresh(self, max_age):
+        refreshed = self.refreshed()
+        return (refreshed is not None and
+                (timezone.now() - refreshed).total_seconds() < max_age)
+
+    @transaction.atomic
+    def replace(self, recipients):
+        """Replace the index with (email, badge_id) pairs from Credly."""
+        now = timezone.now()
+        rows = dict(((normalize_email(email), badge_id),
+                     self.model(email=normalize_email(email),
+                                badge_id=badge_id, refreshed=now))
+                    for email, badge_id in recipients)
+        self.all().delete()
+        self.bulk_create(rows.values(), batch_size=500)
+
+    def emails(self, badge_id):
+        """Normalized emails known to have ``badge_id``. Recipients whose
+        badge Credly did not report are included, to be safe."""
+        return set(self.filter(models.Q(badge_id=badge_id) |
+                               models.Q(badge_id__isnull=True))
+                       .values_list('email', flat=True))
+
+
+class CredlyRecipient(models.Model):
+    """Local index of Credly's /me/badges/given recipients."""
+    email = models.EmailField(max_length=254)
+    badge_id = models.IntegerField(null=True, blank=True)
+    refreshed = models.DateTimeField()
+
+    objects = CredlyRecipientManager()
+
+    class Meta:
+        unique_together = [('email', 'badge_id')]
+
+    def __unicode__(self):
+        return self.email
+
+
+class AwardManager(models.Manager):
+
+    def emails(self, badge_id):
+        """Normalized emails ``badge_id`` has been awarded to."""
+        return set(self.filter(badge_id=badge_id)
+                       .values_list('email', flat=True))
+
+    def user_badges(self, user_ids=None):
+        """(user_id, badge_id) pairs awarded, optionally only among
+        ``user_ids``."""
+        awards = self.filter(user__isnull=False)
+        if user_ids is not None:
+            awards = awards.filter(user__in=user_ids)
+        return set(awards.values_list('user_id', 'badge_id'))
+
+    def record(self, badge_id, emails, status, response=None, users=None):
+        """
+        Record that ``emails`` have ``badge_id``. ``users`` maps normalized
+        emails to user ids; ``response`` maps emails to what Credly said
+        about each. Returns the new Awards; emails another node recorded
+        meanwhile keep its record.
+        """
+        users = users or {}
+        response = response or {}
+        existing = self.emails(badge_id)
+        awards = {}
+        for email in emails:
+            normalized = normalize_email(email)
+            if normalized in existing:
+                continue
+            awards[normalized] = self.model(
+                user_id=users.get(normalized), email=normalized,
+                badge_id=badge_id, status=status,
+                response=json.dumps(response.get(email)))
+        try:
+            with transaction.atomic():
+                self.bulk_create(awards.values(), batch_size=500)
+            return awards.values()
+        except IntegrityError:
+            pass
+        # Another node recorded some since we looked; they have the badge
+        # either way, so record the rest one at a time
+        created = []
+        for award in awards.values():
+            try:
+                with transaction.atomic():
+                    award.save()
+            except IntegrityError:
+                continue
+            created.append(award)
+        return created
+
+
+class Award(models.Model):
+    """
+    Ledger of badges awarded, or found already awarded, by award_badges,
+    so users who have a badge are never fetched or sent to Credly again.
+    """
+    AWARDED = 'awarded'
+    ALREADY_AWARDED = 'already_awarded'
+    STATUS_CHOICES = (
+        (AWARDED, 'Awarded'),
+        (ALREADY_AWARDED, 'Already awarded'),
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+                             on_delete=models.SET_NULL,
+                             related_name='untappd_awards')
+    email = models.EmailField(max_length=254)
+    badge_id = models.IntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    # Credly's response for this email, as JSON
+    response = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = AwardManager()
+
+    class Meta:
+        unique_together = [('email', 'badge_id')]
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.email, self.badge_id)
+
+
+class AvatarThumbnail(models.Model):
+    """
+    A participant's Untappd avatar, shrunk for the participant list (see
+    avatars.py). ``digest`` identifies the source URL, so a new avatar
+    gets a new thumbnail.
+    """
+    account = models.OneToOneField(SocialAccount,
+                                   related_name='avatar_thumbnail')
+    source = models.URLField(max_length=500)
+    digest = models.CharField(max_length=12)
+    image = models.BinaryField()
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'%s @ %s' % (self.account, self.digest)
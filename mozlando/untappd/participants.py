@@ -0,0 +1,62 @@
+"""
+Cached rendering of the home page participant list, a page at a time.
+
+The home page shows the first page; further pages are fetched from
+/participants as the list is scrolled. The fragment is invalidated
+whenever an Untappd account is linked or removed (see signals.py).
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+
+from allauth.socialaccount.models import SocialAccount
+
+from . import avatars
+from .fragments import CachedFragment
+
+
+def get_accounts():
+    """Untappd accounts with just the fields the participant list shows."""
+    return (SocialAccount.objects.filter(provider='untappd')
+                                 .select_related('user')
+                                 .only('extra_data', 'user__username')
+                                 .order_by('id'))
+
+
+def get_page(number):
+    paginator = Paginator(get_accounts(), settings.PARTICIPANTS_PAGE_SIZE)
+    try:
+        return paginator.page(number)
+    except PageNotAnInteger:
+        return paginator.page(1)
+    except EmptyPage:
+        return paginator.page(paginator.num_pages)
+
+
+def num_pages():
+    """Pages in the list, cached along with the pages themselves."""
+    key = fragment.cache_key('num_pages')
+    count = cache.get(key)
+    if count is None:
+        count = Paginator(get_accounts(),
+                          settings.PARTICIPANTS_PAGE_SIZE).num_pages
+        cache.set(key, count, settings.PARTICIPANTS_CACHE_TIMEOUT)
+    return count
+
+
+def page_data(number=1):
+    page = get_page(number)
+    return {
+        'count': page.paginator.count,
+        'next': page.next_page_number() if page.has_next() else None,
+        'results': [{
+            'username': account.user.username,
+            'avatar': avatars.thumbnail_url(account),
+        } for account in page.object_list],
+    }
+
+
+fragment = CachedFragment(
+    'participants', '_participants.html',
+    lambda number=1: {'participants': page_data(number)},
+    settings.PARTICIPANTS_CACHE_TIMEOUT)
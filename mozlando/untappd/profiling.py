@@ -0,0 +1,157 @@
+"""
+Per-phase profiling for award_badges --profile.
+
+    profiler = Profiler(cprofile=True)
+    with profiler.phase('accounts'):
+        ...
+    for line in profiler.report():
+        print line
+    profiler.dump('award_badges.prof')
+
+Each phase records wall and CPU time, memory allocated (with tracemalloc
+where Python has it, otherwise the growth in peak RSS) and the seconds
+spent waiting on Untappd and Credly and on the cache, read from the
+metrics registry; those waits are summed over every thread while the
+phase ran, so they can exceed its wall time. Phases may repeat, which
+adds up, or nest.
+
+The cProfile dump covers the calling thread and any pool threads
+started with ``profile_thread`` as their initializer, and opens in
+pstats, snakeviz or gprof2dot.
+"""
+import cProfile
+import os
+import pstats
+import resource
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+from . import metrics
+
+NETWORK_METRICS = ('untappd_request_seconds', 'credly_request_seconds')
+CACHE_METRICS = ('untappd_cache_seconds',)
+
+
+def cpu_time():
+    """User and system CPU seconds of this process, all threads."""
+    user, system = os.times()[:2]
+    return user + system
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (Linux reports
+    KB)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def allocated():
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return peak_rss()
+
+
+class Phase(object):
+
+    def __init__(self, depth=0):
+        # How many phases this one is nested in
+        self.depth = depth
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.network = 0.0
+        self.cache = 0.0
+        self.memory = 0
+
+
+class Profiler(object):
+
+    def __init__(self, cprofile=False):
+        self.phases = OrderedDict()
+        self.lock = threading.Lock()
+        self.profiles = []
+        self.cprofile = cprofile
+        self.started = None
+        self.local = threading.local()
+
+    def start(self):
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.cprofile:
+            self.profile_thread()
+        self.started = time.time()
+
+    def stop(self):
+        for profile in self.profiles:
+            profile.disable()
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def profile_thread(self):
+        """Profile the calling thread too, e.g. as a ThreadPool's
+        initializer."""
+        if not self.cprofile:
+            return
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    @contextmanager
+    def phase(self, name):
+        depth = getattr(self.local, 'depth', 0)
+        with self.lock:
+            phase = self.phases.setdefault(name, Phase(depth))
+        self.local.depth = depth + 1
+        network = sum(metrics.seconds(m) for m in NETWORK_METRICS)
+        cache = sum(metrics.seconds(m) for m in CACHE_METRICS)
+        memory = allocated()
+        started, cpu_started = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            with self.lock:
+                phase.calls += 1
+                phase.wall += time.time() - started
+                phase.cpu += cpu_time() - cpu_started
+                phase.network += sum(metrics.seconds(m)
+                                     for m in NETWORK_METRICS) - network
+                phase.cache += sum(metrics.seconds(m)
+                                   for m in CACHE_METRICS) - cache
+                phase.memory += allocated() - memory
+
+    def report(self):
+        """Lines of a table of the phases in the order first entered,
+        nested phases indented under the one they ran in."""
+        memory = ('alloc MB' if tracemalloc is not None
+                  else 'RSS+ MB')
+        lines = ['%-22s %5s %8s %8s %8s %8s %8s' % (
+            'phase', 'calls', 'wall s', 'cpu s', 'net s', 'cache s',
+            memory)]
+        for name, phase in self.phases.items():
+            lines.append('%-22s %5d %8.3f %8.3f %8.3f %8.3f %8.1f' % (
+                '  ' * phase.depth + name, phase.calls, phase.wall,
+                phase.cpu, phase.network, phase.cache,
+                phase.memory / 1024.0 / 1024))
+        if self.started is not None:
+            lines.append('%-22s %5s %8.3f' % ('total', '',
+                                              time.time() - self.started))
+        return lines
+
+    def dump(self, path):
+        """Write the cProfile stats of every profiled thread to path."""
+        if not self.profiles:
+            return
+        self.stop()
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from . import metrics
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket shared by concurrent API callers.
+
+    ``rate`` tokens are added per second, up to ``capacity``. ``consume``
+    blocks until a token is available, so callers are paced to ``rate``
+    however many threads share the bucket. A rate of 0 disables limiting.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens=1):
+        if self.rate <= 0:
+            return
+        with metrics.timer('ratelimit_wait_seconds'):
+            while True:
+                with self.lock:
+                    self._refill()
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return
+                    wait = (tokens - self.tokens) / self.rate
+                time.sleep(wait)
+
+
+class QuotaExhausted(Exception):
+    """No requests are left in the current quota window."""
+
+    def __init__(self, reset_at):
+        super(QuotaExhausted, self).__init__(
+            'API quota exhausted until %s' % time.ctime(reset_at))
+        self.reset_at = reset_at
+
+
+class Quota(object):
+    """
+    An hourly request quota as reported by the API's X-Ratelimit-Limit and
+    X-Ratelimit-Remaining headers, shared by concurrent callers.
+
+    ``acquire`` is called before each request and ``update`` with each
+    response's headers. Once only ``reserve`` requests are left, acquire
+    raises QuotaExhausted, or with ``wait`` sleeps until the window
+    resets. With ``pace``, requests are spread evenly over what is left of
+    the window instead of being spent as fast as they are asked for.
+    """
+
+    def __init__(self, window=3600, reserve=0, pace=False):
+        self.window = window
+        self.reserve = reserve
+        self.pace = pace
+        self.limit = None
+        # Unknown until the first response tells us
+        self.remaining = None
+        self.reset_at = None
+        self.next_at = 0
+        self.lock = threading.Lock()
+
+    def _expire(self, now):
+        if self.reset_at is not None and now >= self.reset_at:
+            self.remaining = None
+            self.reset_at = None
+
+    def update(self, headers):
+        remaining = headers.get('X-Ratelimit-Remaining')
+        if remaining is None:
+            return
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            if self.reset_at is None:
+                # The API doesn't say when its window started, so count
+                # from the first response we see in it
+                self.reset_at = now + self.window
+            self.remaining = int(remaining)
+            limit = headers.get('X-Ratelimit-Limit')
+            if limit is not None:
+                self.limit = int(limit)
+
+    def exhaust(self):
+        """Record a rate-limited response: nothing is left this window."""
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            if self.reset_at is None:
+                self.reset_at = now + self.window
+            self.remaining = 0
+
+    def exhausted(self):
+        with self.lock:
+            self._expire(time.time())
+            return (self.remaining is not None and
+                    self.remaining <= self.reserve)
+
+    def acquire(self, wait=False):
+        with metrics.timer('quota_wait_seconds'):
+            while True:
+                with self.lock:
+                    now = time.time()
+                    self._expire(now)
+                    if self.remaining is None:
+                        return
+                    available = self.remaining - self.reserve
+                    if available > 0:
+                        # Count the request now so concurrent callers
+                        # see it before the response headers arrive
+                        self.remaining -= 1
+                        if not self.pace:
+                            return
+                        slot = max(self.next_at, now)
+                        self.next_at = slot + ((self.reset_at - now) /
+                                               available)
+                        break
+                    if not wait:
+                        raise QuotaExhausted(self.reset_at)
+                    delay = self.reset_at - now
+                time.sleep(max(delay, 0))
+            # Our slot in the paced schedule
+            time.sleep(max(slot - time.time(), 0))
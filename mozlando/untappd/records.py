@@ -0,0 +1,139 @@
+"""
+Compact check-in records, for the cache and for evaluating badges.
+
+Badges only need a check-in's id, time, venue location and beer, plus
+the beer, brewery and venue names that get stored and, for check-ins
+from a friend feed, whose they are. CheckinRecord keeps just those, and
+a page of records packs into one fixed-size struct per check-in followed
+by a table of the distinct names, so cached pages are a fraction of the
+size of Untappd's JSON and load without parsing any.
+"""
+import math
+import struct
+from datetime import datetime
+from email.utils import mktime_tz, parsedate_tz
+
+from django.utils import timezone
+
+MAGIC = b'UCK2'
+# Magic, number of records, number of names
+HEADER = struct.Struct('<4sII')
+# checkin_id, created, bid, venue_id, lat, lng, and the indexes of the
+# beer, brewery, venue and user names: 64 bytes. Missing ids are 0 and
+# locations NaN.
+RECORD = struct.Struct('<qqqqddIIII')
+LENGTH = struct.Struct('<I')
+
+
+def untappd_timestamp(value):
+    """Seconds since the epoch of Untappd's RFC 2822 created_at."""
+    return mktime_tz(parsedate_tz(value))
+
+
+class CheckinRecord(object):
+    __slots__ = ('checkin_id', 'created', 'bid', 'beer_name',
+                 'brewery_name', 'venue_id', 'venue_name', 'lat', 'lng',
+                 'user_name')
+
+    def __init__(self, checkin_id, created, bid=None, beer_name=u'',
+                 brewery_name=u'', venue_id=None, venue_name=u'', lat=None,
+                 lng=None, user_name=u''):
+        self.checkin_id = checkin_id
+        # Seconds since the epoch
+        self.created = created
+        self.bid = bid
+        self.beer_name = beer_name
+        self.brewery_name = brewery_name
+        self.venue_id = venue_id
+        self.venue_name = venue_name
+        self.lat = lat
+        self.lng = lng
+        self.user_name = user_name
+
+    def __repr__(self):
+        return '<CheckinRecord %s>' % self.checkin_id
+
+    @classmethod
+    def from_item(cls, item):
+        """Keep what is needed of a raw Untappd check-in."""
+        beer = item.get('beer') or {}
+        # Untappd sends an empty list when there is no venue
+        venue = item.get('venue') or {}
+        location = venue.get('location') or {}
+        return cls(item['checkin_id'],
+                   untappd_timestamp(item['created_at']),
+                   beer.get('bid'),
+                   beer.get('beer_name', u''),
+                   (item.get('brewery') or {}).get('brewery_name', u''),
+                   venue.get('venue_id'),
+                   venue.get('venue_name', u''),
+                   location.get('lat'),
+                   location.get('lng'),
+                   (item.get('user') or {}).get('user_name', u''))
+
+    @property
+    def created_at(self):
+        return datetime.utcfromtimestamp(self.created).replace(
+            tzinfo=timezone.utc)
+
+
+def pack_records(records):
+    """Encode check-in records as bytes."""
+    names = {}
+
+    def name_index(name):
+        if name not in names:
+            names[name] = len(names)
+        return names[name]
+
+    packed = [RECORD.pack(record.checkin_id, record.created,
+                          record.bid or 0, record.venue_id or 0,
+                          float('nan') if record.lat is None else record.lat,
+                          float('nan') if record.lng is None else record.lng,
+                          name_index(record.beer_name),
+                          name_index(record.brewery_name),
+                          name_index(record.venue_name),
+                          name_index(record.user_name))
+              for record in records]
+    table = [None] * len(names)
+    for name, index in names.items():
+        encoded = name.encode('utf-8')
+        table[index] = LENGTH.pack(len(encoded)) + encoded
+    return b''.join([HEADER.pack(MAGIC, len(packed), len(table))] +
+                    packed + table)
+
+
+def unpack_records(data):
+    """Decode bytes from pack_records. Raises ValueError if they aren't."""
+    try:
+        return _unpack_records(data)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError('Corrupt check-in records: %s' % e)
+
+
+def _unpack_records(data):
+    if len(data) < HEADER.size:
+        raise ValueError('Not packed check-in records')
+    magic, count, num_names = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('Not packed check-in records')
+
+    offset = HEADER.size + count * RECORD.size
+    names = []
+    for i in range(num_names):
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        names.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+
+    records = []
+    for i in range(count):
+        (checkin_id, created, bid, venue_id, lat, lng, beer_name,
+         brewery_name, venue_name, user_name) = RECORD.unpack_from(
+            data, HEADER.size + i * RECORD.size)
+        records.append(CheckinRecord(
+            checkin_id, created, bid or None, names[beer_name],
+            names[brewery_name], venue_id or None, names[venue_name],
+            None if math.isnan(lat) else lat,
+            None if math.isnan(lng) else lng, names[user_name]))
+    return records
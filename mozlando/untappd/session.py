@@ -0,0 +1,48 @@
+"""
+Shared keep-alive HTTP session for Untappd.
+
+Sign-ins and award_badges both talk to untappd.com, so reusing pooled
+connections saves a TLS handshake per call. Every call should pass
+``timeout=settings.UNTAPPD_TIMEOUT`` so a slow Untappd can't hold a
+worker indefinitely.
+"""
+import os
+import threading
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process-wide Untappd session."""
+    global _session, _session_pid
+    with _session_lock:
+        # Forked award_badges workers mustn't share pooled sockets
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2,
+                                  pool_maxsize=settings.UNTAPPD_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+    return _session
+
+
+def describe_error(e, url):
+    """
+    A requests exception as safe to print: its messages quote the URL,
+    whose query string holds the client secret or a user's access token.
+    """
+    return '%s talking to %s' % (type(e).__name__, urlparse(url).netloc)
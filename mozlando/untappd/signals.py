@@ -0,0 +1,22 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from allauth.socialaccount.models import SocialAccount
+from allauth.socialaccount.signals import (social_account_added,
+                                           social_account_removed)
+
+from . import participants
+
+
+@receiver(social_account_added)
+@receiver(social_account_removed)
+def participants_changed(sender, **kwargs):
+    participants.fragment.invalidate()
+
+
+@receiver(post_save, sender=SocialAccount)
+@receiver(post_delete, sender=SocialAccount)
+def social_account_saved(sender, instance, **kwargs):
+    # New sign-ups create their account without social_account_added
+    if instance.provider == 'untappd':
+        participants.fragment.invalidate()
@@ -1,3 +1,945 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime, timedelta
+from StringIO import StringIO
 
-# Create your tests here.
+import numpy as np
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import parse_http_date
+
+from allauth.account.models import EmailAddress
+from allauth.socialaccount.models import (SocialAccount, SocialApp,
+                                          SocialToken)
+
+from . import avatars, leaderboard, metrics, participants
+from .cache import SQLiteCache
+from .credly import CredlyClient, CredlyError
+from .eligibility import (CheckinColumns, epoch, event_beer_counts,
+                          event_mask)
+from .fakes import (FakeCredlyServer, FakeUntappdServer, generate_checkins,
+                    untappd_datetime)
+from .geofence import Area, Geofence
+from .jsonstream import iter_array
+from .management.commands.award_badges import (Command, Refresher,
+                                               is_inactive, iter_page,
+                                               rank_accounts)
+from .models import (AvatarThumbnail, Award, Beer, Checkin, CheckinSync,
+                     CredlyRecipient, Event, Score, Venue)
+from .ratelimit import Quota, QuotaExhausted
+from .records import RECORD, CheckinRecord, pack_records, unpack_records
+
+START = datetime(2015, 12, 7, tzinfo=timezone.utc)
+END = datetime(2015, 12, 12, tzinfo=timezone.utc)
+DURING = epoch(datetime(2015, 12, 8, 12))
+# Pages render without running collectstatic first
+PLAIN_STATIC = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+BOUNDS = (0, 10, 0, 10)
+
+
+def square(name, lng, lat, size=1):
+    return Area(name, [[[(lng, lat), (lng + size, lat),
+                         (lng + size, lat + size), (lng, lat + size),
+                         (lng, lat)]]])
+
+
+# Areas A and B; anywhere else in BOUNDS is outside both
+GEOFENCE = Geofence([square('A', 1, 1), square('B', 5, 5)], cell_size=1)
+
+
+class EligibleTests(TestCase):
+    """The SQL rule and the NumPy engine must agree."""
+
+    def setUp(self):
+        self.users = [User.objects.create(username='user%d' % n)
+                      for n in range(2)]
+        self.venues = {}
+        for venue_id, (area, lat, lng) in enumerate(
+                [('A', 1.5, 1.5), ('B', 5.5, 5.5), ('', 8.5, 8.5)], 1):
+            self.venues[area] = Venue.objects.create(
+                venue_id=venue_id, lat=lat, lng=lng, area=area)
+        self.rows = []
+        self.checkin_id = 0
+
+    def checkin(self, user, bid, area):
+        self.checkin_id += 1
+        venue = self.venues[area]
+        Beer.objects.get_or_create(bid=bid)
+        Checkin.objects.create(
+            checkin_id=self.checkin_id, user=user, beer_id=bid, venue=venue,
+            created_at=datetime.utcfromtimestamp(DURING).replace(
+                tzinfo=timezone.utc))
+        self.rows.append((user.id, DURING, venue.lat, venue.lng, bid))
+
+    def eligible(self, num_beers, num_areas):
+        event = dict(start=START, end=END, bounds=BOUNDS, in_areas=False)
+        in_sql = dict(Checkin.objects.eligible(num_beers, num_areas,
+                                               **event))
+        users, counts = event_beer_counts(CheckinColumns.from_rows(self.rows),
+                                          num_areas, geofence=GEOFENCE,
+                                          **event)
+        in_numpy = dict((user, count) for user, count
+                        in zip(users.tolist(), counts.tolist())
+                        if count >= num_beers)
+        self.assertEqual(in_sql, in_numpy)
+        return in_sql
+
+    def test_beers(self):
+        user = self.users[0]
+        for bid in (1, 2, 2):
+            self.checkin(user, bid, 'A')
+        self.assertEqual(self.eligible(2, 0), {user.id: 2})
+        self.assertEqual(self.eligible(3, 0), {})
+
+    def test_areas(self):
+        user = self.users[0]
+        self.checkin(user, 1, 'A')
+        self.checkin(user, 2, 'B')
+        self.assertEqual(self.eligible(2, 2), {user.id: 2})
+
+    def test_outside_is_not_an_area(self):
+        user = self.users[0]
+        self.checkin(user, 1, 'A')
+        self.checkin(user, 2, '')
+        self.assertEqual(self.eligible(2, 2), {})
+
+    def test_areas_of_other_users(self):
+        first, second = self.users
+        self.checkin(first, 1, 'A')
+        self.checkin(first, 2, 'A')
+        self.checkin(second, 3, '')
+        self.checkin(second, 4, 'B')
+        self.assertEqual(self.eligible(2, 2), {})
+        self.assertEqual(self.eligible(2, 1), {first.id: 2, second.id: 2})
+
+
+    @override_settings(GEOFENCE_PATH=None)
+    def test_no_geofence(self):
+        # Nothing is in an area, rather than a crash
+        self.checkin(self.users[0], 1, 'A')
+        columns = CheckinColumns.from_rows(self.rows)
+        self.assertFalse(event_mask(columns, START, END, BOUNDS,
+                                    in_areas=True).any())
+        users, counts = event_beer_counts(columns, 1, start=START, end=END,
+                                          bounds=BOUNDS, in_areas=False)
+        self.assertEqual(len(users), 0)
+
+    def test_score_checkins_areas(self):
+        Event.objects.create(
+            slug='squares', name='Squares', active=False, start=START,
+            end=END, min_latitude=BOUNDS[0], max_latitude=BOUNDS[1],
+            min_longitude=BOUNDS[2], max_longitude=BOUNDS[3], num_beers=2,
+            num_areas=2, credly_badge_id=1)
+        both, one = self.users
+        self.checkin(both, 1, 'A')
+        self.checkin(both, 2, 'B')
+        self.checkin(one, 1, 'A')
+        self.checkin(one, 2, 'A')
+        path = os.path.join(tempfile.mkdtemp(), 'areas.geojson')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': {'name': area.name},
+                 'geometry': {'type': 'Polygon', 'coordinates': [
+                     ring.tolist() for ring in area.polygons[0]]}}
+                for area in GEOFENCE.areas]}, f)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            with override_settings(GEOFENCE_PATH=path, GEOFENCE_CELL_SIZE=1):
+                call_command('score_checkins', event='squares')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn('1 users with at least 2 matching beers', output)
+
+
+class RecordsTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        records = [
+            CheckinRecord(3, 1449500000, 7, u'Bi\xe8re', u'Brasserie', 11,
+                          u'Caf\xe9', 28.37, -81.55, u'alice'),
+            # No beer, venue or location
+            CheckinRecord(2, 1449400000),
+        ]
+        unpacked = unpack_records(pack_records(records))
+        self.assertEqual(
+            [[getattr(record, slot) for slot in CheckinRecord.__slots__]
+             for record in unpacked],
+            [[getattr(record, slot) for slot in CheckinRecord.__slots__]
+             for record in records])
+
+    def test_record_size(self):
+        # Changing it changes the cache format; bump MAGIC with it
+        self.assertEqual(RECORD.size, 64)
+        one = pack_records([CheckinRecord(2, 1449400000, 7, u'Beer')])
+        two = pack_records([CheckinRecord(2, 1449400000, 7, u'Beer'),
+                            CheckinRecord(1, 1449300000, 7, u'Beer')])
+        self.assertEqual(len(two) - len(one), 64)
+
+    def test_corrupt(self):
+        data = pack_records([CheckinRecord(1, 1449500000, 7, u'Beer')])
+        for corrupt in (b'', b'JSON' + data[4:], data[:-2]):
+            self.assertRaises(ValueError, unpack_records, corrupt)
+
+
+class IterArrayTests(SimpleTestCase):
+
+    def chunks(self, data, size):
+        data = json.dumps(data).encode('utf-8')
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_split_chunks(self):
+        items = [{'checkin_id': n, 'name': u'Caf\xe9 "%d"' % n}
+                 for n in range(5)]
+        data = {'meta': {'items': []},
+                'response': {'checkins': {'count': 5, 'items': items}}}
+        # Down to one byte at a time, splitting keys and UTF-8 sequences
+        for size in (1, 3, 1000):
+            self.assertEqual(
+                list(iter_array(self.chunks(data, size),
+                                ('checkins', 'items'))), items)
+
+    def test_empty(self):
+        data = {'checkins': {'items': []}}
+        self.assertEqual(
+            list(iter_array(self.chunks(data, 4), ('checkins', 'items'))),
+            [])
+
+    def test_stops_reading(self):
+        read = []
+
+        def chunks():
+            for chunk in self.chunks({'items': range(100)}, 8):
+                read.append(chunk)
+                yield chunk
+        items = iter_array(chunks(), ('items',))
+        self.assertEqual([next(items) for i in range(3)], [0, 1, 2])
+        self.assertLess(len(read), 10)
+
+    def test_missing_key(self):
+        self.assertRaises(ValueError, list,
+                          iter_array(self.chunks({'a': []}, 4), ('items',)))
+
+
+class GeofenceTests(SimpleTestCase):
+
+    def test_locate(self):
+        donut = Area('Donut', [[
+            [(0, 0), (4, 0), (4, 4), (0, 4), (0, 0)],
+            [(1, 1), (3, 1), (3, 3), (1, 3), (1, 1)],
+        ]])
+        pair = Area('Pair', [
+            [[(5, 0), (6, 0), (6, 1), (5, 1), (5, 0)]],
+            [[(7, 0), (8, 0), (8, 1), (7, 1), (7, 0)]],
+        ])
+        triangle = Area('Triangle', [[[(0, 5), (4, 5), (0, 9), (0, 5)]]])
+        geofence = Geofence([donut, pair, triangle], cell_size=1)
+        points = [
+            ((0.5, 0.5), 'Donut'),
+            ((2, 2), None),  # in the hole
+            ((0.5, 5.5), 'Pair'),
+            ((0.5, 7.5), 'Pair'),
+            ((0.5, 6.5), None),  # between the pair
+            ((6, 1), 'Triangle'),
+            ((8, 3), None),  # inside the box, outside the triangle
+            ((20, 20), None),
+        ]
+        for (lat, lng), name in points:
+            self.assertEqual(geofence.locate(lat, lng), name)
+        lats = [lat for (lat, lng), name in points] + [np.nan]
+        lngs = [lng for (lat, lng), name in points] + [0.5]
+        self.assertEqual(
+            geofence.locate_many(lats, lngs).tolist(),
+            [geofence.names.index(name) if name else -1
+             for point, name in points] + [-1])
+
+
+class QuotaTests(SimpleTestCase):
+
+    def test_exhausted(self):
+        quota = Quota(window=3600, reserve=2)
+        # Unknown until a response says
+        self.assertFalse(quota.exhausted())
+        quota.acquire()
+        quota.update({'X-Ratelimit-Limit': '100',
+                      'X-Ratelimit-Remaining': '4'})
+        self.assertFalse(quota.exhausted())
+        quota.acquire()
+        quota.acquire()
+        self.assertTrue(quota.exhausted())
+        self.assertRaises(QuotaExhausted, quota.acquire)
+
+    def test_window_resets(self):
+        quota = Quota(window=3600)
+        quota.exhaust()
+        self.assertTrue(quota.exhausted())
+        quota.reset_at = time.time() - 1
+        self.assertFalse(quota.exhausted())
+        quota.acquire()
+
+
+class SQLiteCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_validators(self):
+        cache = SQLiteCache(self.path, timeout=60)
+        cache.set('a', b'value', {'etag': '"x"'})
+        entry = cache.get_entry('a')
+        self.assertEqual(entry.value, b'value')
+        self.assertEqual(entry.validators, {'etag': '"x"'})
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = SQLiteCache(self.path, max_entries=2, evict_every=1,
+                            timeout=60)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        # Touch a so b is the least recently used
+        time.sleep(0.01)
+        self.assertEqual(cache.get('a'), b'1')
+        cache.set('c', b'3')
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), b'3')
+
+    def test_hits_written_together(self):
+        cache = SQLiteCache(self.path, touch_every=3, timeout=60)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+
+        def accessed(key):
+            conn = sqlite3.connect(self.path)
+            try:
+                return conn.execute('SELECT accessed - stored FROM entries'
+                                    ' WHERE key = ?', (key,)).fetchone()[0]
+            finally:
+                conn.close()
+
+        time.sleep(0.01)
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual((accessed('a'), accessed('b')), (0, 0))
+        cache.get('a')
+        self.assertGreater(accessed('a'), 0)
+        self.assertGreater(accessed('b'), 0)
+
+    def test_evicts_by_size(self):
+        cache = SQLiteCache(self.path, max_bytes=10, evict_every=1,
+                            timeout=60)
+        cache.set('a', b'x' * 6)
+        time.sleep(0.01)
+        cache.set('b', b'y' * 6)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), b'y' * 6)
+
+    def test_stale(self):
+        cache = SQLiteCache(self.path, timeout=60)
+        cache.set('a', b'1')
+        time.sleep(0.01)
+        # Too old to serve, but kept for revalidation
+        self.assertEqual(cache.get('a', max_age=0.005), None)
+        self.assertEqual(cache.get_entry('a', max_age=0.005).value, b'1')
+
+
+class DatabaseCacheTests(TestCase):
+
+    def test_get_many(self):
+        cache.set('a', 1)
+        cache.set('b', {'x': 2})
+        cache.set('old', 3, -1)
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_many(['a', 'b', 'old', 'none']),
+                             {'a': 1, 'b': {'x': 2}})
+
+
+class AwardTests(TestCase):
+
+    def test_recorded_elsewhere(self):
+        Award.objects.record(1, ['b@example.com'], Award.AWARDED)
+        # As if another node recorded b after this one read the ledger
+        Award.objects.emails = lambda badge_id: set()
+        self.addCleanup(delattr, Award.objects, 'emails')
+        created = Award.objects.record(
+            1, ['a@example.com', 'B@example.com'], Award.ALREADY_AWARDED)
+        self.assertEqual([award.email for award in created],
+                         ['a@example.com'])
+        self.assertEqual(
+            dict(Award.objects.values_list('email', 'status')),
+            {'a@example.com': Award.ALREADY_AWARDED,
+             'b@example.com': Award.AWARDED})
+
+
+class RankAccountsTests(TestCase):
+
+    def setUp(self):
+        Event.objects.exclude(slug='mozlando-2015').update(active=False)
+        self.events = list(Event.objects.active())
+
+    def account(self, username, last_checkin_id=None, last_active=None,
+                num_beers=None):
+        user = User.objects.create(username=username)
+        account = SocialAccount.objects.create(user=user, provider='untappd',
+                                               uid=username)
+        sync = CheckinSync.objects.create(account=account,
+                                          last_checkin_id=last_checkin_id,
+                                          last_active=last_active)
+        if num_beers is not None:
+            Score.objects.create(user=user, event=self.events[0],
+                                 num_beers=num_beers)
+        return account, sync
+
+    def test_order(self):
+        now = timezone.now()
+        accounts, syncs = {}, {}
+        for username, args in [
+                ('new', ()),
+                ('close', (1, now, 10)),
+                ('started', (2, now, 2)),
+                ('idle', (3, now - timedelta(days=365), 11)),
+                ('done', (4, now, 12))]:
+            accounts[username], syncs[username] = self.account(username,
+                                                               *args)
+        ranked, skipped = rank_accounts(accounts, syncs, self.events)
+        # idle was fetched just now, so can wait
+        self.assertEqual(ranked, ['new', 'close', 'started', 'done'])
+        self.assertEqual(skipped, ['idle'])
+
+
+class AwardBadgesTests(TestCase):
+    """Whole award_badges runs against the fake Untappd and Credly."""
+
+    def setUp(self):
+        Event.objects.exclude(slug='mozlando-2015').update(active=False)
+        self.event = Event.objects.get(slug='mozlando-2015')
+        self.dir = tempfile.mkdtemp()
+        self.checkins = generate_checkins(8, 40, self.event, in_event=0.8)
+        # Nothing during the event
+        self.checkins['benchuser7'] = generate_checkins(
+            1, 5, self.event, in_event=0, seed=1)['benchuser0']
+        for n, item in enumerate(self.checkins['benchuser7']):
+            item['checkin_id'] = 10000 - n
+        for username in self.checkins:
+            user = User.objects.create(username=username)
+            SocialAccount.objects.create(user=user, provider='untappd',
+                                         uid=username)
+            EmailAddress.objects.create(user=user, primary=True,
+                                        email='%s@example.com' % username)
+        self.untappd = FakeUntappdServer(self.checkins).start()
+        self.credly = FakeCredlyServer(max_per_page=3).start()
+        self.settings = override_settings(
+            UNTAPPD_BASE_URL=self.untappd.url + '/v4',
+            UNTAPPD_CLIENT_ID='test',
+            UNTAPPD_CLIENT_SECRET='test',
+            UNTAPPD_CACHE={
+                'BACKEND': 'mozlando.untappd.cache.SQLiteCache',
+                'OPTIONS': {'path': os.path.join(self.dir, 'untappd.db')},
+            },
+            UNTAPPD_FEED_USERNAMES=[],
+            CREDLY_BASE_URL=self.credly.url + '/v1.1',
+            CREDLY_API_KEY='test',
+            CREDLY_API_SECRET='test',
+            CREDLY_USERNAME='test',
+            CREDLY_PASSWORD='test',
+            CREDLY_BACKOFF=0,
+            CREDLY_PAGE_SIZE=5)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.untappd.stop()
+        self.credly.stop()
+        shutil.rmtree(self.dir)
+
+    def run_command(self, **options):
+        """Run award_badges, returning what it printed."""
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            call_command('award_badges', rate=0, **options)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_awards_once(self):
+        self.run_command()
+        earned = set('%s@example.com' % User.objects.get(id=user_id)
+                     for user_id, num_beers in self.event.eligible())
+        self.assertGreater(len(earned), 3)
+        badge_id = self.event.credly_badge_id
+        self.assertEqual(self.credly.awards[badge_id], earned)
+        self.assertEqual(Award.objects.emails(badge_id), earned)
+
+        # Forget the ledger: the recipient index, read in pages smaller
+        # than asked for, still finds every recipient
+        Award.objects.all().delete()
+        self.run_command(refresh_recipients=True)
+        self.assertEqual(self.credly.duplicates, 0)
+        self.assertEqual(self.credly.awards[badge_id], earned)
+        self.assertEqual(Award.objects.emails(badge_id), earned)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_publishes_metrics(self):
+        cache.clear()
+        self.run_command(shard=(0, 2))
+        self.assertIn('award_run_seconds_count{process="award_badges:0/2"} 1',
+                      metrics.render_all())
+
+    def test_watermark_past_old_checkins(self):
+        self.run_command()
+        sync = CheckinSync.objects.get(account__uid='benchuser7')
+        newest = self.checkins['benchuser7'][0]
+        self.assertEqual(sync.last_checkin_id, newest['checkin_id'])
+        self.assertFalse(Checkin.objects.filter(user__username='benchuser7')
+                         .exists())
+
+        # So they can be left alone for a while rather than fetched from
+        # the start every run
+        self.assertTrue(is_inactive(sync))
+
+    def test_errors_hide_credentials(self):
+        # Nothing listens on a port just released
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with override_settings(
+                UNTAPPD_BASE_URL='http://127.0.0.1:%s/v4' % port,
+                UNTAPPD_CLIENT_SECRET='SUPERSECRET'):
+            output = self.run_command()
+        self.assertIn('Could not fetch benchuser0', output)
+        self.assertNotIn('SUPERSECRET', output)
+
+
+    def test_credly_retries(self):
+        client = CredlyClient(max_retries=2)
+        client.authenticate()
+        self.credly.reset_counters()
+        self.credly.error_rate = 1
+        self.assertRaises(CredlyError, client.given_badges)
+        self.assertEqual(self.credly.requests, 3)
+        self.credly.error_rate = 0
+        self.assertEqual(client.given_badges()['data'], [])
+
+    def test_credly_reauthenticates(self):
+        client = CredlyClient()
+        client.authenticate()
+        self.credly.expire_token()
+        self.assertEqual(client.given_badges()['data'], [])
+        self.assertEqual(self.credly.authentications, 2)
+
+        # Threads sharing the client authenticate once between them
+        self.credly.expire_token()
+        emails = ['user%s@example.com' % n for n in range(8)]
+        for batch, response in client.award_all(emails, badge_id=1,
+                                                batch_size=1,
+                                                concurrency=4):
+            self.assertEqual(response['successes'], {batch[0]: 'SUCCESS'})
+        self.assertEqual(self.credly.authentications, 3)
+
+    def test_credly_token_rejected(self):
+        client = CredlyClient(max_retries=0)
+        client.authenticate()
+        self.credly.expire_token()
+        self.assertRaises(CredlyError, client.given_badges)
+
+    def test_watch(self):
+        command = Command()
+        command.setup(dict(concurrency=4, rate=0, watch=True,
+                           refresh_recipients=False))
+        accounts, schedule = {}, []
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            command.watch_once(accounts, schedule)
+            earned = set(User.objects.get(id=user_id).username
+                         for user_id, num_beers in self.event.eligible())
+            self.assertGreater(len(earned), 3)
+            self.assertEqual(
+                self.credly.awards[self.event.credly_badge_id],
+                set('%s@example.com' % username for username in earned))
+            # Users with the badge are no longer polled
+            scheduled = set(username for due, username in schedule)
+            self.assertEqual(scheduled, set(accounts) - earned)
+
+            # A new account is picked up by id alone
+            user = User.objects.create(username='benchuser8')
+            account = SocialAccount.objects.create(
+                user=user, provider='untappd', uid='benchuser8')
+            self.checkins['benchuser8'] = []
+            with CaptureQueriesContext(connection) as queries:
+                command.watch_once(accounts, schedule)
+            self.assertIn('benchuser8', accounts)
+            self.assertEqual(command.newest_account_id, account.id)
+            self.assertFalse([query for query in queries.captured_queries
+                              if 'NOT IN' in query['sql']])
+
+            # Users done with one event are polled again for a new one
+            Event.objects.filter(slug='tulsa-cherry-street-2015').update(
+                active=True)
+            command.watch_once(accounts, schedule)
+            self.assertEqual(len(command.events), 2)
+            scheduled = set(username for due, username in schedule)
+            self.assertTrue(earned <= scheduled)
+        finally:
+            sys.stdout = stdout
+
+
+    def test_feed_fan_in(self):
+        # benchuser0 is friends with everyone but benchuser7, whose made
+        # up check-in ids don't grow over time as real ones do
+        self.untappd.friends['benchuser0'] = sorted(self.checkins)[1:7]
+        app = SocialApp.objects.create(provider='untappd', name='Untappd',
+                                       client_id='test', secret='test')
+        SocialToken.objects.create(
+            app=app, account=SocialAccount.objects.get(uid='benchuser0'),
+            token='token-benchuser0')
+        with override_settings(UNTAPPD_FEED_USERNAMES=['benchuser0']):
+            output = self.run_command()
+            self.assertIn('Friend feeds covered 6 users', output)
+            self.assertEqual(output.count('Fetching user activity'), 2)
+            stored = self.stored_checkins()
+            awarded = set(self.credly.awards[self.event.credly_badge_id])
+
+            # Later runs find friends' new check-ins in the feed too; forget
+            # the badges so users who earned one are read again
+            Award.objects.all().delete()
+            newest = dict(self.checkins['benchuser3'][0], checkin_id=20000,
+                          created_at=untappd_datetime(time.time()))
+            self.checkins['benchuser3'].insert(0, newest)
+            # The made up check-ins are from 2015; don't count that as
+            # inactive
+            with override_settings(LATEST_CACHE_AGE=0.001,
+                                   UNTAPPD_INACTIVE_AFTER=10 ** 10):
+                time.sleep(0.01)
+                output = self.run_command()
+        self.assertNotIn('Fetching user activity for benchuser3', output)
+        self.assertEqual(CheckinSync.objects.get(
+            account__uid='benchuser3').last_checkin_id, 20000)
+
+        # The feed found what fetching each user does, and more, as
+        # fetching stops once a user has the badge
+        for model in (Award, Checkin, CheckinSync, CredlyRecipient, Score):
+            model.objects.all().delete()
+        self.credly.awards.clear()
+        del self.checkins['benchuser3'][0]
+        with override_settings(UNTAPPD_CACHE={
+                'BACKEND': 'mozlando.untappd.cache.SQLiteCache',
+                'OPTIONS': {'path': os.path.join(self.dir, 'other.db')}}):
+            output = self.run_command()
+        self.assertEqual(output.count('Fetching user activity'), 8)
+        self.assertTrue(set(self.stored_checkins()) <= set(stored))
+        self.assertEqual(self.credly.awards[self.event.credly_badge_id],
+                         awarded)
+
+    def stored_checkins(self):
+        return sorted(Checkin.objects.values_list('user__username',
+                                                  'checkin_id'))
+
+
+class RevalidationTests(TestCase):
+    """Stale cached check-in pages, brought up to date."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        event = Event.objects.get(slug='mozlando-2015')
+        self.checkins = generate_checkins(1, 20, event)
+        self.settings = override_settings(
+            UNTAPPD_CLIENT_ID='test',
+            UNTAPPD_CLIENT_SECRET='test',
+            UNTAPPD_CACHE={
+                'BACKEND': 'mozlando.untappd.cache.SQLiteCache',
+                'OPTIONS': {'path': os.path.join(self.dir, 'untappd.db')},
+            })
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.untappd.stop()
+        shutil.rmtree(self.dir)
+
+    def start(self, **options):
+        self.untappd = FakeUntappdServer(self.checkins, **options).start()
+        self.url = override_settings(UNTAPPD_BASE_URL=self.untappd.url + '/v4')
+        self.url.enable()
+        self.addCleanup(self.url.disable)
+
+    def read(self, max_age=60, refresher=None):
+        """Check-in ids on benchuser0's newest page, read through the
+        cache; with a tiny max_age, the cached page is stale."""
+        time.sleep(0.01)
+        self.untappd.reset_counters()
+        return [record.checkin_id for record in iter_page(
+            'user/checkins/benchuser0', dict(limit=10), max_age,
+            refresher=refresher)]
+
+    def add_checkin(self):
+        newest = dict(self.checkins['benchuser0'][0],
+                      checkin_id=self.checkins['benchuser0'][0]['checkin_id']
+                      + 1)
+        self.checkins['benchuser0'].insert(0, newest)
+        return newest['checkin_id']
+
+    def test_not_modified(self):
+        self.start(etags=True)
+        page = self.read()
+        self.assertEqual(len(page), 10)
+        self.assertEqual(self.read(), page)
+        self.assertEqual(self.untappd.requests, 0)
+        self.assertEqual(self.read(0.001), page)
+        self.assertEqual(self.untappd.requests, 1)
+        # A 304 has no body
+        self.assertEqual(self.untappd.bytes_sent, 0)
+
+    def test_etag_changed(self):
+        self.start(etags=True)
+        page = self.read()
+        newest = self.add_checkin()
+        self.assertEqual(self.read(0.001), [newest] + page[:9])
+        self.assertEqual(self.untappd.requests, 1)
+        self.assertEqual(self.read(), [newest] + page[:9])
+        self.assertEqual(self.untappd.requests, 0)
+
+    def test_delta(self):
+        # Without validators only the check-ins past the newest cached one
+        # are asked for
+        self.start()
+        page = self.read()
+        newest = self.add_checkin()
+        self.assertEqual(self.read(0.001), [newest] + page[:9])
+        self.assertEqual(self.untappd.requests, 1)
+        self.assertLess(self.untappd.bytes_sent, 1000)
+
+    def test_stale_while_revalidate(self):
+        self.start(etags=True)
+        page = self.read()
+        newest = self.add_checkin()
+        refresher = Refresher(60)
+        # Served stale at once, and refreshed in the background
+        self.assertEqual(self.read(0.001, refresher), page)
+        refresher.join()
+        self.assertEqual(self.untappd.requests, 1)
+        self.assertEqual(self.read(), [newest] + page[:9])
+
+
+class ViewTests(TestCase):
+
+    def setUp(self):
+        Event.objects.exclude(slug='mozlando-2015').update(active=False)
+        cache.clear()
+
+    @override_settings(STATICFILES_STORAGE=PLAIN_STATIC)
+    def test_home_revalidates(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(
+            self.client.get('/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        leaderboard.fragment.invalidate()
+        response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(STATICFILES_STORAGE=PLAIN_STATIC)
+    def test_home_cache_reads(self):
+        etag = self.client.get('/')['ETag']
+        # The stamps in one read, then each fragment's HTML
+        with self.assertNumQueries(3):
+            self.client.get('/')
+        with self.assertNumQueries(1):
+            self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+
+    @override_settings(STATICFILES_STORAGE=PLAIN_STATIC)
+    def test_last_modified_not_ahead(self):
+        for i in range(5):
+            participants.fragment.invalidate()
+        # As written by a node whose clock runs fast
+        cache.set(leaderboard.fragment.modified_key, time.time() + 3600,
+                  None)
+        response = self.client.get('/')
+        self.assertLessEqual(parse_http_date(response['Last-Modified']),
+                             time.time())
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(
+            self.client.get('/metrics',
+                            HTTP_AUTHORIZATION='Bearer wrong').status_code,
+            403)
+        self.assertEqual(
+            self.client.get('/metrics',
+                            HTTP_AUTHORIZATION='Bearer secret').status_code,
+            200)
+
+    def test_allowed_hosts(self):
+        # The test runner allows any host, so load the settings afresh
+        def allowed_hosts(**env):
+            env = dict(os.environ, **env)
+            env.pop('ALLOWED_HOSTS', None)
+            return subprocess.check_output(
+                [sys.executable, '-c', 'from mozlando import settings; '
+                 'print(",".join(settings.ALLOWED_HOSTS))'],
+                env=env).strip()
+        self.assertEqual(allowed_hosts(DEBUG='False'), 'localhost,127.0.0.1')
+        self.assertEqual(allowed_hosts(DEBUG='True'), '*')
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_of_every_process(self):
+        for process, value in (('award_badges', 3), ('web:a:1', 2)):
+            metrics.reset()
+            metrics.inc('fake_total', value)
+            metrics.publish(process)
+        metrics.reset()
+        response = self.client.get('/metrics',
+                                   HTTP_AUTHORIZATION='Bearer secret')
+        self.assertIn('fake_total{process="award_badges"} 3',
+                      response.content)
+        self.assertIn('fake_total{process="web:a:1"} 2', response.content)
+
+        # Processes that stopped publishing are forgotten
+        cache.delete('metrics:process:web:a:1')
+        response = self.client.get('/metrics',
+                                   HTTP_AUTHORIZATION='Bearer secret')
+        self.assertNotIn('web:a:1', response.content)
+        self.assertEqual(cache.get(metrics.PROCESSES_KEY),
+                         ['metrics:process:award_badges'])
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_metrics_off(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+    def test_leaderboard_json(self):
+        for query in ('', '?page=x', '?page=-1', '?page=99',
+                      '?event=mozlando-2015'):
+            response = self.client.get('/leaderboard.json' + query)
+            self.assertEqual(json.loads(response.content)['page'], 1)
+        self.assertEqual(
+            self.client.get('/leaderboard.json?event=a%20b').status_code,
+            404)
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves the server's ``images`` by path, counting requests."""
+
+    def do_GET(self):
+        self.server.requests += 1
+        image = self.server.images.get(self.path)
+        self.send_response(200 if image else 404)
+        self.send_header('Content-Length', str(len(image or b'')))
+        self.end_headers()
+        self.wfile.write(image or b'')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def png(size=(80, 60), color=(200, 100, 0)):
+    out = StringIO()
+    Image.new('RGB', size, color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class ParticipantsTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.server = HTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.server.images = {'/a.png': png(), '/b.png': png(color=(0, 0, 0))}
+        self.server.requests = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.accounts = []
+        for n in range(5):
+            user = User.objects.create(username='user%d' % n)
+            self.accounts.append(SocialAccount.objects.create(
+                user=user, provider='untappd', uid=str(n),
+                extra_data={'response': {'user': {
+                    'user_avatar': self.avatar('/a.png')}}}))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def avatar(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server.server_address[1],
+                                          path)
+
+    def set_avatar(self, account, path):
+        account.extra_data = {'response': {'user': {
+            'user_avatar': self.avatar(path)}}}
+        account.save()
+
+    @override_settings(PARTICIPANTS_PAGE_SIZE=2)
+    def test_pages(self):
+        def usernames(query):
+            content = self.client.get('/participants' + query).content
+            return [account.user.username for account in self.accounts
+                    if '>%s<' % account.user.username in content]
+
+        self.assertEqual(usernames(''), ['user0', 'user1'])
+        self.assertEqual(usernames('?page=2'), ['user2', 'user3'])
+        self.assertEqual(usernames('?page=3'), ['user4'])
+        # Anything else is the first or last page, cached only as that
+        for query, page in (('?page=999', 3), ('?page=0', 1),
+                            ('?page=-1', 1), ('?page=x', 1)):
+            self.assertEqual(usernames(query), usernames('?page=%s' % page))
+        for number in (999, 0, -1):
+            self.assertEqual(
+                cache.get(participants.fragment.cache_key(number)), None)
+
+    def test_thumbnail(self):
+        account = self.accounts[0]
+        url = avatars.thumbnail_url(account)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('max-age=%s' % settings.AVATAR_CACHE_TIMEOUT,
+                      response['Cache-Control'])
+        self.assertEqual(Image.open(StringIO(response.content)).size,
+                         avatars.SIZE)
+        # Made once; shared by everyone with the same avatar
+        self.client.get(url)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_changed_avatar(self):
+        account = self.accounts[0]
+        old_url = avatars.thumbnail_url(account)
+        self.set_avatar(account, '/b.png')
+        response = self.client.get(old_url)
+        self.assertRedirects(response, avatars.thumbnail_url(account),
+                             fetch_redirect_response=False)
+
+    def test_missing_avatar(self):
+        account = self.accounts[0]
+        self.set_avatar(account, '/missing.png')
+        response = self.client.get(avatars.thumbnail_url(account))
+        self.assertRedirects(response, self.avatar('/missing.png'),
+                             fetch_redirect_response=False)
+        self.assertFalse(AvatarThumbnail.objects.exists())
@@ -3,8 +3,20 @@ try:
 except ImportError:
     from urlparse import parse_qsl
 
+import json
+
 import requests
 
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.shortcuts import get_object_or_404, redirect
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.utils.safestring import mark_safe
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic.base import TemplateView
 
 from allauth.socialaccount.models import SocialAccount
@@ -13,7 +25,9 @@ from allauth.socialaccount.providers.oauth2.client import (OAuth2Client,
 from allauth.socialaccount.providers.oauth2.views import (OAuth2Adapter,
                                                           OAuth2LoginView,
                                                           OAuth2CallbackView)
+from . import avatars, fragments, leaderboard, metrics, participants
 from .provider import UntappdProvider
+from .session import describe_error, get_session
 
 
 class UntappdOAuth2Client(OAuth2Client):
@@ -36,11 +50,16 @@ class UntappdOAuth2Client(OAuth2Client):
         if self.access_token_method == 'GET':
             params = data
             data = None
-        # TODO: Proper exception handling
-        resp = requests.request(self.access_token_method,
-                                url,
-                                params=params,
-                                data=data)
+        try:
+            with metrics.timer('untappd_login_seconds', step='token'):
+                resp = get_session().request(self.access_token_method,
+                                             url,
+                                             params=params,
+                                             data=data,
+                                             timeout=settings.UNTAPPD_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            raise OAuth2Error('Error retrieving access token: %s'
+                              % describe_error(e, url))
         access_token = None
         if resp.status_code == 200:
             access_token = resp.json()['response']
@@ -59,24 +78,145 @@ class UntappdOAuth2Adapter(OAuth2Adapter):
     supports_state = False
 
     def complete_login(self, request, app, token, **kwargs):
-        resp = requests.get(self.user_info_url,
-                            params={'access_token': token.token})
-        extra_data = resp.json()
+        try:
+            with metrics.timer('untappd_login_seconds', step='user_info'):
+                resp = get_session().get(self.user_info_url,
+                                         params={'access_token': token.token},
+                                         timeout=settings.UNTAPPD_TIMEOUT)
+            extra_data = resp.json()
+        except requests.exceptions.RequestException as e:
+            raise OAuth2Error('Error retrieving user info: %s'
+                              % describe_error(e, self.user_info_url))
+        except ValueError as e:
+            raise OAuth2Error('Error retrieving user info: %s' % e)
         # TODO: get and store the email from the user info json
         return self.get_provider().sociallogin_from_response(request,
                                                              extra_data)
 
 
+def home_stamps(request):
+    """The home page's fragment stamps, read once per request."""
+    if not hasattr(request, 'fragment_stamps'):
+        request.fragment_stamps = fragments.stamps(participants.fragment,
+                                                   leaderboard.fragment)
+    return request.fragment_stamps
+
+
+def home_etag(request, *args, **kwargs):
+    stamps = home_stamps(request)
+    # The page greets signed-in users, so the tag varies by user too
+    return '%s-%s-%s' % (stamps[participants.fragment.name][0],
+                         stamps[leaderboard.fragment.name][0],
+                         request.user.pk or 0)
+
+
+def home_last_modified(request, *args, **kwargs):
+    return max(modified for version, modified
+               in home_stamps(request).values())
+
+
 class HomePageView(TemplateView):
     template_name = 'home.html'
 
+    @method_decorator(condition(etag_func=home_etag,
+                                last_modified_func=home_last_modified))
+    def dispatch(self, *args, **kwargs):
+        return super(HomePageView, self).dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        with metrics.timer('home_page_seconds'):
+            response = super(HomePageView, self).get(request, *args,
+                                                     **kwargs)
+            # Render here so template time is included
+            return response.render()
+
     def get_context_data(self, **kwargs):
         context = super(HomePageView, self).get_context_data(**kwargs)
-        untappd_accounts = SocialAccount.objects.filter(provider='untappd')
-        context['untappd_accounts'] = untappd_accounts
+        stamps = home_stamps(self.request)
+        context['participants'] = mark_safe(participants.fragment.render(
+            version=stamps[participants.fragment.name][0]))
+        try:
+            context['leaderboard'] = mark_safe(leaderboard.fragment.render(
+                version=stamps[leaderboard.fragment.name][0]))
+        except Http404:
+            # No active event
+            context['leaderboard'] = ''
         return context
 
 
+@cache_control(public=True, max_age=settings.LEADERBOARD_CACHE_TIMEOUT)
+def leaderboard_json(request):
+    # Only real events and page numbers make cache keys
+    event = leaderboard.get_event(request.GET.get('event'))
+    try:
+        number = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        number = 1
+    key = leaderboard.fragment.cache_key('json', event.slug, number)
+    data = cache.get(key)
+    if data is None:
+        page = leaderboard.page_data(event.slug, number)
+        data = json.dumps(page)
+        # Pages past the end show the last one; cache that under its own
+        # number only
+        if page['page'] == number:
+            cache.set(key, data, settings.LEADERBOARD_CACHE_TIMEOUT)
+    return HttpResponse(data, content_type='application/json')
+
+
+@cache_control(public=True, max_age=settings.PARTICIPANTS_CACHE_TIMEOUT)
+def participants_page(request):
+    """A page of the participant list, for scrolling further down it."""
+    try:
+        number = int(request.GET.get('page', 1))
+    except ValueError:
+        number = 1
+    # Only real page numbers make cache keys
+    number = min(max(number, 1), participants.num_pages())
+    return HttpResponse(participants.fragment.render(number))
+
+
+def avatar(request, account_id, digest):
+    """
+    A participant's avatar thumbnail, made on first request. Its URL
+    names the source avatar, so it can be cached for good.
+    """
+    image = avatars.stored_thumbnail(account_id, digest)
+    if image is None:
+        account = get_object_or_404(SocialAccount, id=account_id,
+                                    provider='untappd')
+        url = avatars.thumbnail_url(account)
+        if not url:
+            raise Http404('No avatar')
+        if url != request.path:
+            # The avatar changed since the page linking here was cached
+            return redirect(url)
+        image = avatars.create_thumbnail(account)
+        if image is None:
+            # Let the browser try Untappd's copy
+            return redirect(avatars.source_url(account))
+    response = HttpResponse(image, content_type='image/jpeg')
+    patch_cache_control(response, public=True,
+                        max_age=settings.AVATAR_CACHE_TIMEOUT)
+    return response
+
+
+def metrics_view(request):
+    """
+    Every process's metrics in the Prometheus text format, labelled with
+    the process, for scrapers sending ``Authorization: Bearer
+    <METRICS_TOKEN>``. Other processes' are as they last published them.
+    """
+    if not settings.METRICS_TOKEN:
+        raise Http404('Metrics are off')
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not constant_time_compare(authorization,
+                                 'Bearer %s' % settings.METRICS_TOKEN):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render_all(),
+                        content_type='text/plain; version=0.0.4')
+
+
 class UntappdOAuth2CallbackView(OAuth2CallbackView):
     """ Custom OAuth2CallbackView to return UntappdOAuth2Client """
 
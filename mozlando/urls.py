@@ -18,12 +18,18 @@ from django.contrib import admin
 
 from allauth.account import views as account_views
 
-from mozlando.untappd.views import HomePageView
+from mozlando.untappd.views import (HomePageView, avatar, leaderboard_json,
+                                    metrics_view, participants_page)
 
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^accounts/', include('allauth.urls')),
     url(r'^signout/?$', account_views.logout, name='account_logout'),
+    url(r'^leaderboard\.json$', leaderboard_json, name='leaderboard'),
+    url(r'^participants$', participants_page, name='participants'),
+    url(r'^avatars/(?P<account_id>\d+)/(?P<digest>[0-9a-f]+)\.jpg$', avatar,
+        name='avatar'),
+    url(r'^metrics$', metrics_view, name='metrics'),
     url(r'^/?', HomePageView.as_view(), name='home')
 ]
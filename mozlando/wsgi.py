@@ -9,10 +9,19 @@ https://docs.djangoproject.com/en/1.8/howto/deployment/wsgi/
 
 import os
 
+# whitenoise.django reads the settings as it is imported
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mozlando.settings")
+
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
-from dj_static import Cling
+from whitenoise.django import DjangoWhiteNoise
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mozlando.settings")
+application = DjangoWhiteNoise(get_wsgi_application())
 
-application = Cling(get_wsgi_application())
+if settings.METRICS_TOKEN:
+    # Share this worker's metrics for /metrics to show with the others'.
+    # Gunicorn imports this in each worker after forking, so each gets
+    # its own publisher.
+    from mozlando.untappd import metrics
+    metrics.start_publisher(metrics.process_name('web'))